@@ -0,0 +1,210 @@
+"""Artvision Bot v5 — асинхронная точка входа (ASGI) того же вебхука
+
+Логика команд — в webhook.py (process_update и обработчики), здесь только
+ввод-вывод: обработчик апдейта работает в потоке, а его запросы к внешним API
+уходят через общий httpx.AsyncClient в event loop (см. RequestIO). Вызовы
+Telegram, ответ на которые обработчику не нужен, не ждут друг друга:
+answerCallbackQuery и editMessageText летят параллельно, и задержка апдейта —
+это критический путь (чтения GitHub/Webmaster + последний вызов Telegram).
+Плановый сбор позиций выгружает все хосты Webmaster параллельно.
+
+Vercel: в vercel.json указать dest маршрута /api/webhook — /api/asgi.py.
+Локально: uvicorn asgi:app --app-dir api
+"""
+
+import asyncio
+import json
+import os
+import sys
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import webhook as wh  # noqa: E402
+
+# Вызовы Bot API, результат которых обработчикам не нужен — уходят без ожидания
+TG_FIRE_AND_FORGET = frozenset({"sendMessage", "answerCallbackQuery", "editMessageText", "deleteMessage"})
+WM_COLLECT_CONCURRENCY = 4  # параллельных выгрузок Webmaster при плановом сборе
+HTTP_TIMEOUT = 15
+
+_client = None
+_client_loop = None
+
+
+def get_client():
+    """Общий httpx.AsyncClient текущего event loop (keep-alive между апдейтами инстанса)"""
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop:
+        import httpx
+        _client = httpx.AsyncClient(timeout=HTTP_TIMEOUT)
+        _client_loop = loop
+    return _client
+
+
+async def fetch(url, data=None, headers=None):
+    """Асинхронный двойник wh.http_request: тот же спан, предохранитель и запись об ошибке"""
+    breaker = wh.BREAKER_HOSTS.get(urlsplit(url).hostname)
+    with wh.request_span(url, "POST" if data else "GET") as sp:
+        if breaker and not wh.breaker_allow(breaker):
+            sp["error"] = "circuit open"
+            return None
+        try:
+            if data:
+                resp = await get_client().post(url, json=data, headers=headers)
+            else:
+                resp = await get_client().get(url, headers=headers)
+            sp["http.status_code"] = resp.status_code
+            resp.raise_for_status()
+            result = resp.json()
+        except Exception as e:
+            sp["error"] = e
+            wh.log("HTTP error", error=str(e), url=url.split("/bot")[0])
+            if breaker:
+                # HTTPStatusError несёт ответ; сеть и таймауты — без него
+                wh.breaker_record(breaker, getattr(getattr(e, "response", None), "status_code", None))
+            return None
+        if breaker:
+            wh.breaker_record(breaker, 200)
+        return result
+
+
+class RequestIO:
+    """Транспорт wh.http_request одного апдейта (вызывается из потока обработчика)
+
+    Чтения ждут ответа. Вызовы TG_FIRE_AND_FORGET сразу возвращают {"ok": True}
+    и выполняются в event loop параллельно, но внутри одного чата — по порядку.
+    Контекст (буфер логов, текущий спан) переходит в задачи loop вместе с вызовом.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.pending = []
+        self._chat_tail = {}  # chat_id → последний вызов в этот чат
+
+    def __call__(self, url, data=None, headers=None):
+        if url.startswith(wh.TG_API) and url.rsplit("/", 1)[-1] in TG_FIRE_AND_FORGET:
+            self.loop.call_soon_threadsafe(self._dispatch, url, data, headers)
+            return {"ok": True}
+        return asyncio.run_coroutine_threadsafe(fetch(url, data, headers), self.loop).result()
+
+    def _dispatch(self, url, data, headers):
+        chat_id = (data or {}).get("chat_id")
+        task = self.loop.create_task(self._send_after(self._chat_tail.get(chat_id), url, data, headers))
+        if chat_id is not None:
+            self._chat_tail[chat_id] = task
+        self.pending.append(task)
+
+    @staticmethod
+    async def _send_after(previous, url, data, headers):
+        if previous is not None:
+            await asyncio.wait([previous])
+        await fetch(url, data, headers)
+
+    async def drain(self):
+        """Дождаться вызовов без ожидания — после ответа Vercel может заморозить инстанс"""
+        await asyncio.gather(*self.pending)
+
+
+async def handle_update(body):
+    """Апдейт Telegram: process_update в потоке, ввод-вывод — через RequestIO"""
+    io = RequestIO(asyncio.get_running_loop())
+    wh.begin_request()
+    with wh.span("update", wh.SPAN_KIND_SERVER, root=True) as root:
+        try:
+            update = json.loads(body)
+            wh.begin_request(update.get("update_id"))
+            root["update_id"] = update.get("update_id")
+            wh.http_transport.set(io)
+            await asyncio.to_thread(wh.process_update, update)
+        except Exception as e:
+            wh.log_error(e)
+            root["error"] = e
+        finally:
+            await io.drain()
+
+
+async def collect_all_hosts():
+    """Плановый сбор: выгрузки по хостам параллельно, запись в хранилище — по очереди"""
+    io = RequestIO(asyncio.get_running_loop())
+    wh.http_transport.set(io)
+    hosts = await asyncio.to_thread(wh.get_hosts)
+    # collect_range и store_analytics ходят в KV через RequestIO — не из потока event loop
+    ranges = await asyncio.to_thread(lambda: {host_id: wh.collect_range(host_id) for host_id in hosts.values()})
+    due = [host_id for host_id, date_range in ranges.items() if date_range]
+    semaphore = asyncio.Semaphore(WM_COLLECT_CONCURRENCY)
+
+    async def fetch_host(host_id):
+        async with semaphore:
+            return await fetch(*wh.analytics_request(host_id, *ranges[host_id]))
+
+    results = await asyncio.gather(*(fetch_host(host_id) for host_id in due))
+    total = await asyncio.to_thread(lambda: sum(wh.store_analytics(host_id, data, ranges[host_id][1])
+                                                for host_id, data in zip(due, results) if data))
+    wh.log("Positions collected", records=total)
+    await asyncio.to_thread(wh.check_position_alerts)
+    await io.drain()
+    return total
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def respond(send, status, body=b""):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"text/plain; charset=utf-8")]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if _client is not None:
+                await _client.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI-приложение: POST — апдейт Telegram, GET ?collect=positions — Vercel Cron, ?profile= — профиль"""
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    query = parse_qs(scope.get("query_string", b"").decode())
+    if scope["method"] == "POST":
+        await handle_update(await read_body(receive))
+        await respond(send, 200, b"ok")
+
+    # Профилирование: GET /api/webhook?profile=N | raw (см. wh.profile_request)
+    elif "profile" in query:
+        authorization = dict(scope["headers"]).get(b"authorization", b"").decode()
+        await respond(send, *await asyncio.to_thread(wh.profile_request, query["profile"][0], authorization))
+
+    # Плановый сбор позиций: GET /api/webhook?collect=positions (Vercel Cron)
+    elif b"collect=positions" in scope.get("query_string", b""):
+        authorization = dict(scope["headers"]).get(b"authorization", b"").decode()
+        if not wh.authorized(authorization):
+            await respond(send, 403)
+            return
+        wh.begin_request()
+        with wh.span("collect positions", wh.SPAN_KIND_SERVER, root=True):
+            total = await collect_all_hosts()
+        await respond(send, 200, f"collected {total}".encode())
+
+    else:
+        await respond(send, 200, b"Artvision Bot v5 - Smart Mode")
+        return
+
+    wh.flush_logs()
+    wh.flush_trace()
@@ -17,17 +17,61 @@ import os
 import urllib.request
 import base64
 import re
+import sys
+import html
+import time
+import tracemalloc
+import functools
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime, timedelta
+from urllib.parse import parse_qs, urlsplit
 
 # === КОНФИГ ===
 TG_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN", "")
 GH_TOKEN = os.environ.get("GH_TOKEN", "")
 WM_TOKEN = os.environ.get("YANDEX_WEBMASTER_TOKEN", "")
 ASANA_TOKEN = os.environ.get("ASANA_TOKEN", "")
-ADMIN_IDS = os.environ.get("ADMIN_IDS", "161261562").split(",")
-TEAM_IDS = os.environ.get("TEAM_IDS", "161261562").split(",")  # ID сотрудников
+ADMIN_IDS = frozenset(os.environ.get("ADMIN_IDS", "161261562").split(","))
+TEAM_IDS = frozenset(os.environ.get("TEAM_IDS", "161261562").split(","))  # ID сотрудников
 WM_USER_ID = "126256095"
 BOT_USERNAME = "avportalbot"
+# Допуск дорогих операций: "ёмкость/период_сек" на пользователя и на инстанс
+ADMISSION_LIMITS = {
+    "status": (os.environ.get("ADMISSION_STATUS_USER", "5/60"), os.environ.get("ADMISSION_STATUS_GLOBAL", "30/60")),
+    "positions": (os.environ.get("ADMISSION_POSITIONS_USER", "5/60"), os.environ.get("ADMISSION_POSITIONS_GLOBAL", "30/60")),
+}
+LOG_SAMPLE_PASSIVE = float(os.environ.get("LOG_SAMPLE_PASSIVE", "0.1"))  # доля апдейтов с логами пассивного мониторинга
+CRON_SECRET = os.environ.get("CRON_SECRET", "")  # Vercel Cron присылает его в Authorization
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", "3"))  # ошибок подряд до размыкания
+BREAKER_RESET = float(os.environ.get("BREAKER_RESET", "30"))     # сек до пробного запроса
+HTTP_TIMEOUT = 15  # сек на внешний запрос; таймаут — сбой для предохранителя
+TRACING = os.environ.get("TRACING", "1") == "1"
+TRACE_FILE = os.environ.get("TRACE_FILE", "/tmp/traces.jsonl")  # OTLP/JSON, по строке на трассу
+TRACE_FILE_MAX_BYTES = 5 * 1024 * 1024  # дальше — переименование в .1
+PROFILE_FILE = os.environ.get("PROFILE_FILE", "/tmp/profile.folded")  # стеки последнего /profile
+PROFILE_INTERVAL = 0.005  # шаг сэмплирования стеков, сек
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", "600"))  # дольше — стоп, даже без N апдейтов
+
+# Локальное хранилище позиций Webmaster (на Vercel — /tmp инстанса, на VPS — постоянный путь)
+POSITIONS_DB = os.environ.get("POSITIONS_DB", "/tmp/positions.db")
+# Постоянная копия хранилища для всех инстансов: Vercel KV / Upstash Redis (REST API).
+# Без неё на Vercel собранные позиции и базы алертов живут только в /tmp одного инстанса
+KV_URL = os.environ.get("KV_REST_API_URL", "")
+KV_TOKEN = os.environ.get("KV_REST_API_TOKEN", "")
+WM_QUERY_LIMIT = 100     # запросов на хост за одну выгрузку
+WM_HISTORY_DAYS = 14     # глубина первой выгрузки (две недели — для сравнения неделя к неделе)
+WM_REFETCH_DAYS = 3      # последние дни перезапрашиваются: Webmaster дописывает их с задержкой
+WM_HOSTS_TTL = 24 * 3600
+WM_KEEP_DAYS = 14 + WM_REFETCH_DAYS  # дней хоста в KV: две недели для /trend + недописанные
+# Алерты после планового сбора: падение позиции запроса (позиций) и показов хоста (доля от обычных)
+ALERT_POSITION_DROP = float(os.environ.get("ALERT_POSITION_DROP", "3"))
+ALERT_IMPRESSIONS_DROP = float(os.environ.get("ALERT_IMPRESSIONS_DROP", "0.5"))
+ALERT_MIN_IMPRESSIONS = 20   # запросы/хосты с меньшими обычными показами в день — шум
+ALERT_MIN_DAYS = 3           # дней в базе до первых алертов
+ALERT_EWMA = 2 / (7 + 1)     # вес нового дня в скользящей базе (~неделя)
+TG_API = f"https://api.telegram.org/bot{TG_TOKEN}"
 
 # Паттерны для распознавания задач в чате
 TASK_PATTERNS = [
@@ -38,30 +82,258 @@ TASK_PATTERNS = [
     r"(добавь|добавить)\s+(.+)",
 ]
 
+# Регулярки компилируются один раз при импорте, а не на каждом сообщении
+TASK_RES = [re.compile(p, re.IGNORECASE) for p in TASK_PATTERNS]
+TRIGGER_RE = re.compile(r'^бот[\s,!?.:\-]')
+TRIGGER_PREFIX_RE = re.compile(r'^бот[\s,!?.:\-]*', re.IGNORECASE)
+MENTION_RE = re.compile(rf'@{BOT_USERNAME}\s*', re.IGNORECASE)
+TRAILING_PUNCT_RE = re.compile(r'[\.\!\?]+$')
+CREATE_TASK_RE = re.compile(r'^(создай|добавь|новая)\s*задач[у|а][\s:]*', re.IGNORECASE)
+
+
+# === ЛОГИРОВАНИЕ ===
+# Записи (JSON) копятся в буфере запроса с update_id и выводятся одной записью
+# в stdout после ответа — обработчик не ждёт вывода на каждом log().
+# Пассивный мониторинг пишется только для доли апдейтов LOG_SAMPLE_PASSIVE.
+# Буфер свой у каждого запроса (contextvars): api/asgi.py обрабатывает апдейты
+# параллельно, а потоки и задачи запроса видят один и тот же буфер.
+
+_request_log = ContextVar("request_log", default=None)
+
+
+def _log_state():
+    state = _request_log.get()
+    if state is None:
+        state = begin_request()
+    return state
+
+
+def log(msg, **fields):
+    """Структурированная запись в буфер текущего запроса"""
+    started = time.perf_counter()
+    state = _log_state()
+    record = {"ts": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"), "msg": msg, **fields}
+    if state["update_id"] is not None:
+        record["update_id"] = state["update_id"]
+    state["records"].append(record)
+    state["cost"] += time.perf_counter() - started
+
+
+def log_sampled(msg, **fields):
+    """Высокочастотные события — только для выборки апдейтов (целиком, не вразнобой)"""
+    if _log_state()["sampled"]:
+        log(msg, sample_rate=LOG_SAMPLE_PASSIVE, **fields)
+
+
+def begin_request(update_id=None):
+    state = {
+        "records": [],
+        "update_id": update_id,
+        "sampled": update_id is None or update_id % 1000 < LOG_SAMPLE_PASSIVE * 1000,
+        "cost": 0.0,
+        "started": time.perf_counter(),
+    }
+    _request_log.set(state)
+    return state
+
+
+def flush_logs():
+    """Вывести буфер запроса + итог по апдейту (время обработки, стоимость логов)"""
+    state = _log_state()
+    records = state["records"]
+    if not records and not state["sampled"]:
+        return
+    started = time.perf_counter()
+    lines = [json.dumps(r, ensure_ascii=False, default=str) for r in records]
+    summary = {
+        "ts": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+        "msg": "update processed",
+        "update_id": state["update_id"],
+        "duration_ms": round((started - state["started"]) * 1000, 1),
+        "log_records": len(records),
+        "log_cost_us": round((state["cost"] + time.perf_counter() - started) * 1e6),
+    }
+    lines.append(json.dumps(summary))
+    print("\n".join(lines), flush=True)
+    records.clear()
+
+
+# === ТРАССИРОВКА ===
+# Корневой спан на запрос (do_POST / do_GET), дочерние — вокруг http_request и
+# функций хранилища позиций. Трасса пишется после ответа одной строкой OTLP/JSON
+# в TRACE_FILE — тот же формат, что у bot.py, разбирается теми же средствами.
+
+SPAN_KIND_INTERNAL, SPAN_KIND_SERVER, SPAN_KIND_CLIENT = 1, 2, 3
+
+_current_span = ContextVar("current_span", default=None)
+_trace_spans = ContextVar("trace_spans", default=None)  # завершённые спаны трассы запроса
+
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+@contextmanager
+def span(name, kind=SPAN_KIND_INTERNAL, root=False, **attrs):
+    """Спан вокруг блока; отдаёт словарь атрибутов (ключ "error" → статус ошибки)
 
-def log(msg):
-    """Логирование"""
-    print(f"[BOT v5] {datetime.now().strftime('%H:%M:%S')} {msg}")
+    Вне корневого спана (и при TRACING=0) ничего не записывается.
+    """
+    parent = None if root else _current_span.get()
+    if not TRACING or (not root and parent is None):
+        yield attrs
+        return
+    if root:
+        _trace_spans.set([])
+    sp = {
+        "traceId": parent["traceId"] if parent else os.urandom(16).hex(),
+        "spanId": os.urandom(8).hex(),
+        "parentSpanId": parent["spanId"] if parent else "",
+        "name": name,
+        "kind": kind,
+        "startTimeUnixNano": str(time.time_ns()),
+    }
+    spans = _trace_spans.get()
+    token = _current_span.set(sp)
+    try:
+        yield attrs
+    except Exception as e:
+        attrs["error"] = str(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        error = attrs.pop("error", None)
+        sp["endTimeUnixNano"] = str(time.time_ns())
+        sp["attributes"] = [{"key": k, "value": otlp_value(v)} for k, v in attrs.items() if v is not None]
+        sp["status"] = {"code": 2, "message": str(error)[:300]} if error else {"code": 1}
+        spans.append(sp)
+
+
+def traced(func):
+    """Спан "<имя функции>" вокруг вызова (внутри текущей трассы)"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def flush_trace():
+    """Дописать завершённую трассу в TRACE_FILE (после ответа, как и логи)"""
+    spans = _trace_spans.get()
+    if not spans:
+        return
+    line = json.dumps({"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "artvision-webhook"}}]},
+        "scopeSpans": [{"scope": {"name": "artvision.webhook"}, "spans": spans}],
+    }]}, ensure_ascii=False, default=str)
+    _trace_spans.set(None)
+    try:
+        if os.path.exists(TRACE_FILE) and os.path.getsize(TRACE_FILE) > TRACE_FILE_MAX_BYTES:
+            os.replace(TRACE_FILE, TRACE_FILE + ".1")
+        with open(TRACE_FILE, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    except OSError as e:
+        print(json.dumps({"msg": "Trace write error", "error": str(e)}), flush=True)
+
+
+# === ПРЕДОХРАНИТЕЛИ ВНЕШНИХ API ===
+# После BREAKER_FAILURES ошибок подряд (сеть, таймаут, 5xx, 429) запросы к сервису
+# сразу получают None вместо ожидания таймаута; через BREAKER_RESET сек пропускается
+# один пробный запрос (half-open). Состояние — в памяти инстанса, смотреть: /health.
+
+BREAKER_HOSTS = {"api.webmaster.yandex.net": "webmaster", "api.github.com": "github"}
+if KV_URL:
+    BREAKER_HOSTS[urlsplit(KV_URL).hostname] = "kv"
+
+_breakers = {name: {"state": "closed", "failures": 0, "opened_at": 0.0, "rejected": 0}
+             for name in BREAKER_HOSTS.values()}
+_breakers_lock = threading.Lock()  # api/asgi.py вызывает обработчики из пула потоков
+
+
+def breaker_allow(name):
+    """Можно ли идти в сервис; в half-open — только пробному запросу"""
+    with _breakers_lock:
+        b = _breakers[name]
+        if b["state"] == "open" and time.monotonic() - b["opened_at"] >= BREAKER_RESET:
+            b["state"] = "half-open"
+            log("Breaker state", breaker=name, state="half-open")
+            return True
+        if b["state"] == "closed":
+            return True
+        b["rejected"] += 1
+        return False
+
+
+def breaker_record(name, status):
+    """Итог запроса: status None — сеть/таймаут; 5xx и 429 — сбой сервиса"""
+    with _breakers_lock:
+        b = _breakers[name]
+        if status is None or status >= 500 or status == 429:
+            b["failures"] += 1
+            if b["state"] == "half-open" or b["failures"] >= BREAKER_FAILURES:
+                b["opened_at"] = time.monotonic()
+                if b["state"] != "open":
+                    b["state"] = "open"
+                    log("Breaker state", breaker=name, state="open", failures=b["failures"])
+        else:
+            if b["state"] != "closed":
+                log("Breaker state", breaker=name, state="closed")
+            b.update(state="closed", failures=0)
+
+
+# Транспорт запросов текущего апдейта: None — urllib в этом же потоке;
+# api/asgi.py подставляет общий асинхронный клиент (см. RequestIO там)
+http_transport = ContextVar("http_transport", default=None)
+
+
+def request_span(url, method):
+    """Спан исходящего запроса. В URL Telegram — токен бота: в спан идут только хост и метод API"""
+    host = urlsplit(url).hostname
+    name = f"telegram {url.rsplit('/', 1)[-1]}" if url.startswith(TG_API) else f"http {host}"
+    return span(name, SPAN_KIND_CLIENT, **{"server.address": host, "http.method": method})
 
 
 def http_request(url, data=None, headers=None):
-    """HTTP запрос"""
+    """HTTP запрос (None — ошибка или разомкнутый предохранитель сервиса)"""
+    transport = http_transport.get()
+    if transport is not None:
+        return transport(url, data, headers)
     headers = headers or {}
     if data:
         data = json.dumps(data).encode()
         headers["Content-Type"] = "application/json"
     req = urllib.request.Request(url, data=data, headers=headers)
-    try:
-        with urllib.request.urlopen(req, timeout=15) as resp:
-            return json.loads(resp.read().decode())
-    except Exception as e:
-        log(f"HTTP error: {e}")
-        return None
+    breaker = BREAKER_HOSTS.get(urlsplit(url).hostname)
+    with request_span(url, req.get_method()) as sp:
+        if breaker and not breaker_allow(breaker):
+            sp["error"] = "circuit open"
+            return None
+        try:
+            with urllib.request.urlopen(req, timeout=HTTP_TIMEOUT) as resp:
+                sp["http.status_code"] = resp.status
+                result = json.loads(resp.read().decode())
+        except Exception as e:
+            sp["error"] = e
+            log("HTTP error", error=str(e), url=url.split("/bot")[0])
+            if breaker:
+                # HTTPError несёт код ответа; сеть и таймауты — без него
+                breaker_record(breaker, getattr(e, "code", None))
+            return None
+        if breaker:
+            breaker_record(breaker, 200)
+        return result
 
 
 def send_tg(chat_id, text, reply_to=None, buttons=None):
     """Отправить сообщение в Telegram"""
-    url = f"https://api.telegram.org/bot{TG_TOKEN}/sendMessage"
+    url = f"{TG_API}/sendMessage"
     payload = {
         "chat_id": chat_id,
         "text": text[:4000],
@@ -74,6 +346,60 @@ def send_tg(chat_id, text, reply_to=None, buttons=None):
     return http_request(url, payload)
 
 
+# === ДОПУСК ДОРОГИХ ОПЕРАЦИЙ ===
+# Token bucket на пользователя и общий. Вебхук не может держать запрос Telegram
+# в очереди, поэтому сверх бюджета — сразу отказ с временем ожидания.
+# Вёдра живут в памяти инстанса; полные (период без списаний) выбрасываются.
+
+BUCKETS_MAX = 1000  # больше вёдер — чистка полных
+
+_buckets = {}
+
+
+def bucket_spec(key):
+    op, user_id = key
+    return ADMISSION_LIMITS[op][0 if user_id is not None else 1]
+
+
+def prune_buckets(now):
+    """Убрать вёдра, не тронутые дольше своего периода: они уже полные"""
+    for key, (_, updated) in list(_buckets.items()):
+        if now - updated >= float(bucket_spec(key).split("/")[1]):
+            _buckets.pop(key, None)
+
+
+def take_token(key, spec):
+    """Списать токен из ведра key ('ёмкость/период'). Возвращает 0 или сек до следующего токена"""
+    capacity, period = (float(x) for x in spec.split("/"))
+    rate = capacity / period
+    now = time.monotonic()
+    if len(_buckets) > BUCKETS_MAX:
+        prune_buckets(now)
+    tokens, updated = _buckets.get(key, (capacity, now))
+    tokens = min(capacity, tokens + (now - updated) * rate)
+    if tokens < 1:
+        _buckets[key] = (tokens, now)
+        return (1 - tokens) / rate
+    _buckets[key] = (tokens - 1, now)
+    return 0
+
+
+def admit(op, user_id, chat_id):
+    """Пропустить операцию op или ответить, через сколько повторить"""
+    user_spec, global_spec = ADMISSION_LIMITS[op]
+    wait = take_token((op, user_id), user_spec)
+    if not wait:
+        wait = take_token((op, None), global_spec)
+        if wait:
+            # Общий бюджет исчерпан — вернуть токен пользователю
+            tokens, updated = _buckets[(op, user_id)]
+            _buckets[(op, user_id)] = (tokens + 1, updated)
+    if wait:
+        send_tg(chat_id, f"⏳ Слишком много запросов подряд. Попробуй через {int(wait) + 1} сек.")
+        return False
+    return True
+
+
 # === ОПРЕДЕЛЕНИЕ ТИПА СООБЩЕНИЯ ===
 
 def is_bot_trigger(text, message):
@@ -88,7 +414,7 @@ def is_bot_trigger(text, message):
     text_lower = text.lower().strip()
     
     # Паттерн: начинается с "бот" + пробел/знак препинания
-    if re.match(r'^бот[\s,!?.:\-]', text_lower):
+    if TRIGGER_RE.match(text_lower):
         return True
     if text_lower == "бот":
         return True
@@ -113,9 +439,9 @@ def extract_bot_query(text):
     "@avportalbot помоги" → "помоги"
     """
     # Убираем "бот" в начале
-    text = re.sub(r'^бот[\s,!?.:\-]*', '', text, flags=re.IGNORECASE).strip()
+    text = TRIGGER_PREFIX_RE.sub('', text).strip()
     # Убираем @username
-    text = re.sub(rf'@{BOT_USERNAME}\s*', '', text, flags=re.IGNORECASE).strip()
+    text = MENTION_RE.sub('', text).strip()
     return text
 
 
@@ -125,13 +451,13 @@ def detect_task_intent(text):
     Возвращает (True, описание) или (False, None)
     """
     text_lower = text.lower()
-    for pattern in TASK_PATTERNS:
-        match = re.search(pattern, text_lower, re.IGNORECASE)
+    for pattern in TASK_RES:
+        match = pattern.search(text_lower)
         if match:
             # Извлекаем описание задачи
             task_desc = match.group(2).strip()
             # Убираем лишнее
-            task_desc = re.sub(r'[\.\!\?]+$', '', task_desc)
+            task_desc = TRAILING_PUNCT_RE.sub('', task_desc)
             if len(task_desc) > 5:  # Минимум 5 символов
                 return True, task_desc
     return False, None
@@ -144,7 +470,7 @@ def handle_bot_command(chat_id, user_id, text, message):
     query = extract_bot_query(text)
     query_lower = query.lower()
     
-    log(f"Bot query: '{query}'")
+    log("Bot query", query=query)
     
     # Простые ответы
     if query_lower in ["привет", "здравствуй", "ты тут?", "ты здесь?", "ты здесь", "ты тут"]:
@@ -164,7 +490,7 @@ def handle_bot_command(chat_id, user_id, text, message):
     
     # Создание задачи
     if query_lower.startswith(("создай задачу", "добавь задачу", "новая задача")):
-        task_name = re.sub(r'^(создай|добавь|новая)\s*задач[у|а][\s:]*', '', query, flags=re.IGNORECASE).strip()
+        task_name = CREATE_TASK_RE.sub('', query).strip()
         if task_name:
             # TODO: интеграция с Asana
             send_tg(chat_id, f"✅ Задача создана:\n<b>{task_name}</b>\n\n<i>(интеграция с Asana в разработке)</i>",
@@ -176,13 +502,15 @@ def handle_bot_command(chat_id, user_id, text, message):
     
     # Статус
     if query_lower in ["статус", "status"]:
-        handle_status(chat_id)
+        if admit("status", user_id, chat_id):
+            handle_status(chat_id)
         return
     
     # Позиции
     if query_lower.startswith("позиции"):
         args = query.split()[1:] if len(query.split()) > 1 else []
-        handle_positions(chat_id, args)
+        if admit("positions", user_id, chat_id):
+            handle_positions(chat_id, args)
         return
     
     # Не понял
@@ -203,11 +531,12 @@ def handle_passive_monitoring(chat_id, user_id, text, message):
     is_task, task_desc = detect_task_intent(text)
     
     if is_task and task_desc:
-        log(f"Detected task intent: {task_desc}")
+        log_sampled("Detected task intent", task=task_desc)
         
-        # Предлагаем создать задачу
+        # Предлагаем создать задачу. Описание в callback_data не кладём (лимит 64 байта):
+        # предложение отвечает на исходное сообщение, из него задача и восстанавливается
         buttons = [[
-            {"text": "✅ Да, создай", "callback_data": f"create_task:{task_desc[:50]}"},
+            {"text": "✅ Да, создай", "callback_data": "create_task"},
             {"text": "❌ Не надо", "callback_data": "dismiss"}
         ]]
         
@@ -221,64 +550,446 @@ def handle_passive_monitoring(chat_id, user_id, text, message):
 
 # === СТАНДАРТНЫЕ КОМАНДЫ ===
 
+_report_cache = {}
+
+
 def get_report():
+    """Сводка позиций из GitHub → (report, fetched_at)
+
+    fetched_at — None для свежих данных; при сбое GitHub отдаётся последняя
+    удачная сводка инстанса и время её получения.
+    """
     url = "https://api.github.com/repos/justtrance-web/artvision-data/contents/monitoring/position_history.json"
     data = http_request(url, headers={"Authorization": f"token {GH_TOKEN}"})
     if data and "content" in data:
-        return json.loads(base64.b64decode(data["content"]))
-    return None
+        report = json.loads(base64.b64decode(data["content"]))
+        _report_cache.update(report=report, fetched_at=time.time())
+        return report, None
+    return _report_cache.get("report"), _report_cache.get("fetched_at")
+
+
+# === ХРАНИЛИЩЕ ПОЗИЦИЙ ===
+# Посуточная статистика (хост, запрос, день) копится в SQLite: /positions и /trend
+# считаются по ней. На Vercel POSITIONS_DB — /tmp одного недолговечного инстанса,
+# поэтому с KV_URL каждый хост после записи выгружается в KV одним ключом (дни за
+# WM_KEEP_DAYS, водяной знак сбора, базы алертов), а инстанс, который хоста ещё не
+# видел, сначала подтягивает его оттуда. Тогда плановый сбор действительно избавляет
+# остальные инстансы от походов в Webmaster, а базы алертов переживают инстанс.
+# Без KV_URL хранилище локальное — постоянное только на VPS с POSITIONS_DB на диске.
+
+_positions_local = threading.local()
+
 
+def positions_db():
+    """SQLite-хранилище позиций (открывается при первом обращении в потоке)
 
+    Соединение своё у каждого потока: в api/asgi.py обработчики работают в пуле потоков.
+    """
+    conn = getattr(_positions_local, "conn", None)
+    if conn is None:
+        import sqlite3
+        conn = sqlite3.connect(POSITIONS_DB)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS wm_hosts (
+                url TEXT PRIMARY KEY,
+                host_id TEXT NOT NULL,
+                fetched_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS wm_queries (
+                id INTEGER PRIMARY KEY,
+                host_id TEXT NOT NULL,
+                text TEXT NOT NULL,
+                UNIQUE (host_id, text)
+            );
+            CREATE TABLE IF NOT EXISTS wm_query_days (
+                query_id INTEGER NOT NULL,
+                day TEXT NOT NULL,
+                impressions INTEGER NOT NULL,
+                clicks INTEGER NOT NULL,
+                position REAL NOT NULL,
+                PRIMARY KEY (query_id, day)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS wm_collected (
+                host_id TEXT PRIMARY KEY,
+                last_day TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS wm_query_baseline (
+                query_id INTEGER PRIMARY KEY,
+                position REAL NOT NULL,
+                impressions REAL NOT NULL,
+                days INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS wm_host_baseline (
+                host_id TEXT PRIMARY KEY,
+                impressions REAL NOT NULL,
+                days INTEGER NOT NULL,
+                last_day TEXT NOT NULL
+            );
+        """)
+        _positions_local.conn = conn
+    return conn
+
+
+_loaded_hosts = set()  # хосты, уже подтянутые из KV этим инстансом
+_loaded_lock = threading.Lock()
+
+
+def kv_command(*args):
+    """Команда Redis через REST API KV → ответ {"result": ...} (None — ошибка)"""
+    return http_request(KV_URL, list(args), {"Authorization": f"Bearer {KV_TOKEN}"})
+
+
+def load_host(host_id):
+    """Подтянуть хост из KV в локальную базу, если инстанс его ещё не видел
+
+    При ошибке KV хост остаётся незагруженным: следующий вызов повторит,
+    а save_host до тех пор не перезапишет KV неполными локальными данными.
+    """
+    if not KV_URL or host_id in _loaded_hosts:
+        return
+    with _loaded_lock:
+        if host_id in _loaded_hosts:
+            return
+        resp = kv_command("GET", f"wm:host:{host_id}")
+        if resp is None:
+            return
+        if resp.get("result"):
+            state = json.loads(resp["result"])
+            db = positions_db()
+            with db:
+                for text, day, impressions, clicks, position in state["days"]:
+                    db.execute("INSERT OR IGNORE INTO wm_queries (host_id, text) VALUES (?, ?)", (host_id, text))
+                    db.execute("""
+                        INSERT OR REPLACE INTO wm_query_days (query_id, day, impressions, clicks, position)
+                        SELECT id, ?, ?, ?, ? FROM wm_queries WHERE host_id = ? AND text = ?
+                    """, (day, impressions, clicks, position, host_id, text))
+                for text, position, impressions, days in state.get("query_baseline", []):
+                    db.execute("INSERT OR IGNORE INTO wm_queries (host_id, text) VALUES (?, ?)", (host_id, text))
+                    db.execute("""
+                        INSERT OR REPLACE INTO wm_query_baseline (query_id, position, impressions, days)
+                        SELECT id, ?, ?, ? FROM wm_queries WHERE host_id = ? AND text = ?
+                    """, (position, impressions, days, host_id, text))
+                if state.get("host_baseline"):
+                    db.execute("INSERT OR REPLACE INTO wm_host_baseline (host_id, impressions, days, last_day) VALUES (?, ?, ?, ?)",
+                               (host_id, *state["host_baseline"]))
+                if state["collected"]:
+                    db.execute("""
+                        INSERT INTO wm_collected (host_id, last_day) VALUES (?, ?)
+                        ON CONFLICT (host_id) DO UPDATE SET last_day = MAX(last_day, excluded.last_day)
+                    """, (host_id, state["collected"]))
+        _loaded_hosts.add(host_id)
+
+
+def save_host(host_id):
+    """Выгрузить хост в KV: дни за WM_KEEP_DAYS и после водяного знака алертов, базы алертов"""
+    if not KV_URL or host_id not in _loaded_hosts:
+        return
+    db = positions_db()
+    collected = db.execute("SELECT last_day FROM wm_collected WHERE host_id = ?", (host_id,)).fetchone()
+    host_baseline = db.execute("SELECT impressions, days, last_day FROM wm_host_baseline WHERE host_id = ?",
+                               (host_id,)).fetchone()
+    since = (datetime.now() - timedelta(days=WM_KEEP_DAYS)).date().isoformat()
+    if host_baseline:
+        since = min(since, host_baseline[2])  # дни, ещё не учтённые в базе, нужны алертам
+    days = db.execute("""
+        SELECT q.text, d.day, d.impressions, d.clicks, d.position
+        FROM wm_queries q JOIN wm_query_days d ON d.query_id = q.id
+        WHERE q.host_id = ? AND d.day > ?
+    """, (host_id, since)).fetchall()
+    query_baseline = db.execute("""
+        SELECT q.text, b.position, b.impressions, b.days
+        FROM wm_query_baseline b JOIN wm_queries q ON q.id = b.query_id
+        WHERE q.host_id = ?
+    """, (host_id,)).fetchall()
+    state = {"collected": collected and collected[0], "host_baseline": host_baseline,
+             "days": days, "query_baseline": query_baseline}
+    if kv_command("SET", f"wm:host:{host_id}", json.dumps(state, ensure_ascii=False)) is None:
+        log("KV save failed", host_id=host_id)
+
+
+@traced
 def get_hosts():
+    """Подтверждённые хосты Webmaster {url: host_id}, кэш на WM_HOSTS_TTL"""
+    db = positions_db()
+    rows = db.execute("SELECT url, host_id FROM wm_hosts WHERE fetched_at > ?",
+                      (datetime.now().timestamp() - WM_HOSTS_TTL,)).fetchall()
+    if rows:
+        return dict(rows)
+    
     url = f"https://api.webmaster.yandex.net/v4/user/{WM_USER_ID}/hosts"
     data = http_request(url, headers={"Authorization": f"OAuth {WM_TOKEN}"})
-    if data:
-        return {h["ascii_host_url"]: h["host_id"] for h in data.get("hosts", []) if h.get("verified")}
-    return {}
+    if not data:
+        return dict(db.execute("SELECT url, host_id FROM wm_hosts").fetchall())
+    
+    hosts = {h["ascii_host_url"]: h["host_id"] for h in data.get("hosts", []) if h.get("verified")}
+    now = datetime.now().timestamp()
+    with db:
+        db.execute("DELETE FROM wm_hosts")
+        db.executemany("INSERT INTO wm_hosts (url, host_id, fetched_at) VALUES (?, ?, ?)",
+                       [(u, hid, now) for u, hid in hosts.items()])
+    return hosts
 
 
-def get_positions(domain):
-    hosts = get_hosts()
-    host_id = None
-    for url, hid in hosts.items():
+def find_host_id(domain):
+    for url, hid in get_hosts().items():
         if domain in url:
-            host_id = hid
-            break
-    if not host_id:
+            return hid
+    return None
+
+
+def collect_range(host_id):
+    """(date_from, yesterday) для догрузки хоста или None, если данные уже по вчера"""
+    yesterday = (datetime.now() - timedelta(days=1)).date()
+    load_host(host_id)
+    row = positions_db().execute("SELECT last_day FROM wm_collected WHERE host_id = ?", (host_id,)).fetchone()
+    if row and row[0] >= yesterday.isoformat():
         return None
+    if row:
+        return datetime.fromisoformat(row[0]).date() - timedelta(days=WM_REFETCH_DAYS - 1), yesterday
+    return yesterday - timedelta(days=WM_HISTORY_DAYS - 1), yesterday
+
+
+def analytics_request(host_id, date_from, date_to):
+    """Аргументы http_request для выгрузки query-analytics хоста"""
+    url = f"https://api.webmaster.yandex.net/v4/user/{WM_USER_ID}/hosts/{host_id}/query-analytics/list"
+    return url, {
+        "offset": 0, "limit": WM_QUERY_LIMIT, "device_type_indicator": "ALL",
+        "text_indicator": "QUERY", "date_from": date_from.isoformat(), "date_to": date_to.isoformat()
+    }, {"Authorization": f"OAuth {WM_TOKEN}"}
+
+
+@traced
+def collect_host(host_id):
+    """Догрузить посуточную статистику хоста до вчерашнего дня. Возвращает число записей"""
+    date_range = collect_range(host_id)
+    if not date_range:
+        return 0
+    data = http_request(*analytics_request(host_id, *date_range))
+    if not data:
+        return 0
+    return store_analytics(host_id, data, date_range[1])
+
+
+@traced
+def store_analytics(host_id, data, yesterday):
+    """Записать выгрузку query-analytics в хранилище. Возвращает число записей"""
+    load_host(host_id)
+    db = positions_db()
+    records = 0
+    with db:
+        for q in data.get("text_indicator_to_statistics", []):
+            text = q.get("text_indicator", {}).get("value", "")
+            by_day = {}
+            for stat in q.get("statistics", []):
+                day = by_day.setdefault(stat.get("date"), {"IMPRESSIONS": 0, "CLICKS": 0, "POSITION": 0})
+                if stat["field"] in day:
+                    day[stat["field"]] = stat["value"]
+            by_day.pop(None, None)
+            if not by_day:
+                continue
+            
+            db.execute("INSERT OR IGNORE INTO wm_queries (host_id, text) VALUES (?, ?)", (host_id, text))
+            query_id = db.execute("SELECT id FROM wm_queries WHERE host_id = ? AND text = ?",
+                                  (host_id, text)).fetchone()[0]
+            db.executemany(
+                "INSERT OR REPLACE INTO wm_query_days (query_id, day, impressions, clicks, position) VALUES (?, ?, ?, ?, ?)",
+                [(query_id, day[:10], int(v["IMPRESSIONS"]), int(v["CLICKS"]), float(v["POSITION"]))
+                 for day, v in by_day.items()]
+            )
+            records += len(by_day)
+        db.execute("INSERT OR REPLACE INTO wm_collected (host_id, last_day) VALUES (?, ?)",
+                   (host_id, yesterday.isoformat()))
+    save_host(host_id)
+    return records
+
+
+def positions_stale_note(domain):
+    """Пометка, если Webmaster не отдал статистику за вчера и данные — из хранилища"""
+    host_id = find_host_id(domain)
+    row = positions_db().execute("SELECT last_day FROM wm_collected WHERE host_id = ?", (host_id,)).fetchone()
+    yesterday = (datetime.now() - timedelta(days=1)).date().isoformat()
+    if not row or row[0] >= yesterday:
+        return ""
+    return stale_note("Webmaster", datetime.fromisoformat(row[0]).strftime("%d.%m"))
+
+
+def collect_all_hosts():
+    """Плановый сбор по всем хостам (Vercel Cron / ручной запуск) + алерты
+
+    Данные остаются на других инстансах только с KV_URL (см. ХРАНИЛИЩЕ ПОЗИЦИЙ).
+    """
+    total = 0
+    for host_id in get_hosts().values():
+        total += collect_host(host_id)
+    log("Positions collected", records=total)
+    check_position_alerts()
+    return total
+
+
+# === АЛЕРТЫ ПО ПОЗИЦИЯМ ===
+# Каждый новый день хоста сравнивается с компактной базой: скользящие средние
+# (EWMA) позиции и показов по запросу (wm_query_baseline) и показов по хосту
+# (wm_host_baseline, там же водяной знак last_day). Читаются только строки после
+# водяного знака, так что работа зависит от новых данных, а не от всей истории.
+# Последние дни Webmaster ещё дописывает (см. WM_REFETCH_DAYS) — они ждут.
+# Базы сохраняются в KV вместе с днями хоста (save_host), иначе на Vercel каждый
+# холодный инстанс начинал бы набирать их заново и молчал.
+
+
+def ewma(base, value):
+    return base + ALERT_EWMA * (value - base)
+
+
+def host_day_alerts(db, host_id, settled):
+    """Обработать новые дни хоста до settled включительно → строки алертов"""
+    base_row = db.execute("SELECT impressions, days, last_day FROM wm_host_baseline WHERE host_id = ?",
+                          (host_id,)).fetchone()
+    host_impressions, host_days, since = base_row or (0.0, 0, "")
+    rows = db.execute("""
+        SELECT d.day, d.query_id, q.text, d.impressions, d.position
+        FROM wm_queries q JOIN wm_query_days d ON d.query_id = q.id
+        WHERE q.host_id = ? AND d.day > ? AND d.day <= ?
+        ORDER BY d.day
+    """, (host_id, since, settled)).fetchall()
+    if not rows:
+        return []
     
-    today = datetime.now()
-    date_to = (today - timedelta(days=1)).strftime("%Y-%m-%d")
-    date_from = (today - timedelta(days=7)).strftime("%Y-%m-%d")
+    baseline = {qid: [pos, impr, days] for qid, pos, impr, days in db.execute("""
+        SELECT b.query_id, b.position, b.impressions, b.days
+        FROM wm_query_baseline b JOIN wm_queries q ON q.id = b.query_id
+        WHERE q.host_id = ?
+    """, (host_id,))}
     
-    url = f"https://api.webmaster.yandex.net/v4/user/{WM_USER_ID}/hosts/{host_id}/query-analytics/list"
-    data = http_request(url, {
-        "offset": 0, "limit": 12, "device_type_indicator": "ALL",
-        "text_indicator": "QUERY", "date_from": date_from, "date_to": date_to
-    }, {"Authorization": f"OAuth {WM_TOKEN}"})
+    alerts = []
+    day_rows = {}
+    for row in rows:
+        day_rows.setdefault(row[0], []).append(row)
+    for day, group in day_rows.items():
+        label = datetime.fromisoformat(day).strftime("%d.%m")
+        impressions = sum(r[3] for r in group)
+        if (host_days >= ALERT_MIN_DAYS and host_impressions >= ALERT_MIN_IMPRESSIONS
+                and impressions < host_impressions * ALERT_IMPRESSIONS_DROP):
+            alerts.append(f"{label}: показы {host_impressions:.0f} → {impressions} "
+                          f"({100 * (impressions / host_impressions - 1):+.0f}%)")
+        host_impressions = ewma(host_impressions, impressions) if host_days else impressions
+        host_days += 1
+        
+        for _, query_id, text, impr, position in group:
+            base = baseline.get(query_id)
+            if base is None:
+                baseline[query_id] = [position, impr, 1]
+                continue
+            base_position, base_impr, days = base
+            if impr and position > 0:
+                if (days >= ALERT_MIN_DAYS and base_impr >= ALERT_MIN_IMPRESSIONS and base_position > 0
+                        and position - base_position >= ALERT_POSITION_DROP):
+                    alerts.append(f"{label}: «{html.escape(text[:40])}» {base_position:.1f} → {position:.1f}")
+                base[0] = ewma(base_position, position) if base_position > 0 else position
+            base[1] = ewma(base_impr, impr)
+            base[2] = days + 1
     
-    if not data:
+    with db:
+        db.executemany("INSERT OR REPLACE INTO wm_query_baseline (query_id, position, impressions, days) VALUES (?, ?, ?, ?)",
+                       [(qid, *values) for qid, values in baseline.items()])
+        db.execute("INSERT OR REPLACE INTO wm_host_baseline (host_id, impressions, days, last_day) VALUES (?, ?, ?, ?)",
+                   (host_id, host_impressions, host_days, rows[-1][0]))
+    save_host(host_id)
+    # Первый проход по хосту только набирает базу
+    return alerts if base_row else []
+
+
+@traced
+def check_position_alerts():
+    """Новые дни всех хостов → сообщения в ADMIN_IDS. Возвращает число алертов"""
+    db = positions_db()
+    settled = (datetime.now() - timedelta(days=WM_REFETCH_DAYS)).date().isoformat()
+    total = 0
+    for host_id, url in db.execute("""
+        SELECT c.host_id, COALESCE((SELECT url FROM wm_hosts h WHERE h.host_id = c.host_id LIMIT 1), c.host_id)
+        FROM wm_collected c
+    """).fetchall():
+        alerts = host_day_alerts(db, host_id, settled)
+        if not alerts:
+            continue
+        total += len(alerts)
+        more = f"\n…и ещё {len(alerts) - 10}" if len(alerts) > 10 else ""
+        text = f"<b>📉 {url.replace('https://', '').rstrip('/')}</b>\n" + "\n".join(alerts[:10]) + more
+        for admin_id in ADMIN_IDS:
+            send_tg(admin_id, text)
+    if total:
+        log("Position alerts sent", alerts=total)
+    return total
+
+
+@traced
+def get_positions(domain):
+    """Запросы хоста за последние 7 дней из локального хранилища"""
+    host_id = find_host_id(domain)
+    if not host_id:
         return None
+    collect_host(host_id)
     
-    results = []
-    for q in data.get("text_indicator_to_statistics", []):
-        query = q.get("text_indicator", {}).get("value", "")
-        stats = q.get("statistics", [])
-        clicks = sum(s["value"] for s in stats if s["field"] == "CLICKS")
-        shows = sum(s["value"] for s in stats if s["field"] == "IMPRESSIONS")
-        positions = [s["value"] for s in stats if s["field"] == "POSITION" and s["value"] > 0]
-        avg_pos = sum(positions) / len(positions) if positions else 0
-        if shows > 0:
-            results.append({"q": query, "p": avg_pos, "c": int(clicks), "s": int(shows)})
-    return sorted(results, key=lambda x: x["s"], reverse=True)
+    week_from = (datetime.now() - timedelta(days=7)).date().isoformat()
+    rows = positions_db().execute("""
+        SELECT q.text,
+               SUM(d.position * d.impressions) / NULLIF(SUM(CASE WHEN d.position > 0 THEN d.impressions END), 0),
+               SUM(d.clicks), SUM(d.impressions)
+        FROM wm_query_days d JOIN wm_queries q ON q.id = d.query_id
+        WHERE q.host_id = ? AND d.day >= ?
+        GROUP BY q.id
+        HAVING SUM(d.impressions) > 0
+        ORDER BY SUM(d.impressions) DESC
+    """, (host_id, week_from)).fetchall()
+    return [{"q": r[0], "p": r[1] or 0, "c": r[2], "s": r[3]} for r in rows]
+
+
+@traced
+def get_trends(domain, limit=10):
+    """Неделя к неделе по запросам хоста: позиция, её изменение, CTR"""
+    host_id = find_host_id(domain)
+    if not host_id:
+        return None
+    collect_host(host_id)
+    
+    today = datetime.now().date()
+    this_week = (today - timedelta(days=7)).isoformat()
+    prev_week = (today - timedelta(days=14)).isoformat()
+    rows = positions_db().execute("""
+        SELECT q.text,
+               SUM(CASE WHEN d.day >= :w1 THEN d.impressions END) AS s1,
+               SUM(CASE WHEN d.day >= :w1 THEN d.clicks END),
+               SUM(CASE WHEN d.day >= :w1 THEN d.position * d.impressions END)
+                 / NULLIF(SUM(CASE WHEN d.day >= :w1 AND d.position > 0 THEN d.impressions END), 0),
+               SUM(CASE WHEN d.day < :w1 THEN d.position * d.impressions END)
+                 / NULLIF(SUM(CASE WHEN d.day < :w1 AND d.position > 0 THEN d.impressions END), 0)
+        FROM wm_query_days d JOIN wm_queries q ON q.id = d.query_id
+        WHERE q.host_id = :host AND d.day >= :w0
+        GROUP BY q.id
+        HAVING s1 > 0
+        ORDER BY s1 DESC
+        LIMIT :limit
+    """, {"host": host_id, "w0": prev_week, "w1": this_week, "limit": limit}).fetchall()
+    return [
+        {"q": r[0], "s": r[1], "c": r[2] or 0, "p": r[3] or 0,
+         "delta": (r[3] - r[4]) if r[3] and r[4] else None,
+         "ctr": 100 * (r[2] or 0) / r[1]}
+        for r in rows
+    ]
+
+
+def stale_note(service, fetched):
+    """Пометка о давности данных, отданных во время сбоя сервиса"""
+    return f"⚠️ {service} недоступен — данные на {fetched}\n"
 
 
 def handle_status(chat_id):
-    report = get_report()
+    report, fetched_at = get_report()
     if not report:
-        send_tg(chat_id, "❌ Нет данных")
+        send_tg(chat_id, "❌ Нет данных" if _breakers["github"]["state"] == "closed" else "⚠️ GitHub недоступен, попробуй позже")
         return
-    msg = [f"<b>📊 {report.get('date', '?')}</b>\n"]
+    msg = [stale_note("GitHub", datetime.fromtimestamp(fetched_at).strftime("%d.%m %H:%M"))] if fetched_at else []
+    msg.append(f"<b>📊 {report.get('date', '?')}</b>\n")
     for domain, queries in list(report.get("sites", {}).items())[:7]:
         top = sorted(queries, key=lambda x: x.get("impressions", 0), reverse=True)[:1]
         if top:
@@ -292,10 +1003,13 @@ def handle_positions(chat_id, args):
         return
     domain = args[0].replace("https://", "").rstrip("/")
     positions = get_positions(domain)
+    if positions is None and _breakers["webmaster"]["state"] != "closed":
+        send_tg(chat_id, "⚠️ Webmaster недоступен, попробуй позже")
+        return
     if not positions:
         send_tg(chat_id, f"❌ {domain} не найден")
         return
-    msg = [f"<b>📈 {domain}</b>\n<pre>"]
+    msg = [positions_stale_note(domain) + f"<b>📈 {domain}</b>\n<pre>"]
     msg.append(f"{'Поз':>3} {'Кл':>3} {'Пок':>5}  Запрос")
     for q in positions[:10]:
         msg.append(f"{q['p']:>3.0f} {q['c']:>3} {q['s']:>5}  {q['q'][:20]}")
@@ -303,6 +1017,25 @@ def handle_positions(chat_id, args):
     send_tg(chat_id, "\n".join(msg))
 
 
+def handle_trend(chat_id, args):
+    if not args:
+        send_tg(chat_id, "❓ Укажи сайт:\n<code>/trend ant.partners</code>")
+        return
+    domain = args[0].replace("https://", "").rstrip("/")
+    trends = get_trends(domain)
+    if not trends:
+        send_tg(chat_id, f"❌ {domain}: нет данных")
+        return
+    msg = [positions_stale_note(domain) + f"<b>📉 {domain}: неделя к неделе</b>\n<pre>"]
+    msg.append(f"{'Поз':>3} {'Δ':>4} {'CTR':>4} {'Пок':>5}  Запрос")
+    for q in trends:
+        # Δ < 0 — позиция выросла (ближе к топу)
+        delta = f"{q['delta']:+4.0f}" if q["delta"] is not None else "   —"
+        msg.append(f"{q['p']:>3.0f} {delta} {q['ctr']:>3.0f}% {q['s']:>5}  {q['q'][:20]}")
+    msg.append("</pre>")
+    send_tg(chat_id, "\n".join(msg))
+
+
 def handle_slash_command(chat_id, user_id, text, msg=None):
     """Обработка стандартных /команд"""
     if str(user_id) not in ADMIN_IDS:
@@ -319,9 +1052,7 @@ def handle_slash_command(chat_id, user_id, text, msg=None):
     elif cmd == "/myid":
         # Команда для всех — узнать свой Telegram ID
         user_name = msg.get("from", {}).get("first_name", "User")
-        send_tg(chat_id, f"👤 {user_name}, твой Telegram ID: <code>{user_id}</code>
-
-Скопируй и отправь Кириллу для настройки бота.")
+        send_tg(chat_id, f"👤 {user_name}, твой Telegram ID: <code>{user_id}</code>\n\nСкопируй и отправь Кириллу для настройки бота.")
         return
     
     elif cmd in ["/start", "/help"]:
@@ -330,7 +1061,10 @@ def handle_slash_command(chat_id, user_id, text, msg=None):
 <b>Команды:</b>
 /status — данные позиций
 /positions [сайт] — детальные позиции
+/trend [сайт] — позиции неделя к неделе
 /sites — список сайтов
+/health — состояние внешних API
+/profile [N] — профиль следующих N апдейтов
 /ping — тест
 
 <b>Обращение:</b>
@@ -341,7 +1075,8 @@ def handle_slash_command(chat_id, user_id, text, msg=None):
 Также слежу за чатом и предложу создать задачу, если замечу планы 💡""")
     
     elif cmd == "/status":
-        handle_status(chat_id)
+        if admit("status", user_id, chat_id):
+            handle_status(chat_id)
     
     elif cmd == "/sites":
         hosts = get_hosts()
@@ -350,8 +1085,29 @@ def handle_slash_command(chat_id, user_id, text, msg=None):
             msg.append(f"• {url.replace('https://','').rstrip('/')}")
         send_tg(chat_id, "\n".join(msg))
     
+    elif cmd == "/health":
+        icons = {"closed": "🟢", "half-open": "🟡", "open": "🔴"}
+        msg = ["<b>🩺 Внешние API (инстанс):</b>\n"]
+        for name, b in _breakers.items():
+            msg.append(f"{icons[b['state']]} {name}: {b['state']}, ошибок подряд {b['failures']}, отклонено {b['rejected']}")
+        send_tg(chat_id, "\n".join(msg))
+    
+    elif cmd == "/profile":
+        updates = int(args[0]) if args and args[0].isdigit() else 20
+        if not updates:
+            send_tg(chat_id, "❓ /profile N — профилировать следующие N апдейтов")
+        elif start_profile(updates, chat_id, _log_state()["update_id"]):
+            send_tg(chat_id, f"🔬 Профилирую следующие {updates} апдейтов этого инстанса, итог пришлю сюда")
+        else:
+            send_tg(chat_id, "⏳ Профилирование уже идёт")
+    
     elif cmd == "/positions":
-        handle_positions(chat_id, args)
+        if admit("positions", user_id, chat_id):
+            handle_positions(chat_id, args)
+    
+    elif cmd == "/trend":
+        if admit("positions", user_id, chat_id):
+            handle_trend(chat_id, args)
     
     else:
         send_tg(chat_id, "❓ Неизвестная команда. /help")
@@ -366,14 +1122,27 @@ def handle_callback(callback):
     message_id = message.get("message_id")
     
     # Подтверждаем callback
-    http_request(f"https://api.telegram.org/bot{TG_TOKEN}/answerCallbackQuery",
+    http_request(f"{TG_API}/answerCallbackQuery",
                  {"callback_query_id": callback_id})
     
-    if data.startswith("create_task:"):
-        task_desc = data.replace("create_task:", "")
+    if data.startswith("create_task"):
+        if data.startswith("create_task:"):
+            # Кнопки старого формата с обрезанным описанием
+            task_desc = data.replace("create_task:", "")
+        else:
+            source_text = message.get("reply_to_message", {}).get("text", "")
+            task_desc = detect_task_intent(source_text)[1]
+        if not task_desc:
+            http_request(f"{TG_API}/editMessageText", {
+                "chat_id": chat_id,
+                "message_id": message_id,
+                "text": "⌛ Исходное сообщение недоступно — создай задачу через <code>Бот, создай задачу ...</code>",
+                "parse_mode": "HTML"
+            })
+            return
         # TODO: реальное создание в Asana
         # Редактируем сообщение
-        http_request(f"https://api.telegram.org/bot{TG_TOKEN}/editMessageText", {
+        http_request(f"{TG_API}/editMessageText", {
             "chat_id": chat_id,
             "message_id": message_id,
             "text": f"✅ Задача создана:\n<b>{task_desc}</b>\n\n<i>(интеграция с Asana в разработке)</i>",
@@ -381,59 +1150,274 @@ def handle_callback(callback):
         })
     
     elif data == "dismiss":
-        http_request(f"https://api.telegram.org/bot{TG_TOKEN}/deleteMessage", {
+        http_request(f"{TG_API}/deleteMessage", {
             "chat_id": chat_id,
             "message_id": message_id
         })
 
 
-# === MAIN HANDLER ===
+# === ПРОФИЛИРОВАНИЕ ПО ЗАПРОСУ ===
+# /profile N (админ) или GET ?profile=N с Authorization: Bearer CRON_SECRET — следующие
+# N апдейтов этого инстанса идут под сэмплирующим профилировщиком (поток раз в
+# PROFILE_INTERVAL снимает стеки всех потоков) и tracemalloc. Итог уходит админам,
+# стеки в folded-формате (flamegraph.pl, speedscope) — в PROFILE_FILE, их отдаёт
+# GET ?profile=raw. Инстансы Vercel независимы: профилируется тот, что принял
+# команду, и пока он жив. Если N апдейтов не набралось за PROFILE_MAX_SECONDS,
+# сэмплер сам останавливает сессию (и tracemalloc) и рассылает итог по тому, что
+# есть. Выключенное — одна проверка _profile на None на апдейт.
 
-class handler(BaseHTTPRequestHandler):
-    def do_POST(self):
+PROFILE_TOP = 10
+# Сэмплы, где поток ждёт в select() сервера/event loop или в очереди, — простой
+PROFILE_IDLE_FRAMES = ("selectors.py:", "threading.py:", "queue.py:", "thread.py:_worker")
+
+_profile = None  # активная сессия
+_profile_lock = threading.Lock()
+
+
+def sample_stacks(session):
+    """Цикл потока-сэмплера: стек (от корня) → число сэмплов в session["stacks"]"""
+    own = threading.get_ident()
+    stacks = session["stacks"]
+    while not session["stop"].wait(PROFILE_INTERVAL):
+        if time.monotonic() - session["started"] >= PROFILE_MAX_SECONDS:
+            if claim_profile(session):
+                begin_request()
+                finish_profile(session)
+                flush_logs()
+            return
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_qualname}")
+                frame = frame.f_back
+            if stack[0].startswith(PROFILE_IDLE_FRAMES):
+                continue
+            key = tuple(reversed(stack))
+            stacks[key] = stacks.get(key, 0) + 1
+
+
+def start_profile(updates, chat_id=None, command_update_id=None):
+    """Включить профилирование следующих updates апдейтов (False — уже идёт)"""
+    global _profile
+    with _profile_lock:
+        if _profile is not None:
+            return False
+        session = {
+            "limit": updates,
+            "updates": 0,
+            "chat_id": chat_id,
+            "command_update_id": command_update_id,
+            "stacks": {},
+            "stop": threading.Event(),
+            "started": time.monotonic(),
+            "own_tracemalloc": not tracemalloc.is_tracing(),
+        }
+        if session["own_tracemalloc"]:
+            tracemalloc.start()
+        session["thread"] = threading.Thread(target=sample_stacks, args=(session,), name="profiler", daemon=True)
+        session["thread"].start()
+        _profile = session
+    log("Profiling started", updates=updates)
+    return True
+
+
+def claim_profile(session):
+    """Снять сессию с инстанса; True — итог рассылает вызвавший (ровно один)"""
+    global _profile
+    with _profile_lock:
+        if _profile is not session:
+            return False
+        _profile = None
+        return True
+
+
+def count_profiled_update(update_id):
+    """Учесть апдейт; на последнем — остановить профилирование и разослать итог"""
+    global _profile
+    with _profile_lock:
+        session = _profile
+        if session is None or update_id == session["command_update_id"]:
+            return
+        session["updates"] += 1
+        if session["updates"] < session["limit"]:
+            return
+        _profile = None
+    finish_profile(session)
+
+
+def finish_profile(session):
+    session["stop"].set()
+    if session["thread"] is not threading.current_thread():
+        session["thread"].join()
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        *(tracemalloc.Filter(False, __file__, line)
+          for _, _, line in sample_stacks.__code__.co_lines() if line),
+    ])
+    _, peak = tracemalloc.get_traced_memory()
+    if session["own_tracemalloc"]:
+        tracemalloc.stop()
+    
+    stacks = session["stacks"]
+    try:
+        with open(PROFILE_FILE, "w", encoding="utf-8") as f:
+            for stack, count in sorted(stacks.items(), key=lambda item: -item[1]):
+                f.write(f"{';'.join(stack)} {count}\n")
+    except OSError as e:
+        log("Profile write error", error=str(e))
+    
+    text = render_profile(stacks, snapshot, peak, time.monotonic() - session["started"], session["updates"])
+    if session["updates"] < session["limit"]:
+        text += f"\n⏱ Остановлен по лимиту {PROFILE_MAX_SECONDS:.0f} с — апдейтов меньше {session['limit']}"
+    for chat_id in [session["chat_id"]] if session["chat_id"] else ADMIN_IDS:
+        send_tg(chat_id, text)
+    log("Profiling finished", updates=session["updates"], samples=sum(stacks.values()))
+
+
+def render_profile(stacks, snapshot, peak, elapsed, updates):
+    """Сводка: горячие функции по сэмплам и места выделения памяти"""
+    samples = sum(stacks.values())
+    own, inclusive = {}, {}
+    for stack, count in stacks.items():
+        own[stack[-1]] = own.get(stack[-1], 0) + count
+        for func in set(stack):
+            if func.startswith("webhook.py:"):
+                inclusive[func] = inclusive.get(func, 0) + count
+    
+    def top(counts):
+        ranked = sorted(counts.items(), key=lambda item: -item[1])[:PROFILE_TOP]
+        return [f"<code>{count / (samples or 1):6.1%}</code> {html.escape(func)}" for func, count in ranked]
+    
+    msg = [f"<b>🔬 Профиль инстанса за {elapsed:.1f} с</b>: апдейтов {updates}, сэмплов {samples}\n",
+           "<b>⏱ Собственное время:</b>", *top(own),
+           "\n<b>🌳 Функции вебхука с вложенными:</b>", *top(inclusive),
+           f"\n<b>🧠 Память за окно</b> (пик {peak / 1048576:.1f} MiB):"]
+    for stat in snapshot.statistics("lineno")[:PROFILE_TOP]:
+        frame = stat.traceback[0]
+        msg.append(f"<code>{stat.size / 1024:7.1f} KiB</code> {html.escape(os.path.basename(frame.filename))}:{frame.lineno} ({stat.count})")
+    msg.append("\nСтеки для flamegraph: GET ?profile=raw")
+    return "\n".join(msg)
+
+
+def authorized(header):
+    """Служебные GET (Vercel Cron, профилирование) — по Authorization: Bearer CRON_SECRET"""
+    return bool(CRON_SECRET) and header == f"Bearer {CRON_SECRET}"
+
+
+def profile_request(value, authorization):
+    """GET ?profile=N | raw → (HTTP-статус, тело ответа)"""
+    if not authorized(authorization):
+        return 403, b""
+    if value == "raw":
         try:
-            length = int(self.headers.get("Content-Length", 0))
-            body = json.loads(self.rfile.read(length))
-            
-            # Callback query (inline кнопки)
-            if "callback_query" in body:
-                handle_callback(body["callback_query"])
-            
-            # Обычное сообщение
-            elif "message" in body:
-                msg = body["message"]
-                chat_id = msg.get("chat", {}).get("id")
-                user_id = msg.get("from", {}).get("id")
-                text = msg.get("text", "")
-                
-                if not chat_id or not text:
-                    pass
-                
-                # 1. Слэш-команды
-                elif text.startswith("/"):
-                    handle_slash_command(chat_id, user_id, text, msg)
-                
-                # 2. Прямое обращение к боту ("Бот, ...", @mention, reply)
-                elif is_bot_trigger(text, msg):
-                    if str(user_id) in TEAM_IDS:
-                        handle_bot_command(chat_id, user_id, text, msg)
-                    else:
-                        log(f"Non-team user {user_id} tried to use bot")
-                
-                # 3. Пассивный мониторинг (без ответа, но может предложить)
+            with open(PROFILE_FILE, "rb") as f:
+                return 200, f.read()
+        except FileNotFoundError:
+            return 404, b"no profile on this instance"
+    if not value.isdigit() or not int(value):
+        return 400, b"profile=N (next N updates) or profile=raw"
+    if not start_profile(int(value)):
+        return 409, b"already profiling"
+    return 200, f"profiling next {value} updates (at most {PROFILE_MAX_SECONDS:.0f} s)".encode()
+
+
+# === MAIN HANDLER ===
+
+def process_update(body):
+    """Разобрать апдейт Telegram и вызвать обработчик (общий для handler и api/asgi.py)"""
+    try:
+        # Callback query (inline кнопки)
+        if "callback_query" in body:
+            handle_callback(body["callback_query"])
+        
+        # Обычное сообщение
+        elif "message" in body:
+            msg = body["message"]
+            chat_id = msg.get("chat", {}).get("id")
+            user_id = msg.get("from", {}).get("id")
+            text = msg.get("text", "")
+        
+            if not chat_id or not text:
+                pass
+        
+            # 1. Слэш-команды
+            elif text.startswith("/"):
+                handle_slash_command(chat_id, user_id, text, msg)
+        
+            # 2. Прямое обращение к боту ("Бот, ...", @mention, reply)
+            elif is_bot_trigger(text, msg):
+                if str(user_id) in TEAM_IDS:
+                    handle_bot_command(chat_id, user_id, text, msg)
                 else:
-                    handle_passive_monitoring(chat_id, user_id, text, msg)
+                    log("Non-team user tried to use bot", user_id=user_id)
         
-        except Exception as e:
-            log(f"Error: {e}")
-            import traceback
-            traceback.print_exc()
+            # 3. Пассивный мониторинг (без ответа, но может предложить)
+            else:
+                handle_passive_monitoring(chat_id, user_id, text, msg)
+
+    finally:
+        if _profile is not None:
+            count_profiled_update(body.get("update_id"))
+
+def log_error(e):
+    import traceback  # только на пути ошибки — не платим при холодном старте
+    log("Error", error=str(e), traceback=traceback.format_exc())
+
+
+class handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        begin_request()
+        with span("update", SPAN_KIND_SERVER, root=True) as root:
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length))
+                begin_request(body.get("update_id"))
+                root["update_id"] = body.get("update_id")
+                process_update(body)
+            except Exception as e:
+                log_error(e)
+                root["error"] = e
         
         self.send_response(200)
         self.end_headers()
         self.wfile.write(b"ok")
+        self.wfile.flush()
+        flush_logs()
+        flush_trace()
     
     def do_GET(self):
+        # Профилирование: GET /api/webhook?profile=N | raw (Authorization: Bearer CRON_SECRET)
+        profile = parse_qs(urlsplit(self.path).query).get("profile")
+        if profile:
+            status, body = profile_request(profile[0], self.headers.get("Authorization"))
+            self.send_response(status)
+            self.end_headers()
+            self.wfile.write(body)
+            self.wfile.flush()
+            flush_logs()
+            return
+        
+        # Плановый сбор позиций: GET /api/webhook?collect=positions (Vercel Cron)
+        if "collect=positions" in self.path:
+            if not authorized(self.headers.get("Authorization")):
+                self.send_response(403)
+                self.end_headers()
+                return
+            begin_request()
+            with span("collect positions", SPAN_KIND_SERVER, root=True):
+                total = collect_all_hosts()
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(f"collected {total}".encode())
+            self.wfile.flush()
+            flush_logs()
+            flush_trace()
+            return
+        
         self.send_response(200)
         self.end_headers()
         self.wfile.write(b"Artvision Bot v5 - Smart Mode")
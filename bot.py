@@ -5,27 +5,53 @@ Artvision Task Manager Bot
 """
 
 import os
+import io
+import math
+import functools
+import asyncio
+import csv
+import gzip
+import hashlib
+import hmac
+import re
 import json
+import heapq
+import queue
+import atexit
 import logging
+import logging.handlers
 import sqlite3
+import secrets
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import multiprocessing
+from collections import Counter, OrderedDict
+from contextlib import AsyncExitStack, ExitStack, asynccontextmanager, contextmanager
+from contextvars import ContextVar
 from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
 from zoneinfo import ZoneInfo
 from pathlib import Path
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, 
-    CallbackQueryHandler, filters, ContextTypes
+    CallbackQueryHandler, filters, ContextTypes, BaseUpdateProcessor
 )
-import openai
-import requests
+from telegram.helpers import escape_markdown
+from telegram.request import HTTPXRequest
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Настройка логирования (см. setup_logging)
 logger = logging.getLogger(__name__)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_DIR = Path(os.getenv("LOG_DIR", "logs"))  # в Docker — том ./logs:/app/logs
+LOG_FILE_MAX_BYTES = 10 * 1024 * 1024
+LOG_FILE_BACKUPS = 5
 
 # Конфигурация
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -36,17 +62,318 @@ ASANA_WORKSPACE = os.getenv("ASANA_WORKSPACE", "860693669973770")
 ADMIN_IDS = [int(x) for x in os.getenv("ADMIN_IDS", "161261652").split(",")]
 MOSCOW_TZ = ZoneInfo("Europe/Moscow")
 
+# Сколько апдейтов обрабатывается одновременно (внутри пользователя/чата — по очереди)
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "16"))
+
+# Кластерный режим: число процессов-воркеров (1 — обычный запуск в одном процессе)
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+
+# Допуск дорогих операций: "ёмкость/период_сек" на пользователя и на весь бот
+ADMISSION_LIMITS = {
+    "voice": (os.getenv("ADMISSION_VOICE_USER", "3/300"), os.getenv("ADMISSION_VOICE_GLOBAL", "30/300")),
+    "asana": (os.getenv("ADMISSION_ASANA_USER", "10/60"), os.getenv("ADMISSION_ASANA_GLOBAL", "60/60")),
+}
+
+# Синхронизация времени с Asana
+ASANA_SYNC_INTERVAL = int(os.getenv("ASANA_SYNC_INTERVAL", "300"))  # сек между запусками
+ASANA_SYNC_MAX_PER_RUN = int(os.getenv("ASANA_SYNC_MAX_PER_RUN", "100"))  # сессий за запуск
+
+# Длинные голосовые режутся по паузам на куски ~VOICE_SEGMENT_SECONDS сек,
+# до VOICE_SEGMENT_CONCURRENCY кусков распознаются параллельно
+VOICE_SEGMENT_SECONDS = int(os.getenv("VOICE_SEGMENT_SECONDS", "60"))
+VOICE_SEGMENT_CONCURRENCY = int(os.getenv("VOICE_SEGMENT_CONCURRENCY", "4"))
+
+# Предохранители внешних API: ошибок подряд до размыкания, сек до пробного запроса
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "3"))
+BREAKER_RESET = float(os.getenv("BREAKER_RESET", "30"))
+
+# Профилирование по /profile: шаг сэмплирования стеков (сек) и предельная длина окна
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "600"))
+
+# Локальный индекс задач Asana (сек между инкрементальными обновлениями)
+TASK_INDEX_INTERVAL = int(os.getenv("TASK_INDEX_INTERVAL", "900"))
+
+# Вебхуки Asana: порт приёмника в процессе бота (0 — выключен) и публичный HTTPS-адрес,
+# по которому его вызывает Asana (reverse proxy → порт). Пока события доходят,
+# GET-ответы по задачам проекта отдаются из кэша до ASANA_CACHE_TTL сек
+ASANA_WEBHOOK_PORT = int(os.getenv("ASANA_WEBHOOK_PORT", "0"))
+ASANA_WEBHOOK_URL = os.getenv("ASANA_WEBHOOK_URL", "")
+ASANA_CACHE_TTL = int(os.getenv("ASANA_CACHE_TTL", "3600"))
+
+# Забытые сессии: напоминание и автостоп (минуты от начала, 0 — выключено)
+SESSION_REMIND_MINUTES = int(os.getenv("SESSION_REMIND_MINUTES", "240"))
+SESSION_AUTOSTOP_MINUTES = int(os.getenv("SESSION_AUTOSTOP_MINUTES", "600"))
+
 # База данных
 DB_PATH = Path("/data/timetracker.db") if os.path.exists("/data") else Path("timetracker.db")
+ARCHIVE_DB_PATH = DB_PATH.with_name("timetracker_archive.db")
 
-# Команда участников
+# Хранение: закрытые сессии старше RETENTION_DAYS уезжают в архив (0 — не архивировать)
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "180"))
+
+# Колоночный снимок сессий для /analytics: сек между дописываниями
+SNAPSHOT_INTERVAL = int(os.getenv("SNAPSHOT_INTERVAL", "3600"))
+
+# Команда участников; spoken — как имя пишет Whisper в русской речи (без «Миг»:
+# это обычное слово)
 TEAM = {
-    "@antonkamer": {"name": "Anton", "asana_gid": "860693669618957"},
-    "@PandaCaffe": {"name": "Andrey", "asana_gid": None},
+    "@antonkamer": {"name": "Anton", "asana_gid": "860693669618957", "spoken": ("Антон",)},
+    "@PandaCaffe": {"name": "Andrey", "asana_gid": None, "spoken": ("Андрей",)},
     "@mig555555": {"name": "Mig", "asana_gid": None},
-    "@akpersik": {"name": "Akpersik", "asana_gid": None},
+    "@akpersik": {"name": "Akpersik", "asana_gid": None, "spoken": ("Акперсик",)},
 }
 
+# ═══════════════════════════════════════════════════════════════
+# ЛОГИРОВАНИЕ
+# ═══════════════════════════════════════════════════════════════
+
+# Обработчики только кладут запись в очередь; форматирование в JSON и запись в
+# stderr/файл идут в отдельном потоке QueueListener и не тормозят event loop.
+# Каждой записи внутри обработки апдейта проставляется update_id, а стоимость
+# логирования (записей и мкс в emit) считается по апдейту — см. PerUserUpdateProcessor.
+
+current_update_id: ContextVar[int | None] = ContextVar("current_update_id", default=None)
+current_log_cost: ContextVar[list | None] = ContextVar("current_log_cost", default=None)
+_log_listener = None
+
+_LOG_RECORD_FIELDS = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime"}
+
+class JsonFormatter(logging.Formatter):
+    """Одна строка JSON на запись; поля из extra=... попадают в объект как есть"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.processName,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _LOG_RECORD_FIELDS and not key.startswith("_"):
+                data[key] = value
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+class MeteredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который помечает запись update_id и считает свою стоимость"""
+    
+    def emit(self, record: logging.LogRecord):
+        started = time.perf_counter()
+        update_id = current_update_id.get()
+        if update_id is not None:
+            record.update_id = update_id
+        super().emit(record)
+        cost = current_log_cost.get()
+        if cost is not None:
+            cost[0] += 1
+            cost[1] += time.perf_counter() - started
+
+def setup_logging(file_name: str = "bot.log"):
+    """Очередь + JSON в stderr и (если есть каталог LOG_DIR) в ротируемый файл
+    
+    Вызывается в каждом процессе отдельно: поток слушателя не переживает fork.
+    """
+    global _log_listener
+    stop_logging()
+    
+    formatter = JsonFormatter()
+    handlers = [logging.StreamHandler()]
+    if LOG_DIR.is_dir():
+        handlers.append(logging.handlers.RotatingFileHandler(
+            LOG_DIR / file_name, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUPS, encoding="utf-8"
+        ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers = [MeteredQueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+    # httpx пишет INFO на каждый запрос к Telegram — это шум, а не события
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    
+    _log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(stop_logging)
+
+def stop_logging():
+    """Дописать очередь логов и остановить поток слушателя"""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+# ═══════════════════════════════════════════════════════════════
+# ТРАССИРОВКА
+# ═══════════════════════════════════════════════════════════════
+
+# Один корневой спан на апдейт (PerUserUpdateProcessor), дочерние — вокруг
+# запросов к Asana, Telegram, Whisper и хелперов базы. Завершённая трасса
+# целиком уходит одной строкой OTLP/JSON (как у OpenTelemetry-экспортёра в файл)
+# в LOG_DIR/traces*.jsonl — по ней офлайн восстанавливается критический путь
+# медленного апдейта. Вне апдейта (плановые задачи) спаны не пишутся.
+
+TRACING = os.getenv("TRACING", "1") == "1"
+TRACE_SERVICE = "artvision-bot"
+
+SPAN_KIND_INTERNAL, SPAN_KIND_SERVER, SPAN_KIND_CLIENT = 1, 2, 3
+
+current_span: ContextVar["Span | None"] = ContextVar("current_span", default=None)
+trace_logger = logging.getLogger("artvision.trace")
+_trace_listener = None
+
+class Span:
+    """Спан трассы; finished — общий для всей трассы список завершённых спанов"""
+    
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind", "attrs", "error", "start_ns", "end_ns", "finished")
+    
+    def __init__(self, name: str, kind: int, attrs: dict, parent: "Span | None"):
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else ""
+        self.finished = parent.finished if parent else []
+        self.name = name
+        self.kind = kind
+        self.attrs = attrs
+        self.error = None
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+    
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+    
+    def fail(self, error):
+        self.error = str(error)[:300]
+    
+    def to_otlp(self) -> dict:
+        status = {"code": 2, "message": self.error} if self.error else {"code": 1}
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": k, "value": otlp_value(v)} for k, v in self.attrs.items() if v is not None],
+            "status": status,
+        }
+
+class _NoopSpan:
+    """Заглушка, когда трассировка выключена или нет текущей трассы"""
+    
+    def set(self, **attrs):
+        pass
+    
+    def fail(self, error):
+        pass
+
+NOOP_SPAN = _NoopSpan()
+
+def otlp_value(value) -> dict:
+    """Значение атрибута в формате OTLP/JSON (int64 — строкой)"""
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+@functools.cache
+def _otlp_resource() -> dict:
+    return {"attributes": [
+        {"key": "service.name", "value": {"stringValue": TRACE_SERVICE}},
+        {"key": "process.pid", "value": {"intValue": str(os.getpid())}},
+    ]}
+
+def export_trace(spans: list):
+    """Завершённая трасса → одна строка OTLP/JSON (resourceSpans) в очередь записи"""
+    trace_logger.info(json.dumps({"resourceSpans": [{
+        "resource": _otlp_resource(),
+        "scopeSpans": [{"scope": {"name": "artvision.bot"}, "spans": [s.to_otlp() for s in spans]}],
+    }]}, ensure_ascii=False, default=str))
+
+@contextmanager
+def span(name: str, kind: int = SPAN_KIND_INTERNAL, root: bool = False, **attrs):
+    """Спан вокруг блока; root=True открывает новую трассу
+    
+    Дочерний спан вне трассы ничего не стоит — отдаётся NOOP_SPAN.
+    Исключение из блока помечает спан ошибкой и пробрасывается дальше.
+    """
+    parent = current_span.get()
+    if _trace_listener is None or (parent is None and not root):
+        yield NOOP_SPAN
+        return
+    
+    sp = Span(name, kind, attrs, None if root else parent)
+    token = current_span.set(sp)
+    try:
+        yield sp
+    except BaseException as e:
+        sp.fail(e)
+        raise
+    finally:
+        current_span.reset(token)
+        sp.end_ns = time.time_ns()
+        sp.finished.append(sp)
+        if not sp.parent_id:
+            export_trace(sp.finished)
+
+def traced(prefix: str):
+    """Декоратор синхронной функции: спан "<prefix>.<имя функции>" внутри трассы"""
+    def decorator(func):
+        name = f"{prefix}.{func.__name__}"
+    
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if current_span.get() is None:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class TracedHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest со спаном на каждый вызов Bot API (в имени — только метод, без токена)"""
+    
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        with span(f"telegram {url.rsplit('/', 1)[-1]}", SPAN_KIND_CLIENT) as sp:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            sp.set(**{"http.status_code": code})
+            return code, payload
+
+def setup_tracing(file_name: str = "traces.jsonl"):
+    """Запись трасс в ротируемый файл в LOG_DIR (через отдельную очередь и поток)
+    
+    Без каталога LOG_DIR или при TRACING=0 трассировка выключена, span() — no-op.
+    """
+    global _trace_listener
+    stop_tracing()
+    if not TRACING or not LOG_DIR.is_dir():
+        return
+    
+    handler = logging.handlers.RotatingFileHandler(
+        LOG_DIR / file_name, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUPS, encoding="utf-8"
+    )
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    trace_queue = queue.SimpleQueue()
+    trace_logger.handlers = [logging.handlers.QueueHandler(trace_queue)]
+    trace_logger.setLevel(logging.INFO)
+    trace_logger.propagate = False
+    
+    _trace_listener = logging.handlers.QueueListener(trace_queue, handler)
+    _trace_listener.start()
+    atexit.register(stop_tracing)
+
+def stop_tracing():
+    """Дописать очередь трасс и остановить поток записи"""
+    global _trace_listener
+    if _trace_listener is not None:
+        _trace_listener.stop()
+        _trace_listener = None
+
 # ═══════════════════════════════════════════════════════════════
 # БАЗА ДАННЫХ (SQLite)
 # ═══════════════════════════════════════════════════════════════
@@ -56,6 +383,11 @@ def init_db():
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
     
+    # Для новой базы — до создания таблиц; старые переводятся в maintain_db
+    c.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    # WAL: чтения не блокируются записью, несколько процессов-воркеров работают с одной базой
+    c.execute('PRAGMA journal_mode=WAL')
+    
     # Таблица сессий трекинга
     c.execute('''
         CREATE TABLE IF NOT EXISTS time_sessions (
@@ -71,14 +403,82 @@ def init_db():
         )
     ''')
     
+    # Агрегаты архивированных сессий: командный отчёт по старым периодам без чтения архива
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS time_rollups (
+            day TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            username TEXT,
+            task_name TEXT NOT NULL DEFAULT '',
+            minutes INTEGER NOT NULL,
+            sessions INTEGER NOT NULL,
+            PRIMARY KEY (day, user_id, task_name)
+        )
+    ''')
+    
+    # Данные inline-кнопок: в callback_data уходит только короткий токен
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS callback_payloads (
+            token TEXT PRIMARY KEY,
+            payload TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_callback_expires ON callback_payloads(expires_at)')
+    
+    # Локальный полнотекстовый индекс задач Asana (rowid FTS-таблиц = asana_tasks.id)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS asana_tasks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            gid TEXT NOT NULL UNIQUE,
+            name TEXT NOT NULL,
+            completed INTEGER NOT NULL DEFAULT 0,
+            modified_at TEXT
+        )
+    ''')
+    c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS asana_tasks_fts USING fts5(stems, tokenize='unicode61 remove_diacritics 2')")
+    c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS asana_tasks_trgm USING fts5(name, tokenize='trigram')")
+    
+    # Служебные отметки (водяные знаки синхронизаций)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS sync_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+    
+    # Миграции: колонки, добавленные после первой версии схемы
+    ensure_column(c, "time_sessions", "asana_synced_at", "TIMESTAMP")
+    ensure_column(c, "time_sessions", "asana_sync_error", "TEXT")
+    
     # Индексы
     c.execute('CREATE INDEX IF NOT EXISTS idx_user_id ON time_sessions(user_id)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_started_at ON time_sessions(started_at)')
+    # Открытые сессии: активная сессия пользователя и восстановление дедлайнов при старте
+    c.execute('CREATE INDEX IF NOT EXISTS idx_open_sessions ON time_sessions(user_id) WHERE ended_at IS NULL')
+    # Покрывающий индекс для командного отчёта: диапазон по started_at без чтения таблицы
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_closed_report
+        ON time_sessions(started_at, user_id, username, task_name, duration_minutes)
+        WHERE ended_at IS NOT NULL
+    ''')
+    # Очередь синхронизации с Asana: только завершённые и ещё не отправленные
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_asana_unsynced ON time_sessions(id)
+        WHERE ended_at IS NOT NULL AND asana_task_id IS NOT NULL AND asana_synced_at IS NULL
+    ''')
     
     conn.commit()
     conn.close()
     logger.info(f"✅ БД инициализирована: {DB_PATH}")
 
+def ensure_column(c, table: str, column: str, decl: str):
+    """Добавить колонку, если её ещё нет (для старых баз)"""
+    columns = {row[1] for row in c.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+@traced("db")
 def get_active_session(user_id: int) -> dict | None:
     """Получить активную сессию пользователя"""
     conn = sqlite3.connect(DB_PATH)
@@ -101,6 +501,7 @@ def get_active_session(user_id: int) -> dict | None:
         }
     return None
 
+@traced("db")
 def start_session(user_id: int, username: str, task_name: str, asana_task_id: str = None) -> int:
     """Начать новую сессию"""
     conn = sqlite3.connect(DB_PATH)
@@ -114,16 +515,23 @@ def start_session(user_id: int, username: str, task_name: str, asana_task_id: st
     conn.close()
     return session_id
 
-def stop_session(user_id: int, notes: str = None) -> dict | None:
-    """Остановить активную сессию"""
+@traced("db")
+def stop_session(user_id: int, notes: str = None, ended_at: datetime = None) -> dict | None:
+    """Остановить активную сессию
+    
+    ended_at — явное время окончания (автостоп закрывает сессию по дедлайну,
+    а не по моменту, когда бот до неё добрался).
+    """
     session = get_active_session(user_id)
     if not session:
         return None
     
-    ended_at = datetime.now(MOSCOW_TZ)
     started_at = session["started_at"]
     if started_at.tzinfo is None:
         started_at = started_at.replace(tzinfo=MOSCOW_TZ)
+    if ended_at is None:
+        ended_at = datetime.now(MOSCOW_TZ)
+    ended_at = max(ended_at, started_at)
     
     duration = int((ended_at - started_at).total_seconds() / 60)
     
@@ -137,6 +545,8 @@ def stop_session(user_id: int, notes: str = None) -> dict | None:
     conn.commit()
     conn.close()
     
+    invalidate_team_report(started_at.date().isoformat())
+    
     return {
         "task_name": session["task_name"],
         "duration_minutes": duration,
@@ -144,6 +554,28 @@ def stop_session(user_id: int, notes: str = None) -> dict | None:
         "ended_at": ended_at
     }
 
+@traced("db")
+def get_open_sessions() -> list:
+    """Все незавершённые сессии (по частичному индексу idx_open_sessions)"""
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute('''
+        SELECT id, user_id, started_at
+        FROM time_sessions
+        WHERE ended_at IS NULL AND user_id IS NOT NULL
+    ''')
+    rows = c.fetchall()
+    conn.close()
+    
+    sessions = []
+    for row in rows:
+        started_at = datetime.fromisoformat(row[2])
+        if started_at.tzinfo is None:
+            started_at = started_at.replace(tzinfo=MOSCOW_TZ)
+        sessions.append({"id": row[0], "user_id": row[1], "started_at": started_at})
+    return sessions
+
+@traced("db")
 def get_today_stats(user_id: int) -> dict:
     """Статистика за сегодня"""
     today = datetime.now(MOSCOW_TZ).date().isoformat()
@@ -179,6 +611,7 @@ def get_today_stats(user_id: int) -> dict:
         "tasks": [(t[0], t[1]) for t in tasks]
     }
 
+@traced("db")
 def get_week_stats(user_id: int) -> dict:
     """Статистика за неделю"""
     week_ago = (datetime.now(MOSCOW_TZ) - timedelta(days=7)).date().isoformat()
@@ -209,31 +642,823 @@ def get_week_stats(user_id: int) -> dict:
         "days": [(d[0], d[1]) for d in days]
     }
 
+@traced("db")
+def get_team_stats(date_from: str, date_to: str) -> list:
+    """Статистика команды за период [date_from, date_to] одним запросом
+    
+    Строки сгруппированы по (пользователь, день, задача); итоги считаются
+    оконными функциями в том же проходе. День — локальная (МСК) дата из
+    started_at, как и границы периода. Архивированные периоды берутся из
+    агрегатов time_rollups.
+    """
+    day_after = (datetime.fromisoformat(date_to) + timedelta(days=1)).date().isoformat()
+    
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute('''
+        WITH base AS (
+            SELECT user_id, username, substr(started_at, 1, 10) AS day,
+                   task_name, duration_minutes AS minutes
+            FROM time_sessions
+            WHERE started_at >= ? AND started_at < ? AND ended_at IS NOT NULL
+            UNION ALL
+            SELECT user_id, username, day, NULLIF(task_name, ''), minutes
+            FROM time_rollups
+            WHERE day >= ? AND day < ?
+        )
+        SELECT user_id, MAX(username), day, task_name,
+               SUM(minutes) AS minutes,
+               SUM(SUM(minutes)) OVER (PARTITION BY user_id, day) AS day_total,
+               SUM(SUM(minutes)) OVER (PARTITION BY user_id) AS user_total,
+               SUM(SUM(minutes)) OVER () AS team_total
+        FROM base
+        GROUP BY user_id, day, task_name
+        ORDER BY user_total DESC, user_id, day, minutes DESC
+    ''', (date_from, day_after, date_from, day_after))
+    rows = c.fetchall()
+    conn.close()
+    
+    return [
+        {
+            "user_id": r[0], "username": r[1], "day": r[2], "task_name": r[3],
+            "minutes": r[4] or 0, "day_total": r[5] or 0,
+            "user_total": r[6] or 0, "team_total": r[7] or 0,
+        }
+        for r in rows
+    ]
+
 # ═══════════════════════════════════════════════════════════════
-# ASANA API
+# ДАННЫЕ INLINE-КНОПОК
 # ═══════════════════════════════════════════════════════════════
 
-def asana_request(method: str, endpoint: str, data: dict = None) -> dict:
-    """Запрос к Asana API"""
-    headers = {
-        "Authorization": f"Bearer {ASANA_TOKEN}",
-        "Content-Type": "application/json"
-    }
-    url = f"https://app.asana.com/api/1.0{endpoint}"
+# callback_data ограничен 64 байтами (кириллица — 2 байта на символ), поэтому
+# кнопки несут токен, а полные данные (gid, название, расшифровка) лежат здесь:
+# LRU в памяти поверх таблицы callback_payloads, записи живут CALLBACK_TTL.
+CALLBACK_TTL = 7 * 24 * 3600
+CALLBACK_TOKEN_RE = re.compile(r"[A-Za-z0-9_-]{11}")  # secrets.token_urlsafe(8)
+CALLBACK_CACHE_SIZE = 1024
+_callback_cache: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+
+def _remember_callback(token: str, expires_at: float, payload: dict):
+    _callback_cache[token] = (expires_at, payload)
+    _callback_cache.move_to_end(token)
+    if len(_callback_cache) > CALLBACK_CACHE_SIZE:
+        _callback_cache.popitem(last=False)
+
+@traced("db")
+def put_callback_payload(payload: dict) -> str:
+    """Сохранить данные кнопки, вернуть короткий токен для callback_data"""
+    token = secrets.token_urlsafe(8)
+    expires_at = time.time() + CALLBACK_TTL
+    
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute(
+        'INSERT OR REPLACE INTO callback_payloads (token, payload, expires_at) VALUES (?, ?, ?)',
+        (token, json.dumps(payload, ensure_ascii=False), expires_at)
+    )
+    conn.commit()
+    conn.close()
+    
+    _remember_callback(token, expires_at, payload)
+    return token
+
+@traced("db")
+def take_callback_payload(token: str) -> dict | None:
+    """Данные одноразовой кнопки: забрать и удалить (повторное нажатие — None)
+    
+    Удаление строки атомарно, поэтому из двух нажатий — и в разных воркерах —
+    данные получает ровно одно.
+    """
+    payload = get_callback_payload(token)
+    _callback_cache.pop(token, None)
+    
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute('DELETE FROM callback_payloads WHERE token = ?', (token,))
+    deleted = c.rowcount
+    conn.commit()
+    conn.close()
     
+    return payload if deleted else None
+
+@traced("db")
+def get_callback_payload(token: str) -> dict | None:
+    """Данные кнопки по токену или None, если истекли / не найдены"""
+    now = time.time()
+    cached = _callback_cache.get(token)
+    if cached:
+        expires_at, payload = cached
+        if expires_at > now:
+            _callback_cache.move_to_end(token)
+            return payload
+        del _callback_cache[token]
+        return None
+    
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute('SELECT payload, expires_at FROM callback_payloads WHERE token = ?', (token,))
+    row = c.fetchone()
+    conn.close()
+    
+    if not row or row[1] <= now:
+        return None
+    payload = json.loads(row[0])
+    _remember_callback(token, row[1], payload)
+    return payload
+
+async def purge_callback_payloads(context: ContextTypes.DEFAULT_TYPE):
+    """Удалить истёкшие данные кнопок"""
+    now = time.time()
+    for token in [t for t, (expires_at, _) in _callback_cache.items() if expires_at <= now]:
+        del _callback_cache[token]
+    
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute('DELETE FROM callback_payloads WHERE expires_at <= ?', (now,))
+    conn.commit()
+    conn.close()
+
+# ═══════════════════════════════════════════════════════════════
+# ХРАНЕНИЕ: АРХИВ И ОБСЛУЖИВАНИЕ БАЗЫ
+# ═══════════════════════════════════════════════════════════════
+
+# Закрытые (и уже отправленные в Asana) сессии старше RETENTION_DAYS переносятся
+# в отдельный файл ARCHIVE_DB_PATH, по таблице на месяц (sessions_YYYY_MM), а их
+# агрегаты по (день, пользователь, задача) остаются в time_rollups. Горячая
+# таблица и её индексы не растут со временем; /export читает архив через
+# временное представление all_sessions.
+
+ARCHIVE_TABLE_RE = re.compile(r"^sessions_\d{4}_\d{2}$")
+
+def session_columns(c, schema: str = "main", table: str = "time_sessions") -> list:
+    return [row[1] for row in c.execute(f"PRAGMA {schema}.table_info({table})")]
+
+def connect_with_archive() -> sqlite3.Connection:
+    """Соединение с представлением all_sessions = горячая таблица + все архивные месяцы
+    
+    Архивные таблицы созданы схемой своего месяца: колонок, добавленных позже
+    (ensure_column), в них нет — они читаются как NULL. Строки, которые ещё
+    лежат и в горячей таблице (перенос прервался между транзакциями), берутся
+    только оттуда.
+    """
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    columns = session_columns(c)
+    parts = [f"SELECT {', '.join(columns)} FROM main.time_sessions"]
+    if ARCHIVE_DB_PATH.exists():
+        c.execute("ATTACH DATABASE ? AS archive", (str(ARCHIVE_DB_PATH),))
+        tables = [row[0] for row in c.execute("SELECT name FROM archive.sqlite_master WHERE type = 'table'")]
+        for t in sorted(tables):
+            if not ARCHIVE_TABLE_RE.match(t):
+                continue
+            present = set(session_columns(c, "archive", t))
+            select = ", ".join(col if col in present else f"NULL AS {col}" for col in columns)
+            parts.append(f"SELECT {select} FROM archive.{t} WHERE id NOT IN (SELECT id FROM main.time_sessions)")
+    c.execute(f"CREATE TEMP VIEW all_sessions AS {' UNION ALL '.join(parts)}")
+    return conn
+
+@traced("db")
+def archive_old_sessions(retention_days: int = RETENTION_DAYS) -> int:
+    """Перенести старые закрытые сессии в архив помесячно, вернуть число строк
+    
+    В WAL-режиме коммит, затрагивающий две базы, атомарен для каждой по
+    отдельности, но не для обеих вместе. Поэтому месяц переносится двумя
+    транзакциями: сначала копия в архив (INSERT OR IGNORE по id, идемпотентно),
+    потом агрегаты и удаление из горячей таблицы — обе в одной базе. Сбой
+    между ними оставляет строки в обеих базах; all_sessions берёт их из
+    горячей таблицы, а следующий запуск доводит перенос до конца.
+    """
+    if retention_days <= 0:
+        return 0
+    cutoff = (datetime.now(MOSCOW_TZ) - timedelta(days=retention_days)).date().isoformat()
+    archivable = '''
+        ended_at IS NOT NULL AND started_at >= ? AND started_at < ?
+        AND (asana_task_id IS NULL OR asana_synced_at IS NOT NULL)
+    '''
+    
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute("ATTACH DATABASE ? AS archive", (str(ARCHIVE_DB_PATH),))
+    column_types = {row[1]: row[2] for row in c.execute("PRAGMA main.table_info(time_sessions)")}
+    columns = list(column_types)
+    column_list = ", ".join(columns)
+    column_defs = ", ".join("id INTEGER PRIMARY KEY" if col == "id" else col for col in columns)
+    months = [row[0] for row in c.execute(
+        "SELECT DISTINCT substr(started_at, 1, 7) FROM time_sessions WHERE ended_at IS NOT NULL AND started_at < ?",
+        (cutoff,)
+    )]
+    
+    moved = 0
+    for month in months:
+        table = f"sessions_{month.replace('-', '_')}"
+        month_start = f"{month}-01"
+        next_month = (datetime.fromisoformat(month_start) + timedelta(days=32)).strftime("%Y-%m-01")
+        bounds = (month_start, min(next_month, cutoff))
+        
+        c.execute(f"CREATE TABLE IF NOT EXISTS archive.{table} ({column_defs})")
+        c.execute(f"CREATE INDEX IF NOT EXISTS archive.idx_{table}_started ON {table}(started_at)")
+        # Месяц мог начать архивироваться до миграции горячей таблицы
+        present = set(session_columns(c, "archive", table))
+        for col in columns:
+            if col not in present:
+                c.execute(f"ALTER TABLE archive.{table} ADD COLUMN {col} {column_types[col]}")
+        c.execute(f"INSERT OR IGNORE INTO archive.{table} ({column_list}) SELECT {column_list} FROM main.time_sessions WHERE {archivable}", bounds)
+        conn.commit()
+        
+        c.execute(f'''
+            INSERT INTO time_rollups (day, user_id, username, task_name, minutes, sessions)
+            SELECT substr(started_at, 1, 10), user_id, MAX(username), COALESCE(task_name, ''),
+                   SUM(duration_minutes), COUNT(*)
+            FROM main.time_sessions WHERE {archivable}
+            GROUP BY 1, 2, 4
+            ON CONFLICT (day, user_id, task_name) DO UPDATE SET
+                minutes = minutes + excluded.minutes, sessions = sessions + excluded.sessions
+        ''', bounds)
+        c.execute(f"DELETE FROM main.time_sessions WHERE {archivable}", bounds)
+        moved += c.rowcount
+        conn.commit()
+    
+    conn.close()
+    return moved
+
+@traced("db")
+def maintain_db(vacuum_pages: int = 2000):
+    """Инкрементальный VACUUM и обновление статистики планировщика"""
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    if c.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        # Старая база: один полный VACUUM, дальше — только инкрементальный
+        c.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        c.execute("VACUUM")
+    c.execute(f"PRAGMA incremental_vacuum({int(vacuum_pages)})")
+    c.execute("PRAGMA optimize")
+    c.execute("ANALYZE time_sessions")
+    conn.commit()
+    conn.close()
+
+async def retention_job(context: ContextTypes.DEFAULT_TYPE):
+    """Ночное обслуживание: архив старых сессий + VACUUM/ANALYZE"""
     try:
-        if method == "GET":
-            resp = requests.get(url, headers=headers, params=data, timeout=10)
-        elif method == "POST":
-            resp = requests.post(url, headers=headers, json={"data": data}, timeout=10)
-        else:
-            resp = requests.request(method, url, headers=headers, json={"data": data}, timeout=10)
+        moved = await asyncio.to_thread(archive_old_sessions)
+        await asyncio.to_thread(maintain_db)
+        logger.info(f"🗄️ Обслуживание БД: в архив перенесено {moved} сессий")
+    except Exception as e:
+        logger.error(f"Retention error: {e}")
+
+# ═══════════════════════════════════════════════════════════════
+# ЭКСПОРТ СЕССИЙ
+# ═══════════════════════════════════════════════════════════════
+
+EXPORT_CHUNK_ROWS = 1000
+EXPORT_SPOOL_BYTES = 8 * 1024 * 1024  # больше — сжатый файл уходит на диск
+EXPORT_COLUMNS = (
+    "id", "user_id", "username", "task_name", "asana_task_id",
+    "started_at", "ended_at", "duration_minutes", "notes",
+)
+
+def iter_sessions(date_from: str, date_to: str, chunk_size: int = EXPORT_CHUNK_ROWS):
+    """Строки сессий (включая архив) за период [date_from, date_to], курсор читается порциями"""
+    day_after = (datetime.fromisoformat(date_to) + timedelta(days=1)).date().isoformat()
+    
+    conn = connect_with_archive()
+    try:
+        c = conn.cursor()
+        c.execute(f'''
+            SELECT {", ".join(EXPORT_COLUMNS)}
+            FROM all_sessions
+            WHERE started_at >= ? AND started_at < ?
+            ORDER BY started_at
+        ''', (date_from, day_after))
+        while True:
+            rows = c.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        conn.close()
+
+# Bot API принимает файлы до 50 МБ; запас — на буферы zlib и TextIOWrapper,
+# которые ещё не дошли до файла в момент проверки размера
+EXPORT_PART_BYTES = 45 * 1024 * 1024
+
+@traced("db")
+def write_sessions_export(new_part, fmt: str, date_from: str, date_to: str,
+                          max_bytes: int = EXPORT_PART_BYTES) -> list[int]:
+    """Записать сессии за период как gzip CSV или NDJSON, частями не больше max_bytes
+    
+    new_part() возвращает пустой файл для очередной части. Строки кодируются
+    и сжимаются по мере чтения курсора, поэтому память не зависит от размера
+    выборки. Каждая часть — самостоятельный архив (у CSV свой заголовок).
+    Возвращает количество строк в каждой части; без строк — пустой список.
+    """
+    counts = []
+    gz = out = write = fileobj = None
+    
+    def close_part():
+        out.flush()
+        out.detach()
+        gz.close()
+    
+    for row in iter_sessions(date_from, date_to):
+        if gz is not None and counts[-1] % EXPORT_CHUNK_ROWS == 0 and fileobj.tell() >= max_bytes:
+            close_part()
+            gz = None
+        if gz is None:
+            fileobj = new_part()
+            gz = gzip.GzipFile(fileobj=fileobj, mode="wb")
+            # utf-8-sig — чтобы Excel сразу открыл кириллицу в CSV
+            out = io.TextIOWrapper(gz, encoding="utf-8-sig" if fmt == "csv" else "utf-8", newline="")
+            if fmt == "csv":
+                writer = csv.writer(out)
+                writer.writerow(EXPORT_COLUMNS)
+                write = writer.writerow
+            else:
+                write = lambda row: out.write(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n")
+            counts.append(0)
+        write(row)
+        counts[-1] += 1
+    
+    if gz is not None:
+        close_part()
+    return counts
+
+# ═══════════════════════════════════════════════════════════════
+# КОЛОНОЧНЫЙ СНИМОК СЕССИЙ
+# ═══════════════════════════════════════════════════════════════
+
+# Для аналитики за годы (/analytics) закрытые сессии, включая архивные, лежат в
+# SNAPSHOT_DIR по колонкам фиксированной ширины: user_id, начало (epoch),
+# минуты, код задачи (словарь названий — в snapshot.json). Файлы открываются
+# через np.memmap и сканируются векторно без копирования, живая таблица не
+# читается целиком. Колонки только дописываются строками с id выше водяного знака
+# (из all_sessions: до refresh строки могли уйти в архив). Открытые сессии
+# пропускаются, их id помнятся в snapshot.json ("pending") и дочитываются, когда
+# сессия закроется, — водяной знак не стоит на месте из-за забытого таймера.
+# snapshot.json пишется после колонок, лишний хвост от прерванной записи отрезается.
+
+SNAPSHOT_DIR = DB_PATH.with_name("sessions_snapshot")
+SNAPSHOT_VERSION = 1
+SNAPSHOT_COLUMNS = {"user_id": "<i8", "started": "<i8", "minutes": "<i4", "task": "<i4"}
+SNAPSHOT_CHUNK_ROWS = 10000
+
+def load_snapshot_meta() -> dict | None:
+    try:
+        meta = json.loads((SNAPSHOT_DIR / "snapshot.json").read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get("version") == SNAPSHOT_VERSION else None
+
+def session_epoch(started_at: str) -> int:
+    started = datetime.fromisoformat(started_at)
+    if started.tzinfo is None:
+        started = started.replace(tzinfo=MOSCOW_TZ)
+    return int(started.timestamp())
+
+@traced("db")
+def refresh_snapshot() -> int:
+    """Дописать в снимок сессии новее водяного знака; вернуть число строк
+    
+    Без снимка (или при смене формата) строится полный — из горячей таблицы
+    и архива. Между процессами кластера — под flock.
+    """
+    import fcntl
+    import numpy as np
+    
+    SNAPSHOT_DIR.mkdir(exist_ok=True)
+    with open(SNAPSHOT_DIR / "snapshot.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        meta = load_snapshot_meta()
+        full = meta is None
+        if full:
+            meta = {"version": SNAPSHOT_VERSION, "rows": 0, "watermark": 0, "tasks": [], "users": {}}
+        codes = {name: i for i, name in enumerate(meta["tasks"])}
+        
+        pending = meta.get("pending", [])
+        open_ids = []
+        
+        conn = connect_with_archive()
+        c = conn.cursor()
+        c.execute(f'''
+            SELECT id, user_id, username, started_at, duration_minutes, task_name, ended_at IS NULL
+            FROM all_sessions
+            WHERE id > ? OR id IN ({", ".join("?" * len(pending))})
+            ORDER BY id
+        ''', (meta["watermark"], *pending))
+        
+        files = {}
+        for name in SNAPSHOT_COLUMNS:
+            f = open(SNAPSHOT_DIR / f"{name}.bin", "wb" if full else "r+b")
+            f.truncate(meta["rows"] * np.dtype(SNAPSHOT_COLUMNS[name]).itemsize)
+            f.seek(0, os.SEEK_END)
+            files[name] = f
         
-        resp.raise_for_status()
-        return resp.json().get("data", {})
+        added = 0
+        try:
+            while rows := c.fetchmany(SNAPSHOT_CHUNK_ROWS):
+                columns = {name: [] for name in SNAPSHOT_COLUMNS}
+                closed = 0
+                for session_id, user_id, username, started_at, minutes, task_name, is_open in rows:
+                    if is_open:
+                        open_ids.append(session_id)
+                        continue
+                    closed += 1
+                    if task_name and task_name not in codes:
+                        codes[task_name] = len(meta["tasks"])
+                        meta["tasks"].append(task_name)
+                    columns["user_id"].append(user_id)
+                    columns["started"].append(session_epoch(started_at))
+                    columns["minutes"].append(minutes or 0)
+                    columns["task"].append(codes[task_name] if task_name else -1)
+                    if username:
+                        meta["users"][str(user_id)] = username
+                for name, values in columns.items():
+                    files[name].write(np.asarray(values, dtype=SNAPSHOT_COLUMNS[name]).tobytes())
+                added += closed
+                meta["watermark"] = max(meta["watermark"], rows[-1][0])
+        finally:
+            conn.close()
+            for f in files.values():
+                f.close()
+        
+        meta["rows"] += added
+        meta["pending"] = open_ids
+        meta["built_at"] = datetime.now(MOSCOW_TZ).isoformat()
+        tmp = SNAPSHOT_DIR / "snapshot.json.tmp"
+        tmp.write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, SNAPSHOT_DIR / "snapshot.json")
+    return added
+
+class SessionSnapshot:
+    """Колонки снимка как массивы numpy поверх mmap (только чтение, без копий)"""
+    
+    def __init__(self, meta: dict):
+        import numpy as np
+        self.meta = meta
+        self.tasks = meta["tasks"]
+        self.users = {int(k): v for k, v in meta["users"].items()}
+        for name, dtype in SNAPSHOT_COLUMNS.items():
+            column = (np.memmap(SNAPSHOT_DIR / f"{name}.bin", dtype=dtype, mode="r", shape=(meta["rows"],))
+                      if meta["rows"] else np.empty(0, dtype=dtype))
+            setattr(self, name, column)
+    
+    @classmethod
+    def open(cls) -> "SessionSnapshot | None":
+        meta = load_snapshot_meta()
+        return cls(meta) if meta else None
+
+def period_epochs(date_from: str, date_to: str) -> tuple[int, int]:
+    """Границы [date_from, date_to] по МСК в epoch-секундах"""
+    start = datetime.fromisoformat(date_from).replace(tzinfo=MOSCOW_TZ)
+    end = datetime.fromisoformat(date_to).replace(tzinfo=MOSCOW_TZ) + timedelta(days=1)
+    return int(start.timestamp()), int(end.timestamp())
+
+def snapshot_analytics(snap: SessionSnapshot, date_from: str, date_to: str) -> dict:
+    """Векторные агрегаты за период и за тот же период годом раньше
+    
+    users / tasks: {ключ: (минуты за период, минуты годом раньше)};
+    heatmap: минуты 7×24 (день недели × час начала сессии, МСК).
+    """
+    import numpy as np
+    
+    def year_back(day: str) -> str:
+        d = datetime.fromisoformat(day).date()
+        return d.replace(year=d.year - 1, day=28 if (d.month, d.day) == (2, 29) else d.day).isoformat()
+    
+    def period_mask(lo: int, hi: int):
+        return (snap.started >= lo) & (snap.started < hi)
+    
+    current = period_mask(*period_epochs(date_from, date_to))
+    previous = period_mask(*period_epochs(year_back(date_from), year_back(date_to)))
+    minutes = snap.minutes.astype(np.int64)
+    
+    users, user_index = np.unique(snap.user_id, return_inverse=True)
+    per_user = [np.bincount(user_index, weights=np.where(mask, minutes, 0), minlength=len(users)) for mask in (current, previous)]
+    
+    has_task = snap.task >= 0
+    per_task = [np.bincount(snap.task[has_task & mask], weights=minutes[has_task & mask], minlength=len(snap.tasks))
+                for mask in (current, previous)]
+    
+    # 1970-01-01 — четверг (3); МСК = UTC+3 круглый год
+    local = snap.started[current] + 3 * 3600
+    cells = (local // 86400 + 3) % 7 * 24 + local // 3600 % 24
+    heatmap = np.bincount(cells, weights=minutes[current], minlength=7 * 24).reshape(7, 24)
+    
+    return {
+        "users": {int(u): (int(a), int(b)) for u, a, b in zip(users, *per_user) if a or b},
+        "tasks": {snap.tasks[i]: (int(a), int(b)) for i, (a, b) in enumerate(zip(*per_task)) if a or b},
+        "heatmap": heatmap,
+        "total": int(minutes[current].sum()),
+    }
+
+async def snapshot_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическое дописывание колоночного снимка"""
+    try:
+        added = await asyncio.to_thread(refresh_snapshot)
+        if added:
+            logger.info(f"🧊 Снимок сессий: +{added} строк")
     except Exception as e:
-        logger.error(f"Asana API error: {e}")
+        logger.error(f"Snapshot refresh error: {e}")
+
+# ═══════════════════════════════════════════════════════════════
+# КЭШ КОМАНДНЫХ ОТЧЁТОВ
+# ═══════════════════════════════════════════════════════════════
+
+# (date_from, date_to) -> (время построения, готовый текст отчёта); живёт до
+# stop_session в этом диапазоне. Закрытия сессий отмечаются ещё и в sync_state
+# (report_touch:<день>), чтобы кэш был согласован между воркерами кластера.
+TEAM_REPORT_CACHE_SIZE = 64
+_team_report_cache: dict[tuple[str, str], tuple[float, str]] = {}
+
+def get_cached_team_report(date_from: str, date_to: str) -> str | None:
+    cached = _team_report_cache.get((date_from, date_to))
+    if not cached:
+        return None
+    
+    built_at, text = cached
+    conn = sqlite3.connect(DB_PATH)
+    row = conn.execute(
+        'SELECT MAX(CAST(value AS REAL)) FROM sync_state WHERE key BETWEEN ? AND ?',
+        (f"report_touch:{date_from}", f"report_touch:{date_to}")
+    ).fetchone()
+    conn.close()
+    if row[0] is not None and row[0] >= built_at:
+        del _team_report_cache[(date_from, date_to)]
+        return None
+    return text
+
+def cache_team_report(date_from: str, date_to: str, text: str, built_at: float):
+    if len(_team_report_cache) >= TEAM_REPORT_CACHE_SIZE:
+        _team_report_cache.pop(next(iter(_team_report_cache)))
+    _team_report_cache[(date_from, date_to)] = (built_at, text)
+
+def invalidate_team_report(day: str):
+    """Сбросить отчёты, диапазон которых содержит день day (YYYY-MM-DD)"""
+    for key in [k for k in _team_report_cache if k[0] <= day <= k[1]]:
+        del _team_report_cache[key]
+    set_sync_state(f"report_touch:{day}", f"{time.time():.6f}")
+
+# ═══════════════════════════════════════════════════════════════
+# ВНЕШНИЕ КЛИЕНТЫ (ленивая инициализация)
+# ═══════════════════════════════════════════════════════════════
+
+# openai и requests импортируются при первом использовании:
+# запуск бота не платит за них, пока не пришло голосовое или запрос к Asana
+_http_session = None
+_openai_client = None
+
+def get_http_session():
+    """HTTP-сессия для внешних API (keep-alive, создаётся при первом запросе)"""
+    global _http_session
+    if _http_session is None:
+        import requests
+        _http_session = requests.Session()
+    return _http_session
+
+def get_openai_client():
+    """Клиент OpenAI (создаётся при первом голосовом)"""
+    global _openai_client
+    if _openai_client is None:
+        import openai
+        _openai_client = openai.OpenAI(api_key=OPENAI_API_KEY)
+    return _openai_client
+
+# ═══════════════════════════════════════════════════════════════
+# ПРЕДОХРАНИТЕЛИ ВНЕШНИХ API (circuit breaker)
+# ═══════════════════════════════════════════════════════════════
+
+# После BREAKER_FAILURES ошибок подряд (сеть, таймаут, 5xx, 429) предохранитель
+# размыкается: запросы к сервису сразу отклоняются, а не ждут таймаут по очереди.
+# Через BREAKER_RESET секунд пропускается один пробный запрос (half-open): успех
+# замыкает цепь, ошибка — снова размыкает. GET к Asana во время сбоя отдаются из
+# кэша последних удачных ответов с пометкой о давности (StaleData).
+
+ASANA_FALLBACK_SIZE = 256
+
+class UpstreamUnavailable(Exception):
+    """Сервис недоступен: предохранитель разомкнут"""
+    
+    def __init__(self, service: str):
+        super().__init__(f"{service} временно недоступен, попробуйте позже")
+        self.service = service
+
+class CircuitBreaker:
+    """Предохранитель одного внешнего сервиса (вызывается из потоков to_thread)"""
+    
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+    
+    def __init__(self, name: str, failures: int = BREAKER_FAILURES, reset_timeout: float = BREAKER_RESET):
+        self.name = name
+        self.max_failures = failures
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+    
+    def allow(self) -> bool:
+        """Можно ли сейчас идти в сервис; в half-open — только одному пробному запросу"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+    
+    def record(self, status_code: int | None):
+        """Итог запроса: None — сетевая ошибка/таймаут; 5xx и 429 — сбой сервиса"""
+        if status_code is None or status_code >= 500 or status_code == 429:
+            self.failure()
+        else:
+            self.success()
+    
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self._probe_in_flight = False
+            if self.state != self.CLOSED:
+                self._set_state(self.CLOSED)
+    
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.state == self.HALF_OPEN or self.failures >= self.max_failures:
+                self.opened_at = time.monotonic()
+                if self.state != self.OPEN:
+                    self._set_state(self.OPEN)
+    
+    def _set_state(self, state: str):
+        logger.warning(f"Предохранитель {self.name}: {self.state} → {state}", extra={
+            "breaker": self.name, "breaker_state": state, "failures": self.failures,
+        })
+        self.state = state
+    
+    def snapshot(self) -> dict:
+        with self._lock:
+            retry_in = max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at)) if self.state == self.OPEN else 0.0
+            return {"state": self.state, "failures": self.failures, "rejected": self.rejected, "retry_in": round(retry_in)}
+
+BREAKERS = {
+    "asana": CircuitBreaker("asana"),
+    "openai": CircuitBreaker("openai"),
+}
+
+class StaleData(list):
+    """Список из кэша последних удачных ответов — сервис сейчас недоступен
+    
+    fetched_at — когда данные были получены; None — кэша нет и список пуст.
+    """
+    
+    def __init__(self, items=(), fetched_at: float | None = None, service: str = "Asana"):
+        super().__init__(items)
+        self.fetched_at = fetched_at
+        self.service = service
+    
+    @classmethod
+    def like(cls, source: list, items: list) -> list:
+        """items с той же пометкой о давности, что у source"""
+        if isinstance(source, cls):
+            return cls(items, source.fetched_at, source.service)
+        return items
+
+def stale_note(result) -> str:
+    """Пометка для ответа пользователю, если данные не свежие (иначе пустая строка)"""
+    if not isinstance(result, StaleData):
+        return ""
+    if result.fetched_at is None:
+        return f"⚠️ {result.service} сейчас недоступна — попробуйте позже\n\n"
+    fetched = datetime.fromtimestamp(result.fetched_at, MOSCOW_TZ)
+    return f"⚠️ {result.service} недоступна — данные на {fetched:%d.%m %H:%M}\n\n"
+
+def is_unavailable(result) -> bool:
+    """Нет ни свежих, ни сохранённых данных"""
+    return isinstance(result, StaleData) and result.fetched_at is None
+
+# Последние удачные GET-ответы Asana: запас на время сбоя, а при живом вебхуке
+# Asana — и кэш (см. fresh_asana_response). Для точечной инвалидации по событиям
+# помнится, в каких ответах встречается каждая задача.
+_asana_fallback: OrderedDict[tuple, tuple[float, object]] = OrderedDict()
+_asana_task_keys: dict[str, set[tuple]] = {}  # gid задачи → ключи ответов с ней
+_asana_cache_lock = threading.RLock()  # пишут потоки обработчиков и приёмник вебхуков
+
+def response_task_gids(data) -> list:
+    items = data if isinstance(data, list) else [data]
+    return [item["gid"] for item in items if isinstance(item, dict) and item.get("gid")]
+
+def remember_asana_response(key: tuple, data, fetched_at: float | None = None):
+    with _asana_cache_lock:
+        forget_asana_response(key)
+        _asana_fallback[key] = (fetched_at or time.time(), data)
+        for gid in response_task_gids(data):
+            _asana_task_keys.setdefault(gid, set()).add(key)
+        while len(_asana_fallback) > ASANA_FALLBACK_SIZE:
+            forget_asana_response(next(iter(_asana_fallback)))
+
+def forget_asana_response(key: tuple):
+    with _asana_cache_lock:
+        cached = _asana_fallback.pop(key, None)
+        if cached is None:
+            return
+        for gid in response_task_gids(cached[1]):
+            keys = _asana_task_keys.get(gid)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del _asana_task_keys[gid]
+
+def project_scoped(key: tuple) -> bool:
+    """Ответ по задачам ASANA_PROJECT — только его поправят события подписки на проект
+    
+    «Мои задачи» по всему workspace и поиск захватывают задачи других проектов,
+    об изменениях в которых вебхук не сообщает: для них кэш только запасной.
+    """
+    return (json.loads(key[1]) or {}).get("project") == ASANA_PROJECT
+
+def fresh_asana_response(key: tuple | None):
+    """Кэшированный GET-ответ, пока его свежесть гарантируют события вебхука Asana"""
+    if key is None or not project_scoped(key) or not asana_events_live():
+        return None
+    cached = _asana_fallback.get(key)
+    if cached is None or time.time() - cached[0] > ASANA_CACHE_TTL:
+        return None
+    return cached[1]
+
+def asana_fallback(key: tuple | None):
+    """Последний удачный ответ на тот же GET (списки — как StaleData)"""
+    if key is None:
         return {}
+    cached = _asana_fallback.get(key)
+    if cached is None:
+        return StaleData()
+    fetched_at, data = cached
+    return StaleData(data, fetched_at) if isinstance(data, list) else data
+
+# ═══════════════════════════════════════════════════════════════
+# ASANA API
+# ═══════════════════════════════════════════════════════════════
+
+ASANA_API = "https://app.asana.com/api/1.0"
+ASANA_TIMEOUT = 10  # сек на запрос; таймаут — сбой для предохранителя
+ASANA_HEADERS = {
+    "Authorization": f"Bearer {ASANA_TOKEN}",
+    "Content-Type": "application/json"
+}
+
+def asana_request(method: str, endpoint: str, data: dict = None, fresh: bool = False) -> dict:
+    """Запрос к Asana API
+    
+    При сбое Asana (или разомкнутом предохранителе) GET отдаёт последний
+    удачный ответ на тот же запрос (см. asana_fallback), остальные — {}.
+    Пока работает вебхук Asana, GET по задачам проекта отвечает из кэша; fresh — мимо кэша
+    (ответ не запоминается, при сбое — {}).
+    """
+    url = f"{ASANA_API}{endpoint}"
+    session = get_http_session()
+    breaker = BREAKERS["asana"]
+    key = (endpoint, json.dumps(data, sort_keys=True, default=str)) if method == "GET" and not fresh else None
+    
+    cached = fresh_asana_response(key)
+    if cached is not None:
+        return cached
+    
+    with span(f"asana {method}", SPAN_KIND_CLIENT, endpoint=endpoint) as sp:
+        if not breaker.allow():
+            sp.set(**{"breaker.state": breaker.state})
+            sp.fail("circuit open")
+            return asana_fallback(key)
+        
+        resp = None
+        try:
+            if method == "GET":
+                resp = session.get(url, headers=ASANA_HEADERS, params=data, timeout=ASANA_TIMEOUT)
+            elif method == "POST":
+                resp = session.post(url, headers=ASANA_HEADERS, json={"data": data}, timeout=ASANA_TIMEOUT)
+            else:
+                resp = session.request(method, url, headers=ASANA_HEADERS, json={"data": data}, timeout=ASANA_TIMEOUT)
+            
+            sp.set(**{"http.status_code": resp.status_code})
+            resp.raise_for_status()
+            result = resp.json().get("data", {})
+        except Exception as e:
+            sp.fail(e)
+            logger.error(f"Asana API error: {e}")
+            status = resp.status_code if resp is not None else None
+            breaker.record(status)
+            if status is not None and status < 500 and status != 429:
+                return {}  # ошибка в самом запросе (4xx) — кэш тут не поможет
+            return asana_fallback(key)
+        
+        breaker.success()
+        if key is not None:
+            remember_asana_response(key, result)
+        return result
 
 def get_my_tasks(assignee: str = "me", limit: int = 10) -> list:
     """Получить задачи пользователя"""
@@ -245,7 +1470,27 @@ def get_my_tasks(assignee: str = "me", limit: int = 10) -> list:
         "opt_fields": "name,due_on,completed,projects.name",
         "limit": limit
     }
-    return asana_request("GET", endpoint, params) or []
+    tasks = asana_request("GET", endpoint, params)
+    return tasks if isinstance(tasks, list) else []
+
+def get_project_tasks(assignee_gid: str | None = None, limit: int = 10) -> list:
+    """Открытые задачи проекта; задачи assignee_gid — первыми
+    
+    Один запрос на весь проект с фильтром на клиенте: ключ кэша общий для всех
+    пользователей, а события вебхука проекта держат его свежим.
+    """
+    params = {
+        "project": ASANA_PROJECT,
+        "completed_since": "now",
+        "opt_fields": "name,due_on,completed,assignee",
+        "limit": 100
+    }
+    tasks = asana_request("GET", "/tasks", params)
+    if not isinstance(tasks, list):
+        return []
+    is_mine = lambda task: bool(assignee_gid) and (task.get("assignee") or {}).get("gid") == assignee_gid
+    open_tasks = [t for t in tasks if not t.get("completed")]  # закрытые ботом — из кэша
+    return StaleData.like(tasks, sorted(open_tasks, key=lambda task: not is_mine(task))[:limit])
 
 def get_overdue_tasks() -> list:
     """Просроченные задачи"""
@@ -259,7 +1504,7 @@ def get_overdue_tasks() -> list:
             if due < today:
                 overdue.append(task)
     
-    return overdue
+    return StaleData.like(tasks, overdue)
 
 def search_tasks(query: str) -> list:
     """Поиск задач по названию"""
@@ -269,7 +1514,517 @@ def search_tasks(query: str) -> list:
         "opt_fields": "name,due_on,completed,gid",
         "limit": 5
     }
-    return asana_request("GET", endpoint, params) or []
+    tasks = asana_request("GET", endpoint, params)
+    return tasks if isinstance(tasks, list) else []
+
+def asana_paginate(endpoint: str, params: dict):
+    """Все страницы GET-запроса к Asana (offset-пагинация)
+    
+    В отличие от asana_request, ошибки не глотаются: вызывающий код должен
+    знать, что выборка неполная.
+    """
+    params = dict(params, limit=100)
+    session = get_http_session()
+    breaker = BREAKERS["asana"]
+    while True:
+        if not breaker.allow():
+            raise UpstreamUnavailable("Asana")
+        with span("asana GET", SPAN_KIND_CLIENT, endpoint=endpoint, page_offset=params.get("offset")) as sp:
+            try:
+                resp = session.get(f"{ASANA_API}{endpoint}", headers=ASANA_HEADERS, params=params, timeout=ASANA_TIMEOUT)
+            except Exception:
+                breaker.failure()
+                raise
+            breaker.record(resp.status_code)
+            sp.set(**{"http.status_code": resp.status_code})
+            resp.raise_for_status()
+        body = resp.json()
+        yield from body.get("data", [])
+        next_page = body.get("next_page")
+        if not next_page:
+            return
+        params["offset"] = next_page["offset"]
+
+# ═══════════════════════════════════════════════════════════════
+# ЛОКАЛЬНЫЙ ИНДЕКС ЗАДАЧ
+# ═══════════════════════════════════════════════════════════════
+
+# Голосовые «Принял …» / «Готово …» сопоставляются с задачами локально:
+# FTS5 по основам слов (лёгкий русский стеммер) + FTS5-триграммы для опечаток
+# Whisper, результаты сливаются reciprocal rank fusion.
+
+RU_REFLEXIVE = ("ся", "сь")
+RU_ENDINGS = sorted({
+    # прилагательные / причастия
+    "ими", "ыми", "его", "ого", "ему", "ому", "ее", "ие", "ые", "ое", "ей", "ий", "ый", "ой",
+    "ем", "им", "ым", "ом", "их", "ых", "ую", "юю", "ая", "яя", "ою", "ею",
+    # глаголы
+    "ила", "ыла", "ена", "ейте", "уйте", "ите", "или", "ыли", "ило", "ыло", "ено", "ует", "уют",
+    "ить", "ыть", "ишь", "ешь", "ете", "йте", "ать", "ять", "ала", "яла", "али", "яли", "ал", "ял",
+    "ил", "ыл", "ят", "ит", "ыт", "ть", "ла", "ли", "ет", "ют",
+    # существительные
+    "иями", "ями", "ами", "ией", "иям", "ием", "иях", "ев", "ов", "ие", "ье", "еи", "ии",
+    "ям", "ам", "ах", "ях", "ию", "ью", "ия", "ья", "ость", "ости",
+    "а", "е", "и", "й", "о", "у", "ы", "ь", "ю", "я",
+}, key=len, reverse=True)
+WORD_RE = re.compile(r"\w+")
+# Слова, которые ничего не говорят о конкретной задаче
+SEARCH_STOPWORDS = {"задач", "для", "про", "это", "эту", "этой", "над"}
+
+def stem_ru(word: str) -> str:
+    """Лёгкий стеммер: срезает самое длинное окончание, оставляя основу ≥ 3 букв"""
+    word = word.lower().replace("ё", "е")
+    if len(word) <= 3 or not ("а" <= word[0] <= "я"):
+        return word
+    for ending in RU_REFLEXIVE:
+        if word.endswith(ending) and len(word) - 2 >= 3:
+            word = word[:-2]
+            break
+    for ending in RU_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+def task_stems(text: str) -> str:
+    return " ".join(stem_ru(w) for w in WORD_RE.findall(text))
+
+@traced("db")
+def index_tasks(tasks: list):
+    """Добавить/обновить задачи в локальном индексе"""
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    for task in tasks:
+        if not task.get("gid") or not task.get("name"):
+            continue
+        row_id = c.execute('''
+            INSERT INTO asana_tasks (gid, name, completed, modified_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(gid) DO UPDATE SET
+                name = excluded.name, completed = excluded.completed, modified_at = excluded.modified_at
+            RETURNING id
+        ''', (task["gid"], task["name"], int(bool(task.get("completed"))), task.get("modified_at"))).fetchone()[0]
+        c.execute('DELETE FROM asana_tasks_fts WHERE rowid = ?', (row_id,))
+        c.execute('DELETE FROM asana_tasks_trgm WHERE rowid = ?', (row_id,))
+        c.execute('INSERT INTO asana_tasks_fts (rowid, stems) VALUES (?, ?)', (row_id, task_stems(task["name"])))
+        c.execute('INSERT INTO asana_tasks_trgm (rowid, name) VALUES (?, ?)', (row_id, task["name"].lower().replace("ё", "е")))
+    conn.commit()
+    conn.close()
+
+@traced("db")
+def mark_task_completed(gid: str):
+    conn = sqlite3.connect(DB_PATH)
+    conn.execute('UPDATE asana_tasks SET completed = 1 WHERE gid = ?', (gid,))
+    conn.commit()
+    conn.close()
+
+@traced("db")
+def delete_task_local(gid: str):
+    """Убрать задачу из локального индекса (удалена или ушла из проекта)"""
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    row = c.execute('DELETE FROM asana_tasks WHERE gid = ? RETURNING id', (gid,)).fetchone()
+    if row:
+        c.execute('DELETE FROM asana_tasks_fts WHERE rowid = ?', row)
+        c.execute('DELETE FROM asana_tasks_trgm WHERE rowid = ?', row)
+    conn.commit()
+    conn.close()
+
+@traced("db")
+def find_tasks_local(text: str, limit: int = 3) -> list:
+    """Незакрытые задачи, похожие на text: [{"gid", "name"}] по убыванию релевантности"""
+    words = [
+        w for w in WORD_RE.findall(text.lower().replace("ё", "е"))
+        if len(w) >= 3 and stem_ru(w) not in SEARCH_STOPWORDS
+    ]
+    if not words:
+        return []
+    stem_query = " OR ".join(f'"{stem_ru(w)}"*' for w in words)
+    trigrams = {w[i:i + 3] for w in words for i in range(len(w) - 2)}
+    trigram_query = " OR ".join(f'"{t}"' for t in list(trigrams)[:64])
+    
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    scores, names = {}, {}
+    for table, fts_query in (("asana_tasks_fts", stem_query), ("asana_tasks_trgm", trigram_query)):
+        if not fts_query:
+            continue
+        c.execute(f'''
+            SELECT t.gid, t.name
+            FROM {table} f JOIN asana_tasks t ON t.id = f.rowid
+            WHERE {table} MATCH ? AND t.completed = 0
+            ORDER BY bm25({table})
+            LIMIT 20
+        ''', (fts_query,))
+        for rank, (gid, name) in enumerate(c.fetchall()):
+            scores[gid] = scores.get(gid, 0) + 1 / (60 + rank)
+            names[gid] = name
+    conn.close()
+    
+    best = sorted(scores, key=scores.get, reverse=True)[:limit]
+    return [{"gid": gid, "name": names[gid]} for gid in best]
+
+@traced("db")
+def task_index_size() -> int:
+    conn = sqlite3.connect(DB_PATH)
+    count = conn.execute('SELECT COUNT(*) FROM asana_tasks').fetchone()[0]
+    conn.close()
+    return count
+
+def find_tasks(text: str, limit: int = 3) -> list:
+    """Поиск задачи по голосовой фразе: локальный индекс, пока он пуст — API Asana"""
+    if task_index_size():
+        return find_tasks_local(text, limit)
+    return [t for t in search_tasks(text) if not t.get("completed")][:limit]
+
+@traced("db")
+def get_sync_state(key: str) -> str | None:
+    conn = sqlite3.connect(DB_PATH)
+    row = conn.execute('SELECT value FROM sync_state WHERE key = ?', (key,)).fetchone()
+    conn.close()
+    return row[0] if row else None
+
+@traced("db")
+def set_sync_state(key: str, value: str):
+    conn = sqlite3.connect(DB_PATH)
+    conn.execute('INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)', (key, value))
+    conn.commit()
+    conn.close()
+
+def refresh_task_index() -> int:
+    """Подтянуть в индекс задачи проекта, изменённые с прошлого обновления"""
+    started = datetime.now(MOSCOW_TZ).isoformat()
+    params = {"project": ASANA_PROJECT, "opt_fields": "name,completed,modified_at"}
+    since = get_sync_state("task_index_modified_since")
+    if since:
+        params["modified_since"] = since
+    
+    count, batch = 0, []
+    for task in asana_paginate("/tasks", params):
+        batch.append(task)
+        if len(batch) >= 500:
+            index_tasks(batch)
+            count += len(batch)
+            batch = []
+    index_tasks(batch)
+    count += len(batch)
+    
+    # Водяной знак сдвигается только после полной выборки
+    set_sync_state("task_index_modified_since", started)
+    return count
+
+async def refresh_task_index_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическое обновление локального индекса задач"""
+    if not ASANA_TOKEN:
+        return
+    try:
+        count = await asyncio.to_thread(refresh_task_index)
+        if count:
+            logger.info(f"🔎 Индекс задач обновлён: {count}")
+    except Exception as e:
+        logger.error(f"Task index refresh error: {e}")
+
+# ═══════════════════════════════════════════════════════════════
+# ВЕБХУКИ ASANA
+# ═══════════════════════════════════════════════════════════════
+
+# Asana сама сообщает об изменениях задач проекта. HTTP-сервер в потоке процесса
+# с плановыми задачами принимает события и точечно обновляет кэш ответов и
+# локальный индекс: удалённые задачи убираются, изменённые перечитываются и
+# подставляются во все ответы, где встречаются. Пока события доходят (Asana шлёт
+# и пустые heartbeat), ответы по задачам проекта живут ASANA_CACHE_TTL (остальные
+# запрашиваются заново, кэш для них запасной); вебхук замолчал — кэш снова
+# только запасной, а подписка пересоздаётся.
+# Рукопожатие: на POST /webhooks Asana присылает X-Hook-Secret, его надо вернуть;
+# дальше каждое событие подписано X-Hook-Signature = HMAC-SHA256(секрет, тело).
+# В кластере приёмник работает в воркере 0, кэш остальных воркеров — только запасной.
+
+ASANA_WEBHOOK_SILENCE = 24 * 3600  # heartbeat — раз в 8 ч; дольше тишина — подписки нет
+ASANA_TASK_FIELDS = "name,due_on,completed,modified_at,projects.name,assignee"
+# Поля, от которых зависит, в чьи списки задач (assignee + completed_since) попадает задача
+ASANA_LIST_FIELDS = {"assignee", "completed"}
+# Параметры GET-списков, в которых может появиться только что созданная задача
+ASANA_NEW_TASK_LISTS = ("assignee", "project", "text")
+
+_asana_handshake = threading.Event()  # открыт только на время нашего POST /webhooks
+_asana_receiver_started: float | None = None
+_asana_last_delivery: float | None = None
+
+def asana_events_live() -> bool:
+    """Доходят ли события вебхука Asana до этого процесса"""
+    return _asana_last_delivery is not None and time.time() - _asana_last_delivery < ASANA_WEBHOOK_SILENCE
+
+def patch_task_fields(item: dict, task: dict) -> dict:
+    return {**item, **{field: task[field] for field in item if field in task}}
+
+def patch_cached_task(task: dict):
+    """Подставить свежие поля задачи во все кэшированные ответы, где она есть"""
+    gid = task["gid"]
+    with _asana_cache_lock:
+        for key in list(_asana_task_keys.get(gid, ())):
+            fetched_at, data = _asana_fallback[key]
+            if isinstance(data, list):
+                data = [patch_task_fields(item, task) if isinstance(item, dict) and item.get("gid") == gid else item
+                        for item in data]
+            else:
+                data = patch_task_fields(data, task)
+            remember_asana_response(key, data, fetched_at)
+
+def remove_cached_task(gid: str):
+    """Убрать задачу из кэшированных списков (ответы по самой задаче — забыть)"""
+    with _asana_cache_lock:
+        for key in list(_asana_task_keys.get(gid, ())):
+            fetched_at, data = _asana_fallback[key]
+            if isinstance(data, list):
+                remember_asana_response(key, [item for item in data if not (isinstance(item, dict) and item.get("gid") == gid)], fetched_at)
+            else:
+                forget_asana_response(key)
+
+def forget_cached_lists(*params: str):
+    """Забыть ответы-списки, запрошенные с любым из params (состав мог поменяться)"""
+    with _asana_cache_lock:
+        for key in [k for k in _asana_fallback if any(p in (json.loads(k[1]) or {}) for p in params)]:
+            forget_asana_response(key)
+
+def apply_asana_events(events: list) -> int:
+    """Применить пачку событий задач; вернуть число перечитанных задач"""
+    refetch, deleted, relist, research = set(), set(), False, False
+    for event in events:
+        resource = event.get("resource") or {}
+        if resource.get("resource_type") != "task" or not resource.get("gid"):
+            continue
+        gid, action = resource["gid"], event.get("action")
+        parent = event.get("parent") or {}
+        if action == "deleted":
+            deleted.add(gid)
+            refetch.discard(gid)
+        elif action == "removed" and parent.get("gid") == ASANA_PROJECT:
+            # Индекс — по задачам проекта; из списков «моих задач» задача не пропадает
+            delete_task_local(gid)
+        else:
+            deleted.discard(gid)
+            refetch.add(gid)
+            field = (event.get("change") or {}).get("field")
+            relist = relist or action in ("added", "undeleted") or field in ASANA_LIST_FIELDS
+            # Новая или переименованная задача может попасть в чужой поиск
+            research = research or action in ("added", "undeleted") or field == "name"
+    
+    for gid in deleted:
+        remove_cached_task(gid)
+        delete_task_local(gid)
+    if relist:
+        forget_cached_lists("assignee", "project")
+    if research:
+        forget_cached_lists("text")
+    
+    tasks = []
+    for gid in refetch:
+        task = asana_request("GET", f"/tasks/{gid}", {"opt_fields": ASANA_TASK_FIELDS}, fresh=True)
+        if isinstance(task, dict) and task.get("gid"):
+            patch_cached_task(task)
+            tasks.append(task)
+        else:
+            remove_cached_task(gid)  # перечитать не вышло — без неё надёжнее, чем со старой
+    index_tasks(tasks)
+    return len(tasks)
+
+class AsanaWebhookHandler(BaseHTTPRequestHandler):
+    """POST от Asana: рукопожатие подписки или подписанная пачка событий"""
+    
+    def do_POST(self):
+        global _asana_last_delivery
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path != (urlsplit(ASANA_WEBHOOK_URL).path or "/"):
+            self.reply(404)
+            return
+        
+        hook_secret = self.headers.get("X-Hook-Secret")
+        if hook_secret:
+            # Рукопожатие принимается только во время нашей подписки — иначе
+            # любой мог бы подменить секрет и слать поддельные события
+            if not _asana_handshake.is_set():
+                self.reply(403)
+                return
+            set_sync_state("asana_hook_secret", hook_secret)
+            self.reply(200, {"X-Hook-Secret": hook_secret})
+            return
+        
+        secret = get_sync_state("asana_hook_secret")
+        signature = self.headers.get("X-Hook-Signature", "").encode()
+        if not secret or not hmac.compare_digest(signature, hmac.new(secret.encode(), body, hashlib.sha256).hexdigest().encode()):
+            self.reply(401)
+            return
+        
+        # Asana ждёт ответа не дольше 10 с — события применяются уже после него
+        self.reply(200)
+        _asana_last_delivery = time.time()
+        try:
+            events = json.loads(body).get("events", [])
+            if not events:
+                return
+            with span("asana webhook", SPAN_KIND_SERVER, root=True, events=len(events)) as sp:
+                refetched = apply_asana_events(events)
+                sp.set(refetched=refetched)
+            logger.info(f"🔔 Asana: событий {len(events)}, перечитано задач {refetched}")
+        except Exception as e:
+            logger.error(f"Asana webhook error: {e}")
+    
+    def reply(self, status: int, headers: dict | None = None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+    
+    def log_message(self, format, *args):
+        logger.debug(f"Asana webhook: {format % args}")
+
+def start_asana_receiver():
+    """Поднять приёмник вебхуков Asana в фоновом потоке"""
+    global _asana_receiver_started
+    server = ThreadingHTTPServer(("", ASANA_WEBHOOK_PORT), AsanaWebhookHandler)
+    threading.Thread(target=server.serve_forever, name="asana-webhook", daemon=True).start()
+    _asana_receiver_started = time.time()
+    logger.info(f"🔔 Приёмник вебхуков Asana: порт {ASANA_WEBHOOK_PORT}, {ASANA_WEBHOOK_URL}")
+
+def ensure_asana_webhook():
+    """Подписаться на события задач проекта, если подписки нет или она замолчала"""
+    hook_gid = get_sync_state("asana_hook_gid")
+    last_heard = _asana_last_delivery or _asana_receiver_started or time.time()
+    if hook_gid and time.time() - last_heard < ASANA_WEBHOOK_SILENCE:
+        return
+    if hook_gid:
+        logger.warning("Вебхук Asana молчит — подписка пересоздаётся")
+        asana_request("DELETE", f"/webhooks/{hook_gid}")
+    
+    _asana_handshake.set()
+    try:
+        hook = asana_request("POST", "/webhooks", {
+            "resource": ASANA_PROJECT,
+            "target": ASANA_WEBHOOK_URL,
+            "filters": [{"resource_type": "task"}],
+        })
+    finally:
+        _asana_handshake.clear()
+    if hook.get("gid"):
+        set_sync_state("asana_hook_gid", hook["gid"])
+        logger.info(f"🔔 Подписка на события Asana: {hook['gid']}")
+    else:
+        logger.error("Не удалось подписаться на события Asana")
+
+async def asana_webhook_job(context: ContextTypes.DEFAULT_TYPE):
+    """Проверка подписки на события Asana"""
+    if not ASANA_TOKEN:
+        return
+    try:
+        await asyncio.to_thread(ensure_asana_webhook)
+    except Exception as e:
+        logger.error(f"Asana webhook subscription error: {e}")
+
+# ═══════════════════════════════════════════════════════════════
+# СИНХРОНИЗАЦИЯ ВРЕМЕНИ С ASANA
+# ═══════════════════════════════════════════════════════════════
+
+ASANA_BATCH_SIZE = 10  # лимит действий в одном /batch
+ASANA_BATCH_PAUSE = 1.0  # сек между батчами — не упираемся в rate limit
+
+@traced("db")
+def get_unsynced_sessions(limit: int) -> list:
+    """Завершённые сессии с привязкой к Asana, которые ещё не отправлены"""
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute('''
+        SELECT id, asana_task_id, username, started_at, duration_minutes, notes
+        FROM time_sessions
+        WHERE ended_at IS NOT NULL AND asana_task_id IS NOT NULL AND asana_synced_at IS NULL
+        ORDER BY id LIMIT ?
+    ''', (limit,))
+    rows = c.fetchall()
+    conn.close()
+    
+    return [
+        {
+            "id": r[0], "asana_task_id": r[1], "username": r[2],
+            "started_at": r[3], "duration_minutes": r[4] or 0, "notes": r[5]
+        }
+        for r in rows
+    ]
+
+@traced("db")
+def mark_sessions_synced(results: list):
+    """Сохранить результат синхронизации: [(session_id, error или None)]"""
+    now = datetime.now(MOSCOW_TZ).isoformat()
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.executemany('''
+        UPDATE time_sessions SET asana_synced_at = ?, asana_sync_error = ?
+        WHERE id = ?
+    ''', [(now, error, session_id) for session_id, error in results])
+    conn.commit()
+    conn.close()
+
+def time_comment(session: dict) -> str:
+    """Текст комментария к задаче Asana о затраченном времени"""
+    who = f"@{session['username']}" if session["username"] else "—"
+    text = f"⏱️ {format_minutes(session['duration_minutes'])} — {who}, {session['started_at'][:10]}"
+    if session["notes"]:
+        text += f"\n{session['notes']}"
+    return text
+
+def push_time_batch(sessions: list) -> tuple[list, bool]:
+    """Отправить до ASANA_BATCH_SIZE комментариев одним запросом к /batch
+    
+    Возвращает ([(session_id, error)] для сессий с окончательным результатом,
+    флаг «остановить запуск»). Сессии с 429/5xx не попадают в результат и
+    будут отправлены при следующем запуске.
+    """
+    actions = [
+        {
+            "method": "post",
+            "relative_path": f"/tasks/{s['asana_task_id']}/stories",
+            "data": {"text": time_comment(s)}
+        }
+        for s in sessions
+    ]
+    responses = asana_request("POST", "/batch", {"actions": actions})
+    if not isinstance(responses, list):
+        return [], True  # Asana недоступна — повторим в следующий запуск
+    
+    done, rate_limited = [], False
+    for session, resp in zip(sessions, responses):
+        status = resp.get("status_code", 0)
+        if 200 <= status < 300:
+            done.append((session["id"], None))
+        elif status == 429:
+            rate_limited = True
+        elif 400 <= status < 500:
+            # Задача удалена / нет доступа — повтор не поможет
+            errors = resp.get("body", {}).get("errors", [{}])
+            done.append((session["id"], f"{status}: {errors[0].get('message', '')}"[:200]))
+    return done, rate_limited
+
+async def sync_time_to_asana(context: ContextTypes.DEFAULT_TYPE):
+    """Фоновая отправка затреканного времени в Asana
+    
+    Состояние хранится в asana_synced_at по каждой строке, поэтому задача
+    идемпотентна и после сбоя продолжает с того же места.
+    """
+    if not ASANA_TOKEN:
+        return
+    
+    sessions = get_unsynced_sessions(ASANA_SYNC_MAX_PER_RUN)
+    synced = 0
+    for i in range(0, len(sessions), ASANA_BATCH_SIZE):
+        if i:
+            await asyncio.sleep(ASANA_BATCH_PAUSE)
+        done, stop = await asyncio.to_thread(push_time_batch, sessions[i:i + ASANA_BATCH_SIZE])
+        if done:
+            mark_sessions_synced(done)
+            synced += len(done)
+        if stop:
+            logger.warning("Asana недоступна или rate limit — остаток синхронизации перенесён")
+            break
+    
+    if synced:
+        logger.info(f"⏱️ В Asana отправлено сессий: {synced}")
 
 # ═══════════════════════════════════════════════════════════════
 # КОМАНДЫ БОТА
@@ -292,6 +2047,11 @@ HELP_TEXT = """
 /status — текущий статус
 /report — отчёт за сегодня
 /weekreport — отчёт за неделю
+/teamreport [с] [по] — отчёт по команде (админ)
+/analytics [с] [по] — загрузка и тренды год к году (админ)
+/export [csv|json] [с] [по] — выгрузка сессий (админ)
+/health — состояние внешних API (админ)
+/profile [сек|Nu] [raw] — профилирование бота (админ)
 
 🎤 **ГОЛОС:**
 Отправь голосовое — создам задачу
@@ -316,12 +2076,15 @@ async def tasks_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /tasks — список задач"""
     await update.message.reply_text("⏳ Загружаю задачи...")
     
-    tasks = get_my_tasks()
+    tasks = await asyncio.to_thread(get_my_tasks)
+    if is_unavailable(tasks):
+        await update.message.reply_text(stale_note(tasks))
+        return
     if not tasks:
-        await update.message.reply_text("📭 Нет активных задач")
+        await update.message.reply_text(stale_note(tasks) + "📭 Нет активных задач")
         return
     
-    text = "📋 **Мои задачи:**\n\n"
+    text = stale_note(tasks) + "📋 **Мои задачи:**\n\n"
     for i, task in enumerate(tasks[:10], 1):
         due = task.get("due_on", "—")
         name = task.get("name", "Без названия")
@@ -333,7 +2096,10 @@ async def week_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /week — план на неделю"""
     await update.message.reply_text("⏳ Загружаю план...")
     
-    tasks = get_my_tasks(limit=30)
+    tasks = await asyncio.to_thread(get_my_tasks, limit=30)
+    if is_unavailable(tasks):
+        await update.message.reply_text(stale_note(tasks))
+        return
     today = datetime.now(MOSCOW_TZ).date()
     week_end = today + timedelta(days=7)
     
@@ -345,7 +2111,7 @@ async def week_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 week_tasks.append(task)
     
     if not week_tasks:
-        await update.message.reply_text("📭 На эту неделю задач нет")
+        await update.message.reply_text(stale_note(tasks) + "📭 На эту неделю задач нет")
         return
     
     # Группируем по дням
@@ -356,7 +2122,7 @@ async def week_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             by_day[day] = []
         by_day[day].append(task["name"])
     
-    text = "📅 **План на неделю:**\n\n"
+    text = stale_note(tasks) + "📅 **План на неделю:**\n\n"
     for day in sorted(by_day.keys()):
         dt = datetime.strptime(day, "%Y-%m-%d")
         day_name = dt.strftime("%a %d.%m")
@@ -371,12 +2137,15 @@ async def overdue_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /overdue — просроченные"""
     await update.message.reply_text("⏳ Проверяю...")
     
-    tasks = get_overdue_tasks()
+    tasks = await asyncio.to_thread(get_overdue_tasks)
+    if is_unavailable(tasks):
+        await update.message.reply_text(stale_note(tasks))
+        return
     if not tasks:
-        await update.message.reply_text("✅ Просроченных задач нет!")
+        await update.message.reply_text(stale_note(tasks) + "✅ Просроченных задач нет!")
         return
     
-    text = "🔴 **Просроченные задачи:**\n\n"
+    text = stale_note(tasks) + "🔴 **Просроченные задачи:**\n\n"
     for task in tasks:
         name = task.get("name", "—")
         due = task.get("due_on", "—")
@@ -386,16 +2155,19 @@ async def overdue_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def today_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /today — задачи на сегодня"""
-    tasks = get_my_tasks(limit=30)
+    tasks = await asyncio.to_thread(get_my_tasks, limit=30)
+    if is_unavailable(tasks):
+        await update.message.reply_text(stale_note(tasks))
+        return
     today = datetime.now(MOSCOW_TZ).strftime("%Y-%m-%d")
     
     today_tasks = [t for t in tasks if t.get("due_on") == today]
     
     if not today_tasks:
-        await update.message.reply_text("📭 На сегодня задач нет")
+        await update.message.reply_text(stale_note(tasks) + "📭 На сегодня задач нет")
         return
     
-    text = "📋 **На сегодня:**\n\n"
+    text = stale_note(tasks) + "📋 **На сегодня:**\n\n"
     for task in today_tasks:
         text += f"• {task['name']}\n"
     
@@ -429,14 +2201,15 @@ async def track_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     task_name = " ".join(context.args) if context.args else None
     
     if not task_name:
-        # Показываем кнопки с задачами из Asana
-        tasks = get_my_tasks(limit=5)
+        # Показываем кнопки с задачами проекта в Asana (свои — первыми)
+        member = TEAM.get(f"@{user.username}") or {}
+        tasks = await asyncio.to_thread(get_project_tasks, member.get("asana_gid"), limit=5)
         if tasks:
             keyboard = []
             for task in tasks:
                 keyboard.append([InlineKeyboardButton(
                     task["name"][:40],
-                    callback_data=f"track:{task['gid']}:{task['name'][:30]}"
+                    callback_data=f"track:{put_callback_payload({'gid': task['gid'], 'name': task['name']})}"
                 )])
             keyboard.append([InlineKeyboardButton("✏️ Своё название", callback_data="track:custom")])
             
@@ -454,6 +2227,7 @@ async def track_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Начинаем сессию
     session_id = start_session(user.id, user.username, task_name)
+    schedule_session_deadlines(context.job_queue, session_id, user.id, datetime.now(MOSCOW_TZ))
     
     await update.message.reply_text(
         f"▶️ **Трекинг начат!**\n\n"
@@ -479,19 +2253,30 @@ async def track_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     parts = data.split(":", 2)
-    if len(parts) >= 3:
+    if len(parts) == 2:
+        payload = get_callback_payload(parts[1])
+        if not payload:
+            await query.edit_message_text("⌛ Кнопка устарела — набери /track ещё раз")
+            return
+        asana_id = payload["gid"]
+        task_name = payload["name"]
+    elif len(parts) == 3:
+        # Кнопки старого формата с данными прямо в callback_data
         asana_id = parts[1]
         task_name = parts[2]
-        
-        session_id = start_session(user.id, user.username, task_name, asana_id)
-        
-        await query.edit_message_text(
-            f"▶️ **Трекинг начат!**\n\n"
-            f"📌 {task_name}\n"
-            f"🕐 {datetime.now(MOSCOW_TZ).strftime('%H:%M')}\n\n"
-            f"Используй /stop когда закончишь",
-            parse_mode="Markdown"
-        )
+    else:
+        return
+    
+    session_id = start_session(user.id, user.username, task_name, asana_id)
+    schedule_session_deadlines(context.job_queue, session_id, user.id, datetime.now(MOSCOW_TZ))
+    
+    await query.edit_message_text(
+        f"▶️ **Трекинг начат!**\n\n"
+        f"📌 {task_name}\n"
+        f"🕐 {datetime.now(MOSCOW_TZ).strftime('%H:%M')}\n\n"
+        f"Используй /stop когда закончишь",
+        parse_mode="Markdown"
+    )
 
 async def stop_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /stop — остановить трекинг"""
@@ -600,52 +2385,812 @@ async def weekreport_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     await update.message.reply_text(text, parse_mode="Markdown")
 
+def format_minutes(minutes: int) -> str:
+    """125 -> '2ч 5мин', 40 -> '40 мин'"""
+    hours, mins = divmod(minutes, 60)
+    return f"{hours}ч {mins}мин" if hours else f"{mins} мин"
+
+def parse_report_range(args: list) -> tuple[str, str] | None:
+    """Аргументы /teamreport -> (date_from, date_to) в ISO
+    
+    Без аргументов — последние 7 дней, одна дата — этот день,
+    две — период включительно. Даты: YYYY-MM-DD или DD.MM.YYYY.
+    """
+    def parse(value: str):
+        for fmt in ("%Y-%m-%d", "%d.%m.%Y"):
+            try:
+                return datetime.strptime(value, fmt).date()
+            except ValueError:
+                pass
+        return None
+    
+    today = datetime.now(MOSCOW_TZ).date()
+    if not args:
+        return (today - timedelta(days=7)).isoformat(), today.isoformat()
+    
+    dates = [parse(a) for a in args[:2]]
+    if None in dates:
+        return None
+    date_from, date_to = dates[0], dates[-1]
+    if date_from > date_to:
+        date_from, date_to = date_to, date_from
+    return date_from.isoformat(), date_to.isoformat()
+
+REPORT_MAX_CHARS = 4000  # запас до лимита Telegram в 4096 символов
+
+def md(value) -> str:
+    """Пользовательский текст (ник, название задачи) для parse_mode="Markdown" """
+    return escape_markdown(str(value), version=1)
+
+def truncate_lines(text: str, limit: int = REPORT_MAX_CHARS) -> str:
+    """Обрезать по границе строки, чтобы не разорвать разметку посередине"""
+    if len(text) <= limit:
+        return text
+    cut = text.rfind("\n", 0, limit - 2)
+    return text[:cut if cut > 0 else 0] + "\n…"
+
+def render_team_report(date_from: str, date_to: str, rows: list) -> str:
+    """Текст командного отчёта из строк get_team_stats"""
+    if not rows:
+        return f"📊 За {date_from} — {date_to} нет записей"
+    
+    text = f"👥 **Отчёт команды: {date_from} — {date_to}**\n\n"
+    text += f"⏱️ Всего: **{format_minutes(rows[0]['team_total'])}**\n"
+    
+    user_id = day = None
+    for r in rows:
+        if r["user_id"] != user_id:
+            user_id, day = r["user_id"], None
+            share = 100 * r["user_total"] / r["team_total"] if r["team_total"] else 0
+            name = f"@{r['username']}" if r["username"] else str(user_id)
+            text += f"\n👤 **{md(name)}** — {format_minutes(r['user_total'])} ({share:.0f}%)\n"
+        if r["day"] != day:
+            day = r["day"]
+            day_name = datetime.strptime(day, "%Y-%m-%d").strftime("%a %d.%m")
+            text += f"  📅 {day_name}: {format_minutes(r['day_total'])}\n"
+        text += f"    • {md(r['task_name'])}: {format_minutes(r['minutes'])}\n"
+    
+    return truncate_lines(text)
+
+async def teamreport_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /teamreport [с] [по] — отчёт по всей команде (только админы)"""
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("⛔ Нет доступа")
+        return
+    
+    date_range = parse_report_range(context.args or [])
+    if not date_range:
+        await update.message.reply_text(
+            "❓ Формат: `/teamreport 2024-09-01 2024-09-30`",
+            parse_mode="Markdown"
+        )
+        return
+    
+    date_from, date_to = date_range
+    text = get_cached_team_report(date_from, date_to)
+    if text is None:
+        built_at = time.time()
+        text = render_team_report(date_from, date_to, get_team_stats(date_from, date_to))
+        cache_team_report(date_from, date_to, text, built_at)
+    
+    await update.message.reply_text(text, parse_mode="Markdown")
+
+WORK_MINUTES_PER_DAY = 8 * 60  # норма для загрузки
+HEATMAP_LEVELS = " ░▒▓█"
+
+def working_days(date_from: str, date_to: str) -> int:
+    start, end = datetime.fromisoformat(date_from).date(), datetime.fromisoformat(date_to).date()
+    return sum(1 for i in range((end - start).days + 1) if (start + timedelta(days=i)).weekday() < 5)
+
+def year_trend(now: int, before: int) -> str:
+    if not before:
+        return "🆕" if now else ""
+    change = 100 * (now - before) / before
+    return f"{'▲' if change >= 0 else '▼'} {change:+.0f}%"
+
+def render_analytics(date_from: str, date_to: str, stats: dict, users: dict) -> str:
+    """Текст /analytics из snapshot_analytics"""
+    if not stats["total"]:
+        return f"📈 За {date_from} — {date_to} нет записей"
+    
+    norm = max(1, working_days(date_from, date_to)) * WORK_MINUTES_PER_DAY
+    text = f"📈 **Аналитика: {date_from} — {date_to}**\n"
+    text += "_динамика — к тому же периоду годом раньше_\n\n"
+    text += f"⏱️ Всего: **{format_minutes(stats['total'])}**\n"
+    
+    text += f"\n👥 **Загрузка** (норма {format_minutes(norm)}):\n"
+    for user_id, (now, before) in sorted(stats["users"].items(), key=lambda item: -item[1][0]):
+        name = f"@{md(users[user_id])}" if user_id in users else str(user_id)
+        text += f"• {name}: {format_minutes(now)} ({100 * now / norm:.0f}%) {year_trend(now, before)}\n"
+    
+    text += "\n📌 **Задачи:**\n"
+    for task, (now, before) in sorted(stats["tasks"].items(), key=lambda item: -item[1][0])[:10]:
+        if now:
+            text += f"• {md(task[:50])}: {format_minutes(now)} {year_trend(now, before)}\n"
+    
+    # 7 × 8: дни недели × трёхчасовые интервалы по часу начала сессии
+    buckets = stats["heatmap"].reshape(7, 8, 3).sum(axis=2)
+    peak = buckets.max() or 1
+    text += "\n🕘 **Когда работаем** (МСК):\n```\n    00 03 06 09 12 15 18 21\n"
+    for day, row in zip(("Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"), buckets):
+        text += f"{day}  " + " ".join(HEATMAP_LEVELS[math.ceil(4 * value / peak)] * 2 for value in row) + "\n"
+    text += "```"
+    return text
+
+async def analytics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /analytics [с] [по] — загрузка, задачи и часы работы с динамикой год к году (только админы)
+    
+    Без дат — последние 365 дней. Считается по колоночному снимку сессий.
+    """
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("⛔ Нет доступа")
+        return
+    
+    if context.args:
+        date_range = parse_report_range(context.args)
+    else:
+        today = datetime.now(MOSCOW_TZ).date()
+        date_range = ((today - timedelta(days=364)).isoformat(), today.isoformat())
+    if not date_range:
+        await update.message.reply_text(
+            "❓ Формат: `/analytics 2025-01-01 2025-12-31`",
+            parse_mode="Markdown"
+        )
+        return
+    
+    date_from, date_to = date_range
+    await asyncio.to_thread(refresh_snapshot)
+    snap = SessionSnapshot.open()
+    stats = await asyncio.to_thread(snapshot_analytics, snap, date_from, date_to)
+    await update.message.reply_text(render_analytics(date_from, date_to, stats, snap.users), parse_mode="Markdown")
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /export [csv|json] [с] [по] — выгрузка сессий файлом (только админы)
+    
+    Без дат выгружается прошлый календарный месяц.
+    """
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("⛔ Нет доступа")
+        return
+    
+    args = list(context.args or [])
+    fmt = "csv"
+    if args and args[0].lower() in ("csv", "json"):
+        fmt = args.pop(0).lower()
+    
+    if args:
+        date_range = parse_report_range(args)
+    else:
+        month_start = datetime.now(MOSCOW_TZ).date().replace(day=1)
+        prev_month_end = month_start - timedelta(days=1)
+        date_range = (prev_month_end.replace(day=1).isoformat(), prev_month_end.isoformat())
+    if not date_range:
+        await update.message.reply_text(
+            "❓ Формат: `/export csv 2024-09-01 2024-09-30`",
+            parse_mode="Markdown"
+        )
+        return
+    
+    date_from, date_to = date_range
+    ext = "csv" if fmt == "csv" else "ndjson"
+    
+    with ExitStack() as stack:
+        parts = []
+        
+        def new_part():
+            parts.append(stack.enter_context(tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)))
+            return parts[-1]
+        
+        # Чтение базы и сжатие — в потоке, чтобы не останавливать цикл событий
+        counts = await asyncio.to_thread(write_sessions_export, new_part, fmt, date_from, date_to)
+        if not counts:
+            await update.message.reply_text(f"📭 За {date_from} — {date_to} нет записей")
+            return
+        
+        for i, (buf, count) in enumerate(zip(parts, counts), 1):
+            suffix = f".part{i}" if len(parts) > 1 else ""
+            caption = f"📦 Сессии {date_from} — {date_to}: {count} строк"
+            if len(parts) > 1:
+                caption += f" (часть {i} из {len(parts)})"
+            buf.seek(0)
+            await update.message.reply_document(
+                document=buf,
+                filename=f"time_sessions_{date_from}_{date_to}{suffix}.{ext}.gz",
+                caption=caption
+            )
+
+async def health_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /health — состояние предохранителей внешних API (только админы)"""
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("⛔ Нет доступа")
+        return
+    
+    icons = {CircuitBreaker.CLOSED: "🟢", CircuitBreaker.HALF_OPEN: "🟡", CircuitBreaker.OPEN: "🔴"}
+    text = "🩺 Внешние API:\n\n"
+    for name, breaker in BREAKERS.items():
+        s = breaker.snapshot()
+        text += f"{icons[s['state']]} {name}: {s['state']}"
+        if s["state"] == CircuitBreaker.OPEN:
+            text += f", проба через {s['retry_in']} с"
+        text += f"\n   ошибок подряд: {s['failures']}, отклонено: {s['rejected']}\n"
+    text += f"\n💾 Кэш ответов Asana: {len(_asana_fallback)}"
+    if _asana_receiver_started:
+        if _asana_last_delivery:
+            ago = round((time.time() - _asana_last_delivery) / 60)
+            text += f"\n🔔 Вебхук Asana: последние события {ago} мин назад"
+            text += ", кэш действует" if asana_events_live() else ", молчит — кэш только запасной"
+        else:
+            text += "\n🔔 Вебхук Asana: событий ещё не было"
+    await update.message.reply_text(text)
+
+# ═══════════════════════════════════════════════════════════════
+# ЗАБЫТЫЕ СЕССИИ: НАПОМИНАНИЕ И АВТОСТОП
+# ═══════════════════════════════════════════════════════════════
+
+# Мин-куча дедлайнов (timestamp, session_id, user_id, kind); kind — "remind" / "autostop".
+# Одна задача job_queue просыпается к ближайшему дедлайну. Остановленные вручную
+# сессии из кучи не удаляются — при срабатывании проверяется, что сессия ещё активна.
+_session_deadlines: list[tuple[float, int, int, str]] = []
+_deadline_job = None
+_deadline_job_at = None
+
+AUTOSTOP_NOTE = "⏹️ автостоп: сессия забыта"
+
+def schedule_session_deadlines(job_queue, session_id: int, user_id: int, started_at: datetime):
+    """Поставить напоминание и автостоп для новой или восстановленной сессии"""
+    start_ts = started_at.timestamp()
+    now_ts = datetime.now(MOSCOW_TZ).timestamp()
+    if SESSION_REMIND_MINUTES and start_ts + SESSION_REMIND_MINUTES * 60 > now_ts:
+        heapq.heappush(_session_deadlines, (start_ts + SESSION_REMIND_MINUTES * 60, session_id, user_id, "remind"))
+    if SESSION_AUTOSTOP_MINUTES:
+        heapq.heappush(_session_deadlines, (start_ts + SESSION_AUTOSTOP_MINUTES * 60, session_id, user_id, "autostop"))
+    arm_deadline_job(job_queue)
+
+def arm_deadline_job(job_queue):
+    """Перезапланировать пробуждение на ближайший дедлайн, если он раньше текущего"""
+    global _deadline_job, _deadline_job_at
+    if not _session_deadlines:
+        return
+    
+    next_ts = _session_deadlines[0][0]
+    if _deadline_job is not None:
+        if _deadline_job_at <= next_ts:
+            return
+        _deadline_job.schedule_removal()
+    
+    delay = max(0.0, next_ts - datetime.now(MOSCOW_TZ).timestamp())
+    _deadline_job = job_queue.run_once(process_session_deadlines, when=delay, name="session_deadlines")
+    _deadline_job_at = next_ts
+
+def rebuild_session_deadlines(job_queue):
+    """При старте восстановить кучу из открытых сессий в БД"""
+    _session_deadlines.clear()
+    sessions = get_open_sessions()
+    for session in sessions:
+        schedule_session_deadlines(job_queue, session["id"], session["user_id"], session["started_at"])
+    if sessions:
+        logger.info(f"⏰ Восстановлены дедлайны для открытых сессий: {len(sessions)}")
+
+async def process_session_deadlines(context: ContextTypes.DEFAULT_TYPE):
+    """Обработать все наступившие дедлайны и заснуть до следующего"""
+    global _deadline_job, _deadline_job_at
+    _deadline_job = _deadline_job_at = None
+    
+    now_ts = datetime.now(MOSCOW_TZ).timestamp()
+    while _session_deadlines and _session_deadlines[0][0] <= now_ts:
+        deadline_ts, session_id, user_id, kind = heapq.heappop(_session_deadlines)
+        active = get_active_session(user_id)
+        if not active or active["id"] != session_id:
+            continue
+        
+        try:
+            if kind == "remind":
+                await context.bot.send_message(
+                    user_id,
+                    f"⏰ Трекинг идёт уже {format_minutes(SESSION_REMIND_MINUTES)}:\n\n"
+                    f"📌 {active['task_name']}\n\n"
+                    f"Не забыл /stop?"
+                )
+            else:
+                deadline = datetime.fromtimestamp(deadline_ts, MOSCOW_TZ)
+                result = stop_session(user_id, AUTOSTOP_NOTE, ended_at=deadline)
+                if result:
+                    await context.bot.send_message(
+                        user_id,
+                        f"⏹️ Трекинг остановлен автоматически:\n\n"
+                        f"📌 {result['task_name']}\n"
+                        f"⏱️ {format_minutes(result['duration_minutes'])}\n"
+                        f"🕐 {result['started_at'].strftime('%H:%M')} → {result['ended_at'].strftime('%H:%M')}"
+                    )
+        except Exception as e:
+            logger.error(f"Session deadline error: {e}")
+    
+    arm_deadline_job(context.job_queue)
+
 # ═══════════════════════════════════════════════════════════════
 # ГОЛОСОВЫЕ СООБЩЕНИЯ
 # ═══════════════════════════════════════════════════════════════
 
+def transcribe_file(path: str) -> str:
+    """Whisper: аудиофайл → текст (блокирующий вызов)"""
+    breaker = BREAKERS["openai"]
+    if not breaker.allow():
+        raise UpstreamUnavailable("OpenAI")
+    with span("openai.whisper", SPAN_KIND_CLIENT, file_bytes=os.path.getsize(path)), open(path, "rb") as audio_file:
+        try:
+            transcript = get_openai_client().audio.transcriptions.create(
+                model="whisper-1",
+                file=audio_file,
+                language="ru"
+            )
+        except Exception as e:
+            # APIStatusError несёт status_code; сеть и таймауты — без него
+            breaker.record(getattr(e, "status_code", None))
+            raise
+    breaker.success()
+    return transcript.text
+
+# Длинная диктовка (5–10 минут) одним запросом — долгое молчание бота. Вместо
+# этого: ffmpeg silencedetect → разрезы в паузах около каждых VOICE_SEGMENT_SECONDS
+# → куски параллельно в Whisper → склейка по порядку. По мере готовности
+# сообщение «🎤 Распознаю...» дополняется уже распознанным началом текста.
+# Если ffmpeg не справился, файл уходит в Whisper целиком, как короткий.
+
+SILENCE_RE = re.compile(r"silence_(start|end): (-?[\d.]+)")
+VOICE_PROGRESS_INTERVAL = 2.0  # сек между правками сообщения (лимиты Telegram)
+
+async def run_ffmpeg(*args: str) -> str:
+    """ffmpeg с аргументами; возвращает stderr (туда пишут фильтры вроде silencedetect)"""
+    proc = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-hide_banner", "-nostdin", *args,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+    )
+    _, stderr = await proc.communicate()
+    if proc.returncode:
+        raise RuntimeError(f"ffmpeg exited with {proc.returncode}: {stderr.decode(errors='replace')[-300:]}")
+    return stderr.decode(errors="replace")
+
+async def detect_silences(path: str) -> list:
+    """Середины пауз (сек от начала файла)"""
+    with span("ffmpeg.silencedetect"):
+        output = await run_ffmpeg("-i", path, "-af", "silencedetect=noise=-35dB:d=0.4", "-f", "null", "-")
+    midpoints, start = [], None
+    for kind, value in SILENCE_RE.findall(output):
+        if kind == "start":
+            start = max(0.0, float(value))
+        elif start is not None:
+            midpoints.append((start + float(value)) / 2)
+            start = None
+    return midpoints
+
+def plan_cuts(silences: list, duration: float, target: float = VOICE_SEGMENT_SECONDS) -> list:
+    """Точки разреза: пауза, ближайшая к очередным target секундам
+
+    Пауза ищется в окне ±target/2; если её нет — режем ровно по target.
+    Хвост короче 1.5·target не отделяется.
+    """
+    cuts, last = [], 0.0
+    while duration - last > target * 1.5:
+        goal = last + target
+        window = [s for s in silences if goal - target / 2 <= s <= goal + target / 2]
+        cut = min(window, key=lambda s: abs(s - goal)) if window else goal
+        cuts.append(cut)
+        last = cut
+    return cuts
+
+async def split_audio(path: str, cuts: list, out_dir: str) -> list:
+    """Нарезать файл по точкам cuts без перекодирования; пути кусков по порядку"""
+    with span("ffmpeg.segment", segments=len(cuts) + 1):
+        await run_ffmpeg(
+            "-v", "error", "-i", path, "-f", "segment",
+            "-segment_times", ",".join(f"{c:.2f}" for c in cuts),
+            "-reset_timestamps", "1", "-c", "copy",
+            os.path.join(out_dir, "seg_%03d.ogg")
+        )
+    return sorted(str(p) for p in Path(out_dir).glob("seg_*.ogg"))
+
+async def transcribe_segments(paths: list, on_progress=None, transcribe=transcribe_file,
+                              concurrency: int = VOICE_SEGMENT_CONCURRENCY) -> str:
+    """Распознать куски параллельно (не больше concurrency сразу) и склеить по порядку
+
+    on_progress(готово, всего, текст_начала) вызывается по мере готовности кусков;
+    текст_начала — склейка непрерывного готового префикса. transcribe — функция
+    «путь → текст» (блокирующая, выполняется в потоке).
+    
+    Если предохранитель OpenAI не замкнут (сервис восстанавливается), сначала
+    уходит один первый кусок: в half-open пропускается ровно один пробный
+    запрос, и параллельные куски отбились бы, не дойдя до Whisper.
+    """
+    texts = [None] * len(paths)
+    semaphore = asyncio.Semaphore(concurrency)
+    done = 0
+    failed = False
+    
+    async def run(i: int, path: str):
+        nonlocal done, failed
+        async with semaphore:
+            if failed:
+                return  # голосовое уже не распознать — не тратить запросы на остальные куски
+            try:
+                texts[i] = (await asyncio.to_thread(transcribe, path)).strip()
+            except Exception:
+                failed = True
+                raise
+        done += 1
+        if on_progress:
+            prefix = []
+            for text in texts:
+                if text is None:
+                    break
+                prefix.append(text)
+            await on_progress(done, len(paths), " ".join(t for t in prefix if t))
+    
+    start = 0
+    if paths and BREAKERS["openai"].state != CircuitBreaker.CLOSED:
+        await run(0, paths[0])
+        start = 1
+    
+    try:
+        async with asyncio.TaskGroup() as group:
+            for i in range(start, len(paths)):
+                group.create_task(run(i, paths[i]))
+    except ExceptionGroup as eg:
+        # Остальные куски отменены; наружу — как ошибка одного запроса
+        raise eg.exceptions[0]
+    return " ".join(t for t in texts if t)
+
+async def transcribe_voice(path: str, duration: float, on_progress=None) -> str:
+    """Голосовое → текст: короткие — одним запросом, длинные — кусками по паузам"""
+    if duration <= VOICE_SEGMENT_SECONDS * 1.5 or not shutil.which("ffmpeg"):
+        return await asyncio.to_thread(transcribe_file, path)
+    
+    with tempfile.TemporaryDirectory(prefix="voice_") as out_dir:
+        try:
+            cuts = plan_cuts(await detect_silences(path), duration)
+            paths = await split_audio(path, cuts, out_dir)
+        except (RuntimeError, OSError) as e:
+            paths = []
+            logger.warning(f"ffmpeg не смог нарезать голосовое, распознаю целиком: {e}")
+        if not paths:
+            return await asyncio.to_thread(transcribe_file, path)
+        logger.info(f"🎤 Голосовое {duration:.0f} с → {len(paths)} кусков")
+        return await transcribe_segments(paths, on_progress)
+
+# «Принял [задачу]» / «Готово [задача]» → (действие, фраза для поиска задачи)
+LIFECYCLE_RE = re.compile(
+    r"^\s*(?:(?P<accept>принял[аи]?|беру)|(?P<done>готово|сделал[аи]?|выполнил[аи]?))[\s,.:!\-]+(?P<query>.+)",
+    re.IGNORECASE | re.DOTALL
+)
+
+def parse_lifecycle_command(text: str) -> tuple[str, str] | None:
+    match = LIFECYCLE_RE.match(text)
+    if not match:
+        return None
+    action = "accept" if match.group("accept") else "done"
+    return action, match.group("query").strip(" .!?")
+
+async def reply_lifecycle_matches(update: Update, action: str, query_text: str) -> bool:
+    """Предложить найденные задачи для «Принял»/«Готово». False — ничего не нашлось"""
+    tasks = await asyncio.to_thread(find_tasks, query_text)
+    if not tasks:
+        return False
+    
+    keyboard = []
+    for task in tasks:
+        token = put_callback_payload({"gid": task["gid"], "name": task["name"]})
+        if action == "accept":
+            keyboard.append([InlineKeyboardButton(f"▶️ {task['name'][:40]}", callback_data=f"track:{token}")])
+        else:
+            keyboard.append([InlineKeyboardButton(f"✅ {task['name'][:40]}", callback_data=f"task_done:{token}")])
+    keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data="voice_cancel")])
+    
+    title = "▶️ Начать трекинг по задаче:" if action == "accept" else "✅ Закрыть задачу в Asana:"
+    await update.message.reply_text(
+        f"🔎 «{query_text}»\n\n{title}",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+    return True
+
+async def task_done_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Закрыть задачу, выбранную по голосовому «Готово …»"""
+    query = update.callback_query
+    await query.answer()
+    
+    payload = get_callback_payload(query.data.replace("task_done:", ""))
+    if not payload:
+        await query.edit_message_text("⌛ Кнопка устарела — отправь голосовое ещё раз")
+        return
+    
+    result = await asyncio.to_thread(asana_request, "PUT", f"/tasks/{payload['gid']}", {"completed": True})
+    if result:
+        mark_task_completed(payload["gid"])
+        # Свой PUT события вебхука догонят не сразу — кэш правится тут же
+        patch_cached_task({"gid": payload["gid"], "completed": True})
+        forget_cached_lists("assignee", "project")
+        await query.edit_message_text(f"✅ Задача закрыта:\n\n{payload['name']}")
+    else:
+        await query.edit_message_text("❌ Не удалось закрыть задачу")
+
+# Диктовка с планёрки → несколько задач: «надо X, потом Y до пятницы для @mig555555».
+# Расшифровка режется на фразы по знакам препинания и связкам («потом», «ещё»,
+# «надо»), в каждой ищутся исполнитель (ник из TEAM или имя) и срок; фраза из
+# одного срока/исполнителя («До пятницы.») относится к предыдущей задаче.
+DICTATION_MAX_TASKS = 20
+DICTATION_SPLIT_RE = re.compile(
+    r"[.;!?…]+(?=\s|$)\s*|\n+"
+    r"|(?:,\s*|\s+)(?:а\s+|и\s+)?(?:потом|затем|после этого|дальше)\s+"
+    r"|(?:,\s*(?:а\s+|и\s+)?|\s+и\s+)(?:ещё|еще|также|плюс)\s+"
+    r"|,\s*(?=(?:надо|нужно|необходимо)\s)"
+    r"|\b(?:во-первых|во-вторых|в-третьих|в-четв[её]ртых|в-пятых)\b[,:]?\s*",
+    re.IGNORECASE
+)
+TASK_LEAD_VERB = (r"(?:(?:мне|нам|тебе)\s+)?"
+                  r"(?:надо|нужно|необходимо|давай(?:те)?|создай(?:те)?\s+задачу|новая\s+задача|задача)\b[\s,:\-]*")
+# «Ещё проверить…» после точки — связка осталась в начале фразы, а не перед запятой
+TASK_LEAD_RE = re.compile(
+    r"^(?:(?:и|а|так|ну)\s+)?"
+    rf"(?:(?:ещё|еще|также|плюс)\b[\s,:\-]*(?:{TASK_LEAD_VERB})?|{TASK_LEAD_VERB})",
+    re.IGNORECASE
+)
+MONTHS_RU = ("января", "февраля", "марта", "апреля", "мая", "июня",
+             "июля", "августа", "сентября", "октября", "ноября", "декабря")
+WEEKDAYS_RU = ("пон", "вто", "сре", "чет", "пят", "суб", "вос")
+# «25.10» — срок только после «до»/«к»: иначе это «версия 3.5»
+DUE_RE = re.compile(
+    r"(?:\b(?:до|к|ко|в|во|на|не позже|не позднее)\s+)?(?:"
+    r"(?P<rel>сегодня|завтра|послезавтра)"
+    r"|(?P<weekday>понедельник[аеу]?|вторник[аеу]?|сред[аеуы]|четверг[аеу]?|пятниц[аеуы]|суббот[аеуы]|воскресень[еяю])"
+    r"|(?:конц[аеу]|конец)\s+(?P<week_end>недели)"
+    r"|через\s+(?:(?P<in_n>\d+)\s+)?(?P<in_unit>день|дн[яей]|недел[юиь])"
+    r"|(?P<day>\d{1,2})(?:-?го)?\s+(?P<month_name>" + "|".join(MONTHS_RU) + r")"
+    r")\b"
+    r"|\b(?:до|к|ко|не позже|не позднее)\s+(?P<dm_day>\d{1,2})\.(?P<dm_month>\d{1,2})(?:\.(?P<dm_year>\d{2,4}))?\b",
+    re.IGNORECASE
+)
+
+def name_pattern(name: str) -> str:
+    """Имя в падежах исполнителя: Антон / для Антона / Антону, Андрей / Андрея / Андрею
+    
+    Творительный и предложный («с Антоном», «об Андрее») — упоминание, не поручение.
+    """
+    if re.fullmatch(r"[а-яё]+й", name, re.IGNORECASE):
+        return re.escape(name[:-1]) + "(?:й|я|ю)"
+    if re.fullmatch(r"[а-яё]*[бвгджзклмнпрстфхцчшщ]", name, re.IGNORECASE):
+        return re.escape(name) + "(?:а|у)?"
+    return re.escape(name)
+
+def member_names(member: dict) -> list[str]:
+    return [name_pattern(name) for name in (member["name"], *member.get("spoken", ()))]
+
+def assignee_re() -> re.Pattern:
+    """Исполнитель: ник из TEAM (@mig555555) или имя («для Mig», «Антону»)"""
+    handles = "|".join(re.escape(h.lstrip("@")) for h in TEAM)
+    names = "|".join(name for m in TEAM.values() for name in member_names(m))
+    return re.compile(
+        rf"(?:\b(?:для|на|поручить|исполнитель)\s+)?(?:@(?P<handle>{handles})\b|\b(?P<name>{names})\b)",
+        re.IGNORECASE
+    )
+
+ASSIGNEE_RE = assignee_re()
+# Остаток фразы из одних таких слов — не задача, а уточнение предыдущей (или обращение)
+DICTATION_FILLERS = {"это", "эта", "этот", "эти", "тоже", "всё", "все", "так", "ок", "ладно", "её", "его",
+                     "итак", "короче", "кстати", "коллеги", "ребята", "друзья", "народ", "слушайте"}
+# Обращение в начале предложения перед «надо/нужно»: «Антон, нужно сделать отчёт».
+# Без него запятая отрезала бы имя в отдельную «задачу»; имя из TEAM остаётся
+# исполнителем этой фразы, чужое обращение выбрасывается.
+DICTATION_ADDRESS_RE = re.compile(
+    r"(?:^|(?<=[.;!?…\n]))(?P<lead>\s*)(?P<who>[^\W\d_]+),\s*(?=(?:надо|нужно|необходимо)\s)",
+    re.IGNORECASE
+)
+
+def parse_due(text: str, today) -> tuple[str | None, str]:
+    """Срок из фразы: (дата ISO или None, фраза без него)"""
+    match = DUE_RE.search(text)
+    if not match:
+        return None, text
+    g = match.groupdict()
+    if g["rel"]:
+        due = today + timedelta(days=("сегодня", "завтра", "послезавтра").index(g["rel"].lower()))
+    elif g["weekday"] or g["week_end"]:
+        weekday = WEEKDAYS_RU.index(g["weekday"][:3].lower()) if g["weekday"] else 4
+        due = today + timedelta(days=(weekday - today.weekday()) % 7)
+    elif g["in_unit"]:
+        n = int(g["in_n"] or 1)
+        due = today + timedelta(days=n * 7 if g["in_unit"].lower().startswith("недел") else n)
+    else:
+        day = int(g["day"] or g["dm_day"])
+        month = MONTHS_RU.index(g["month_name"].lower()) + 1 if g["month_name"] else int(g["dm_month"])
+        year = int(g["dm_year"]) if g["dm_year"] else today.year
+        try:
+            due = datetime(year + 2000 if year < 100 else year, month, day).date()
+        except ValueError:
+            return None, text
+        if not g["dm_year"] and due < today:
+            due = due.replace(year=due.year + 1)
+    return due.isoformat(), text[:match.start()] + text[match.end():]
+
+def parse_assignee(text: str) -> tuple[str | None, str]:
+    """Исполнитель из фразы: (ник из TEAM или None, фраза без него)"""
+    match = ASSIGNEE_RE.search(text)
+    if not match:
+        return None, text
+    if match.group("handle"):
+        handle = next(h for h in TEAM if h.lstrip("@").lower() == match.group("handle").lower())
+    else:
+        handle = next(h for h, m in TEAM.items()
+                      if any(re.fullmatch(name, match.group("name"), re.IGNORECASE) for name in member_names(m)))
+    return handle, text[:match.start()] + text[match.end():]
+
+def split_dictation(text: str, today=None) -> list[dict]:
+    """Расшифровка → кандидаты в задачи [{"name", "assignee", "due_on"}]"""
+    today = today or datetime.now(MOSCOW_TZ).date()
+    candidates = []
+    text = DICTATION_ADDRESS_RE.sub(
+        lambda m: m["lead"] + (m["who"] + " " if ASSIGNEE_RE.fullmatch(m["who"]) else ""), text)
+    for phrase in DICTATION_SPLIT_RE.split(text):
+        due_on, rest = parse_due(phrase, today)
+        assignee, rest = parse_assignee(rest)
+        name = TASK_LEAD_RE.sub("", re.sub(r"\s+", " ", rest).strip(" ,.:;-—")).strip(" ,.:;-—")
+        if len(re.findall(r"\w", name)) < 3 or set(WORD_RE.findall(name.lower())) <= DICTATION_FILLERS:
+            # «До пятницы.», «Это для @mig555555.» — уточнение предыдущей задачи
+            if candidates:
+                candidates[-1]["due_on"] = candidates[-1]["due_on"] or due_on
+                candidates[-1]["assignee"] = candidates[-1]["assignee"] or assignee
+            continue
+        candidates.append({"name": name[0].upper() + name[1:], "assignee": assignee, "due_on": due_on})
+    return candidates[:DICTATION_MAX_TASKS]
+
+def task_title(text: str) -> tuple[str, str | None]:
+    """Название задачи (до 100 символов) и полный текст для описания, если не влез"""
+    if len(text) <= 100:
+        return text, None
+    return text[:100].rsplit(" ", 1)[0] + "…", text
+
+def describe_candidate(candidate: dict) -> str:
+    details = [candidate["assignee"]] if candidate["assignee"] else []
+    if candidate["due_on"]:
+        details.append("до " + datetime.fromisoformat(candidate["due_on"]).strftime("%d.%m"))
+    return candidate["name"] + (f" — {', '.join(details)}" if details else "")
+
+def asana_task_data(candidate: dict) -> dict:
+    """Тело POST /tasks для кандидата из диктовки"""
+    name, notes = task_title(candidate["name"])
+    data = {"name": name, "projects": [ASANA_PROJECT], "workspace": ASANA_WORKSPACE}
+    notes = [notes] if notes else []
+    if candidate["due_on"]:
+        data["due_on"] = candidate["due_on"]
+    if candidate["assignee"]:
+        gid = TEAM[candidate["assignee"]]["asana_gid"]
+        if gid:
+            data["assignee"] = gid
+        else:
+            notes.append(f"Исполнитель: {candidate['assignee']}")
+    if notes:
+        data["notes"] = "\n\n".join(notes)
+    return data
+
+def create_tasks_batch(candidates: list) -> list:
+    """Создать задачи через /batch — по ASANA_BATCH_SIZE за запрос
+    
+    Возвращает [(кандидат, gid или None, ошибка или None)] в том же порядке.
+    """
+    results = []
+    for i in range(0, len(candidates), ASANA_BATCH_SIZE):
+        chunk = candidates[i:i + ASANA_BATCH_SIZE]
+        actions = [{"method": "post", "relative_path": "/tasks", "data": asana_task_data(c)} for c in chunk]
+        responses = asana_request("POST", "/batch", {"actions": actions})
+        if not isinstance(responses, list):
+            results += [(c, None, "Asana недоступна") for c in chunk]
+            continue
+        for candidate, resp in zip(chunk, responses):
+            status = resp.get("status_code", 0)
+            body = resp.get("body") or {}
+            if 200 <= status < 300:
+                results.append((candidate, body.get("data", {}).get("gid"), None))
+            else:
+                errors = body.get("errors") or [{}]
+                results.append((candidate, None, f"{status}: {errors[0].get('message', '')}"[:200]))
+    
+    created = [{"gid": gid, "name": asana_task_data(c)["name"], "completed": False} for c, gid, _ in results if gid]
+    if created:
+        # Новые задачи сразу находятся голосом и видны в /tasks
+        index_tasks(created)
+        forget_cached_lists(*ASANA_NEW_TASK_LISTS)
+    return results
+
+async def reply_dictated_tasks(update: Update, text: str, candidates: list):
+    """Показать задачи из диктовки и спросить подтверждение одной кнопкой"""
+    lines = "\n".join(f"{i}. {describe_candidate(c)}" for i, c in enumerate(candidates, 1))
+    await update.message.reply_text(
+        f"📝 Распознано:\n\n_{text}_\n\n"
+        f"Задачи ({len(candidates)}):\n{lines}\n\n"
+        f"Создать?",
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton(f"✅ Создать все ({len(candidates)})", callback_data=f"voice_tasks:{put_callback_payload({'tasks': candidates})}")],
+            [InlineKeyboardButton("📝 Одной задачей", callback_data=f"voice_task:{put_callback_payload({'text': text})}")],
+            [InlineKeyboardButton("❌ Отмена", callback_data="voice_cancel")]
+        ])
+    )
+
+async def voice_tasks_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Создать все задачи из диктовки одним /batch"""
+    query = update.callback_query
+    await query.answer()
+    
+    # Забираем до /batch: второе нажатие не создаст те же задачи ещё раз
+    payload = take_callback_payload(query.data.replace("voice_tasks:", ""))
+    if not payload:
+        await query.edit_message_text("⌛ Кнопка устарела — отправь голосовое ещё раз")
+        return
+    
+    await query.edit_message_text(f"⏳ Создаю задачи: {len(payload['tasks'])}...")
+    results = await asyncio.to_thread(create_tasks_batch, payload["tasks"])
+    created = [describe_candidate(c) for c, gid, _ in results if gid]
+    failed = [f"{describe_candidate(c)}: {error}" for c, gid, error in results if not gid]
+    
+    text = f"✅ Создано задач: {len(created)} из {len(results)}\n\n" + "\n".join(f"• {line}" for line in created)
+    if failed:
+        text += "\n\n❌ Не созданы:\n" + "\n".join(f"• {line}" for line in failed)
+    await query.edit_message_text(text)
+
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка голосовых сообщений"""
     if not OPENAI_API_KEY:
         await update.message.reply_text("⚠️ OpenAI API не настроен")
         return
     
-    await update.message.reply_text("🎤 Распознаю...")
+    status = await update.message.reply_text("🎤 Распознаю...")
+    last_edit = 0.0
     
+    async def show_progress(done: int, total: int, text: str):
+        nonlocal last_edit
+        if done < total and time.monotonic() - last_edit < VOICE_PROGRESS_INTERVAL:
+            return
+        last_edit = time.monotonic()
+        preview = text if len(text) < 3500 else "…" + text[-3500:]
+        try:
+            await status.edit_text(f"🎤 Распознаю... {done}/{total}\n\n{preview}".rstrip())
+        except Exception as e:
+            logger.debug(f"Voice progress edit failed: {e}")
+    
+    voice_path = f"/tmp/voice_{update.message.message_id}.ogg"
     try:
         # Скачиваем голосовое
         voice = update.message.voice
         file = await context.bot.get_file(voice.file_id)
-        
-        # Временный файл
-        voice_path = f"/tmp/voice_{update.message.message_id}.ogg"
         await file.download_to_drive(voice_path)
         
-        # Распознаём через Whisper
-        client = openai.OpenAI(api_key=OPENAI_API_KEY)
-        with open(voice_path, "rb") as audio_file:
-            transcript = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file,
-                language="ru"
-            )
+        # Распознаём через Whisper (в потоке — не блокируем остальные апдейты)
+        text = await transcribe_voice(voice_path, voice.duration or 0, show_progress)
         
-        text = transcript.text
-        os.remove(voice_path)
+        lifecycle = parse_lifecycle_command(text)
+        if lifecycle and await reply_lifecycle_matches(update, *lifecycle):
+            return
+        
+        candidates = split_dictation(text)
+        if len(candidates) > 1 or any(c["assignee"] or c["due_on"] for c in candidates):
+            await reply_dictated_tasks(update, text, candidates)
+            return
         
         await update.message.reply_text(
             f"📝 Распознано:\n\n_{text}_\n\n"
             f"Создать задачу?",
             parse_mode="Markdown",
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("✅ Создать", callback_data=f"voice_task:{text[:100]}")],
+                [InlineKeyboardButton("✅ Создать", callback_data=f"voice_task:{put_callback_payload({'text': text})}")],
                 [InlineKeyboardButton("❌ Отмена", callback_data="voice_cancel")]
             ])
         )
         
+    except UpstreamUnavailable as e:
+        await update.message.reply_text(f"⚠️ {e}")
     except Exception as e:
         logger.error(f"Voice error: {e}")
         await update.message.reply_text(f"❌ Ошибка: {e}")
+    finally:
+        if os.path.exists(voice_path):
+            os.remove(voice_path)
 
 async def voice_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка создания задачи из голоса"""
@@ -656,16 +3201,30 @@ async def voice_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("❌ Отменено")
         return
     
-    task_name = query.data.replace("voice_task:", "")
-    
-    # Создаём задачу в Asana
-    result = asana_request("POST", "/tasks", {
+    value = query.data.replace("voice_task:", "")
+    payload = get_callback_payload(value)
+    if not payload:
+        if CALLBACK_TOKEN_RE.fullmatch(value):
+            await query.edit_message_text("⌛ Кнопка устарела — отправь голосовое ещё раз")
+            return
+        # Кнопка старого формата: текст расшифровки прямо в callback_data
+        payload = {"text": value}
+    
+    # Полная расшифровка уходит в описание, если не влезает в название
+    task_name, notes = task_title(payload["text"])
+    task_data = {
         "name": task_name,
         "projects": [ASANA_PROJECT],
         "workspace": ASANA_WORKSPACE
-    })
+    }
+    if notes:
+        task_data["notes"] = notes
+    
+    # Создаём задачу в Asana
+    result = await asyncio.to_thread(asana_request, "POST", "/tasks", task_data)
     
     if result:
+        forget_cached_lists(*ASANA_NEW_TASK_LISTS)
         await query.edit_message_text(f"✅ Задача создана:\n\n**{task_name}**", parse_mode="Markdown")
     else:
         await query.edit_message_text(f"❌ Ошибка создания задачи")
@@ -678,12 +3237,12 @@ async def daily_notification(context: ContextTypes.DEFAULT_TYPE):
     """Ежедневное уведомление с планом"""
     for admin_id in ADMIN_IDS:
         try:
-            tasks = get_my_tasks(limit=10)
+            tasks = await asyncio.to_thread(get_my_tasks, limit=10)
             today = datetime.now(MOSCOW_TZ).strftime("%Y-%m-%d")
             today_tasks = [t for t in tasks if t.get("due_on") == today]
-            overdue = get_overdue_tasks()
+            overdue = await asyncio.to_thread(get_overdue_tasks)
             
-            text = f"☀️ **Доброе утро!**\n\n"
+            text = stale_note(tasks) + f"☀️ **Доброе утро!**\n\n"
             text += f"📅 {datetime.now(MOSCOW_TZ).strftime('%d.%m.%Y, %A')}\n\n"
             
             if overdue:
@@ -703,41 +3262,537 @@ async def daily_notification(context: ContextTypes.DEFAULT_TYPE):
             logger.error(f"Daily notification error: {e}")
 
 # ═══════════════════════════════════════════════════════════════
-# MAIN
+# ДОПУСК ДОРОГИХ ОПЕРАЦИЙ (token bucket)
 # ═══════════════════════════════════════════════════════════════
 
-def main():
-    """Запуск бота"""
-    if not BOT_TOKEN:
-        logger.error("TELEGRAM_BOT_TOKEN не задан!")
+class TokenBucket:
+    """Ведро токенов с резервированием в долг: reserve() сразу списывает токен
+    и возвращает, сколько секунд ждать, пока долг не покроется пополнением"""
+    
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def reserve(self) -> float:
+        self._refill()
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+    
+    def refund(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+    
+    @property
+    def idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+def parse_limit(spec: str, share: int = 1) -> tuple[float, float]:
+    """'10/60' → (ёмкость, токенов в секунду); share делит лимит между воркерами"""
+    capacity, period = spec.split("/")
+    capacity = max(1.0, float(capacity) / share)
+    return capacity, capacity / float(period)
+
+_user_buckets: dict[tuple[str, int], TokenBucket] = {}
+_global_buckets: dict[str, TokenBucket] = {}
+
+def admission_delay(op: str, user_id: int) -> float:
+    """Списать токен операции: 0 — допущена, иначе через сколько секунд повторить
+    
+    Ждать токена нельзя: обработчик уже держит слот PerUserUpdateProcessor и
+    очередь пользователя, и ожидание задержало бы всех. Поэтому сверх бюджета —
+    сразу отказ, а резерв возвращается в вёдра.
+    """
+    user_spec, global_spec = ADMISSION_LIMITS[op]
+    if op not in _global_buckets:
+        # В кластере глобальный бюджет делится между воркерами
+        _global_buckets[op] = TokenBucket(*parse_limit(global_spec, BOT_WORKERS))
+    if len(_user_buckets) > 1000:
+        for key in [k for k, b in _user_buckets.items() if b.idle]:
+            del _user_buckets[key]
+    user_bucket = _user_buckets.setdefault((op, user_id), TokenBucket(*parse_limit(user_spec)))
+    global_bucket = _global_buckets[op]
+    
+    delay = max(user_bucket.reserve(), global_bucket.reserve())
+    if delay:
+        user_bucket.refund()
+        global_bucket.refund()
+    return delay
+
+async def admit(op: str, update: Update) -> bool:
+    """Допуск по бюджету op; при отказе пользователь узнаёт, когда повторить"""
+    delay = admission_delay(op, update.effective_user.id if update.effective_user else 0)
+    if not delay:
+        return True
+    text = f"⏳ Слишком много запросов подряд. Попробуй через {math.ceil(delay)} сек."
+    if update.callback_query:
+        await update.callback_query.answer(text, show_alert=True)
+    else:
+        await update.effective_message.reply_text(text)
+    return False
+
+def admission(op: str, when=None):
+    """Обёртка обработчика: допуск по бюджету op или отказ
+    
+    when(update, context) — платить ли за этот вызов (без него — за каждый):
+    /track с названием задачи в Asana не ходит, а без него показывает её задачи.
+    """
+    def decorate(handler):
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            if (when is None or when(update, context)) and not await admit(op, update):
+                return
+            return await handler(update, context)
+        return wrapper
+    return decorate
+
+# ═══════════════════════════════════════════════════════════════
+# ПРОФИЛИРОВАНИЕ ПО ЗАПРОСУ
+# ═══════════════════════════════════════════════════════════════
+
+# /profile включает на окно времени или на N апдейтов сэмплирующий профилировщик
+# и tracemalloc. Сэмплер — отдельный поток, который раз в PROFILE_INTERVAL снимает
+# стеки всех потоков процесса (wall-clock: видно и ожидание Asana/OpenAI в
+# to_thread). Выключенное профилирование ничего не стоит: потока нет, tracemalloc
+# не запущен, в PerUserUpdateProcessor остаётся одна проверка _profile на None.
+
+PROFILE_TOP = 10
+PROFILE_TRACE_FRAMES = 10  # глубина стека tracemalloc для сырого отчёта
+# Сэмплы, где поток ждёт в select() event loop или в очереди, — простой, а не работа
+PROFILE_IDLE_FRAMES = ("selectors.py:", "threading.py:", "queue.py:", "thread.py:_worker")
+
+_profile: dict | None = None  # активная сессия профилирования
+
+class SamplingProfiler:
+    """Поток, снимающий стеки остальных потоков каждые interval секунд
+    
+    Стеки копятся в stacks (кортеж «файл:функция» от корня → число сэмплов),
+    из них же выгружается folded-формат для flamegraph.pl / speedscope.
+    """
+    
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+    
+    def start(self):
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+    
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_qualname}")
+                    frame = frame.f_back
+                if stack[0].startswith(PROFILE_IDLE_FRAMES):
+                    continue
+                self.stacks[tuple(reversed(stack))] += 1
+                self.samples += 1
+    
+    def top(self, n: int = PROFILE_TOP) -> tuple[list, list]:
+        """(функции по собственному времени, функции бота с учётом вложенных вызовов)"""
+        own, inclusive = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for func in set(stack):
+                if func.startswith("bot.py:"):
+                    inclusive[func] += count
+        return own.most_common(n), inclusive.most_common(n)
+    
+    def folded(self) -> str:
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in self.stacks.most_common())
+
+def start_profile(bot: Bot, chat_id: int, seconds: int, updates: int | None, raw: bool, command_update_id: int | None):
+    """Запустить сессию: сэмплер, tracemalloc и задачу, которая её завершит"""
+    global _profile
+    own_tracemalloc = not tracemalloc.is_tracing()
+    if own_tracemalloc:
+        tracemalloc.start(PROFILE_TRACE_FRAMES)
+    profiler = SamplingProfiler()
+    profiler.start()
+    _profile = {
+        "bot": bot,
+        "chat_id": chat_id,
+        "raw": raw,
+        "seconds": seconds,
+        "updates_left": updates,
+        "updates": 0,
+        "command_update_id": command_update_id,
+        "profiler": profiler,
+        "own_tracemalloc": own_tracemalloc,
+        "started": time.monotonic(),
+        "done": asyncio.Event(),
+    }
+    _profile["task"] = asyncio.create_task(profile_window(_profile))
+
+def count_profiled_update(update_id: int | None):
+    """Учесть обработанный апдейт; в режиме «N апдейтов» — завершить сессию на N-м"""
+    session = _profile
+    if update_id == session["command_update_id"]:
+        return
+    session["updates"] += 1
+    if session["updates_left"] is not None:
+        session["updates_left"] -= 1
+        if session["updates_left"] <= 0:
+            session["done"].set()
+
+async def profile_window(session: dict):
+    """Дождаться конца окна (или N-го апдейта, /profile stop) и отправить итог"""
+    try:
+        await asyncio.wait_for(session["done"].wait(), session["seconds"])
+    except asyncio.TimeoutError:
+        pass
+    await finish_profile(session)
+
+async def finish_profile(session: dict):
+    global _profile
+    _profile = None
+    profiler = session["profiler"]
+    await asyncio.to_thread(profiler.stop)
+    
+    # Без выделений самого сэмплера и механизма импорта
+    sampler_lines = {line for _, _, line in SamplingProfiler._run.__code__.co_lines() if line}
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        *(tracemalloc.Filter(False, __file__, line) for line in sampler_lines),
+    ])
+    _, peak = tracemalloc.get_traced_memory()
+    if session["own_tracemalloc"]:
+        tracemalloc.stop()
+    
+    elapsed = time.monotonic() - session["started"]
+    bot, chat_id = session["bot"], session["chat_id"]
+    await bot.send_message(chat_id, render_profile(profiler, snapshot, peak, elapsed, session["updates"]))
+    
+    if session["raw"]:
+        stamp = datetime.now(MOSCOW_TZ).strftime("%Y%m%d-%H%M%S")
+        await bot.send_document(
+            chat_id,
+            document=io.BytesIO(profiler.folded().encode()),
+            filename=f"profile-{stamp}.folded.txt",
+            caption="🔥 Стеки в folded-формате (flamegraph.pl, speedscope)"
+        )
+        allocations = "\n\n".join(
+            f"{stat.size / 1024:.1f} KiB, {stat.count} блоков\n" + "\n".join(stat.traceback.format())
+            for stat in snapshot.statistics("traceback")[:50]
+        )
+        await bot.send_document(
+            chat_id,
+            document=io.BytesIO(allocations.encode()),
+            filename=f"allocations-{stamp}.txt",
+            caption="🧠 Места выделения памяти со стеками (tracemalloc)"
+        )
+
+def render_profile(profiler: SamplingProfiler, snapshot, peak: int, elapsed: float, updates: int) -> str:
+    """Сводка сессии: горячие функции по сэмплам и места выделения памяти"""
+    total = profiler.samples or 1
+    own, inclusive = profiler.top()
+    text = (f"🔬 Профиль за {elapsed:.0f} с: апдейтов {updates}, сэмплов {profiler.samples}"
+            f" (шаг {profiler.interval * 1000:g} мс)\n")
+    
+    text += "\n⏱ Собственное время (ждущие потоки не считаются):\n"
+    for func, count in own:
+        text += f"{count / total:6.1%}  {func}\n"
+    
+    text += "\n🌳 Функции бота с вложенными вызовами:\n"
+    for func, count in inclusive:
+        text += f"{count / total:6.1%}  {func}\n"
+    
+    stats = snapshot.statistics("lineno")
+    text += f"\n🧠 Память, выделенная за окно (пик {peak / 1048576:.1f} MiB):\n"
+    for stat in stats[:PROFILE_TOP]:
+        frame = stat.traceback[0]
+        text += f"{stat.size / 1024:8.1f} KiB  {os.path.basename(frame.filename)}:{frame.lineno} ({stat.count} блоков)\n"
+    
+    if not profiler.samples and not stats:
+        text += "\nНичего не набралось — бот простаивал.\n"
+    if len(text) > 4000:
+        text = text[:4000] + "\n…"
+    return text
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /profile [сек | Nu] [raw] — профилирование работающего бота (только админы)
+    
+    /profile 60 — окно 60 секунд, /profile 20u — следующие 20 апдейтов,
+    raw — приложить сырые стеки и места выделения памяти, /profile stop — завершить досрочно.
+    В кластерном режиме профилируется воркер, которому достался чат админа.
+    """
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("⛔ Нет доступа")
         return
     
-    # Инициализация БД
-    init_db()
+    args = [arg.lower() for arg in context.args or []]
+    if args == ["stop"]:
+        if _profile is None:
+            await update.message.reply_text("🔬 Профилирование не запущено")
+        else:
+            _profile["done"].set()
+        return
+    if _profile is not None:
+        await update.message.reply_text("⏳ Профилирование уже идёт, /profile stop — завершить")
+        return
+    
+    raw = "raw" in args
+    spec = next((arg for arg in args if arg != "raw"), "30")
+    match = re.fullmatch(r"(\d+)([su]?)", spec)
+    if not match or not int(match.group(1)):
+        await update.message.reply_text(
+            "❓ Формат: `/profile 60` (секунд), `/profile 20u` (апдейтов), `raw` — сырой профиль",
+            parse_mode="Markdown"
+        )
+        return
+    
+    count = int(match.group(1))
+    if match.group(2) == "u":
+        seconds, updates = PROFILE_MAX_SECONDS, count
+        window = f"следующие {count} апдейтов (не дольше {PROFILE_MAX_SECONDS} с)"
+    else:
+        seconds, updates = min(count, PROFILE_MAX_SECONDS), None
+        window = f"{seconds} с"
     
-    app = Application.builder().token(BOT_TOKEN).build()
+    start_profile(context.bot, update.effective_chat.id, seconds, updates, raw, update.update_id)
+    await update.message.reply_text(f"🔬 Профилирую {window}, итог пришлю сюда")
+
+# ═══════════════════════════════════════════════════════════════
+# ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА АПДЕЙТОВ
+# ═══════════════════════════════════════════════════════════════
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """До max_concurrent_updates апдейтов параллельно, но апдейты одного
+    пользователя и одного чата — строго по очереди
+    
+    /track → /stop одного пользователя не перемешиваются, а медленное
+    голосовое или /week не задерживает остальных. Блокировки берутся в
+    отсортированном порядке ключей, поэтому взаимоблокировок нет; очередь
+    asyncio.Lock — FIFO, порядок прихода апдейтов сохраняется.
+    
+    Общий слот (семафор) берётся только после блокировок своих ключей:
+    апдейты, ждущие своей очереди, слотов не занимают, и пачка апдейтов
+    одного пользователя не отнимает их у остальных.
+    """
+    
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks: dict[tuple[str, int], asyncio.Lock] = {}
+        self._holders: dict[tuple[str, int], int] = {}
+    
+    @staticmethod
+    def order_keys(update: object) -> list:
+        """Ключи очередей апдейта: пользователь и (групповой) чат"""
+        if not isinstance(update, Update):
+            return []
+        keys = []
+        if update.effective_user:
+            keys.append(("user", update.effective_user.id))
+        if update.effective_chat and (not update.effective_user or update.effective_chat.id != update.effective_user.id):
+            keys.append(("chat", update.effective_chat.id))
+        return sorted(keys)
+    
+    @staticmethod
+    def update_type(update: object) -> str | None:
+        """Команда или вид апдейта — атрибут корневого спана"""
+        if not isinstance(update, Update):
+            return None
+        if update.callback_query:
+            return "callback"
+        message = update.effective_message
+        if message and message.text and message.text.startswith("/"):
+            return message.text.split()[0].split("@")[0]
+        if message and message.voice:
+            return "voice"
+        return "message"
+    
+    @asynccontextmanager
+    async def _hold(self, key: tuple[str, int]):
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._holders[key] = self._holders.get(key, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._holders[key] -= 1
+            if not self._holders[key]:
+                del self._holders[key]
+                del self._locks[key]
+    
+    async def process_update(self, update: object, coroutine):
+        # Порядок BaseUpdateProcessor.process_update обратный: сначала слот, потом
+        # do_process_update — апдейты в очереди пользователя держали бы слоты
+        async with AsyncExitStack() as stack:
+            for key in self.order_keys(update):
+                await stack.enter_async_context(self._hold(key))
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+    
+    async def do_process_update(self, update: object, coroutine):
+        # Корреляция логов и учёт их стоимости в рамках апдейта
+        update_id = getattr(update, "update_id", None)
+        id_token = current_update_id.set(update_id)
+        log_cost = [0, 0.0]
+        cost_token = current_log_cost.set(log_cost)
+        started = time.perf_counter()
+        try:
+            with span("update", SPAN_KIND_SERVER, root=True, update_id=update_id, update_type=self.update_type(update)):
+                await coroutine
+        finally:
+            current_log_cost.reset(cost_token)
+            if _profile is not None:
+                count_profiled_update(update_id)
+            logger.info("update processed", extra={
+                "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+                "log_records": log_cost[0],
+                "log_cost_us": round(log_cost[1] * 1e6),
+            })
+            current_update_id.reset(id_token)
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+
+# ═══════════════════════════════════════════════════════════════
+# КЛАСТЕРНЫЙ РЕЖИМ
+# ═══════════════════════════════════════════════════════════════
+
+# Ingress (этот процесс) забирает апдейты long polling'ом и раскладывает их по
+# воркерам через multiprocessing.Queue по хешу user_id: сессия трекинга — состояние
+# пользователя, и /track в личке и /stop в группе должны попасть в один процесс,
+# где их упорядочит PerUserUpdateProcessor. Апдейты без пользователя (посты
+# каналов) идут по chat_id. Воркеры запускают те же
+# обработчики; плановые задачи (рассылка, синхронизации, восстановление
+# дедлайнов) работают только в воркере 0 — ровно один раз на кластер.
+
+def shard_for(update: Update, workers: int) -> int:
+    """Номер воркера для апдейта"""
+    if update.effective_user:
+        key = update.effective_user.id
+    elif update.effective_chat:
+        key = update.effective_chat.id
+    else:
+        key = update.update_id
+    return abs(key) % workers
+
+async def run_worker_loop(app: Application, queue):
+    """Принимать апдейты из очереди ingress и передавать их в Application"""
+    loop = asyncio.get_running_loop()
+    async with app:
+        await app.start()
+        while True:
+            data = await loop.run_in_executor(None, queue.get)
+            if data is None:
+                break
+            await app.update_queue.put(Update.de_json(data, app.bot))
+        await app.stop()
+
+def run_worker(index: int, queue):
+    """Точка входа процесса-воркера"""
+    setup_logging(f"bot-worker-{index}.log")
+    setup_tracing(f"traces-worker-{index}.jsonl")
+    app = build_application(with_jobs=index == 0)
+    logger.info(f"🧩 Воркер {index} запущен")
+    asyncio.run(run_worker_loop(app, queue))
+
+async def run_ingress(queues: list):
+    """Long polling и раздача апдейтов по воркерам"""
+    offset = None
+    async with Bot(BOT_TOKEN) as bot:
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+            except Exception as e:
+                logger.error(f"Ingress polling error: {e}")
+                await asyncio.sleep(5)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                queues[shard_for(update, len(queues))].put(update.to_dict())
+
+def run_cluster(workers: int):
+    """Ingress + workers процессов-воркеров"""
+    queues = [multiprocessing.Queue() for _ in range(workers)]
+    processes = [
+        multiprocessing.Process(target=run_worker, args=(i, q), name=f"bot-worker-{i}", daemon=True)
+        for i, q in enumerate(queues)
+    ]
+    for process in processes:
+        process.start()
+    
+    logger.info(f"🤖 Бот запущен в кластерном режиме: {workers} воркеров")
+    try:
+        asyncio.run(run_ingress(queues))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for q in queues:
+            q.put(None)
+        for process in processes:
+            process.join(timeout=30)
+
+# ═══════════════════════════════════════════════════════════════
+# MAIN
+# ═══════════════════════════════════════════════════════════════
+
+def build_application(with_jobs: bool = True) -> Application:
+    """Application со всеми обработчиками; with_jobs — ставить ли плановые задачи"""
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .request(TracedHTTPXRequest(connection_pool_size=256))
+        .build()
+    )
     
     # Команды
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_command))
-    app.add_handler(CommandHandler("tasks", tasks_command))
-    app.add_handler(CommandHandler("week", week_command))
-    app.add_handler(CommandHandler("overdue", overdue_command))
-    app.add_handler(CommandHandler("today", today_command))
+    app.add_handler(CommandHandler("tasks", admission("asana")(tasks_command)))
+    app.add_handler(CommandHandler("week", admission("asana")(week_command)))
+    app.add_handler(CommandHandler("overdue", admission("asana")(overdue_command)))
+    app.add_handler(CommandHandler("today", admission("asana")(today_command)))
     
     # Трекер времени
-    app.add_handler(CommandHandler("track", track_command))
+    app.add_handler(CommandHandler("track", admission("asana", when=lambda update, context: not context.args)(track_command)))
     app.add_handler(CommandHandler("stop", stop_command))
     app.add_handler(CommandHandler("status", status_command))
     app.add_handler(CommandHandler("report", report_command))
     app.add_handler(CommandHandler("weekreport", weekreport_command))
+    app.add_handler(CommandHandler("teamreport", teamreport_command))
+    app.add_handler(CommandHandler("analytics", analytics_command))
+    app.add_handler(CommandHandler("export", export_command))
+    app.add_handler(CommandHandler("health", health_command))
+    app.add_handler(CommandHandler("profile", profile_command))
     
     # Callbacks
     app.add_handler(CallbackQueryHandler(track_callback, pattern="^track:"))
-    app.add_handler(CallbackQueryHandler(voice_callback, pattern="^voice_"))
+    app.add_handler(CallbackQueryHandler(admission("asana")(voice_tasks_callback), pattern="^voice_tasks:"))
+    app.add_handler(CallbackQueryHandler(voice_callback, pattern="^voice_cancel$"))
+    app.add_handler(CallbackQueryHandler(admission("asana")(voice_callback), pattern="^voice_task:"))
+    app.add_handler(CallbackQueryHandler(admission("asana")(task_done_callback), pattern="^task_done:"))
     
     # Голосовые
-    app.add_handler(MessageHandler(filters.VOICE, handle_voice))
+    app.add_handler(MessageHandler(filters.VOICE, admission("voice")(handle_voice)))
+    
+    if not with_jobs:
+        return app
     
     # Планировщик
     job_queue = app.job_queue
@@ -747,6 +3802,64 @@ def main():
         days=(0, 1, 2, 3, 4),
         name="daily_plan"
     )
+    rebuild_session_deadlines(job_queue)
+    job_queue.run_repeating(
+        refresh_task_index_job,
+        interval=TASK_INDEX_INTERVAL,
+        first=10,
+        name="task_index"
+    )
+    if ASANA_WEBHOOK_PORT and ASANA_WEBHOOK_URL:
+        # Приёмник событий — там же, где плановые задачи (один на кластер)
+        start_asana_receiver()
+        job_queue.run_repeating(
+            asana_webhook_job,
+            interval=3600,
+            first=15,
+            name="asana_webhook"
+        )
+    job_queue.run_repeating(
+        purge_callback_payloads,
+        interval=6 * 3600,
+        first=300,
+        name="callback_purge"
+    )
+    job_queue.run_daily(
+        retention_job,
+        time=datetime.strptime("03:30", "%H:%M").time().replace(tzinfo=MOSCOW_TZ),
+        name="retention"
+    )
+    job_queue.run_repeating(
+        snapshot_job,
+        interval=SNAPSHOT_INTERVAL,
+        first=120,
+        name="sessions_snapshot"
+    )
+    job_queue.run_repeating(
+        sync_time_to_asana,
+        interval=ASANA_SYNC_INTERVAL,
+        first=60,
+        name="asana_time_sync"
+    )
+    return app
+
+def main():
+    """Запуск бота"""
+    setup_logging()
+    setup_tracing()
+    
+    if not BOT_TOKEN:
+        logger.error("TELEGRAM_BOT_TOKEN не задан!")
+        return
+    
+    # Инициализация БД
+    init_db()
+    
+    if BOT_WORKERS > 1:
+        run_cluster(BOT_WORKERS)
+        return
+    
+    app = build_application()
     
     logger.info("🤖 Бот запущен!")
     app.run_polling(allowed_updates=Update.ALL_TYPES)
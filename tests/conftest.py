@@ -0,0 +1,157 @@
+"""Общие фикстуры: бот и вебхук импортируются из корня репозитория, база — во временной папке."""
+import asyncio
+import json
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "api"))
+
+
+@pytest.fixture
+def bot_db(tmp_path, monkeypatch):
+    """bot.py с чистой SQLite-базой, архивом и снимком в tmp_path."""
+    import bot
+
+    monkeypatch.setattr(bot, "DB_PATH", tmp_path / "timetracker.db")
+    monkeypatch.setattr(bot, "ARCHIVE_DB_PATH", tmp_path / "timetracker_archive.db")
+    monkeypatch.setattr(bot, "SNAPSHOT_DIR", tmp_path / "sessions_snapshot")
+    bot.init_db()
+    return bot
+
+
+class FakeQuery:
+    """callback_query: запоминает ответы вместо Bot API"""
+
+    def __init__(self, data, user_id=1, username="ivan"):
+        self.data = data
+        self.from_user = SimpleNamespace(id=user_id, username=username)
+        self.edits = []
+        self.alerts = []
+
+    async def answer(self, text=None, show_alert=False, **kwargs):
+        if text:
+            self.alerts.append((text, show_alert))
+
+    async def edit_message_text(self, text, **kwargs):
+        self.edits.append(text)
+
+
+def callback_update(data, user_id=1, username="ivan"):
+    """Update с нажатием inline-кнопки"""
+    query = FakeQuery(data, user_id, username)
+    user = query.from_user
+    return SimpleNamespace(callback_query=query, effective_user=user,
+                           effective_chat=SimpleNamespace(id=user_id), message=None)
+
+
+@pytest.fixture
+def asana_calls(monkeypatch):
+    """asana_request без сети: запросы копятся в списке, ответ — {"gid": "new"}"""
+    import bot
+
+    calls = []
+
+    def fake_request(method, endpoint, data=None, fresh=False):
+        calls.append((method, endpoint, data))
+        return {"gid": "new", **(data or {})}
+
+    monkeypatch.setattr(bot, "asana_request", fake_request)
+    return calls
+
+
+class FakeBot:
+    """Bot API без сети: отправленные тексты копятся в sent"""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.delay)
+        self.sent.append((chat_id, text))
+
+
+def message_update(update_id, text, user_id=1, chat_id=None, bot=None):
+    """Настоящий telegram.Update с текстовым сообщением"""
+    from telegram import Chat, Message, Update, User
+
+    chat_id = user_id if chat_id is None else chat_id
+    chat = Chat(chat_id, Chat.PRIVATE if chat_id == user_id else Chat.GROUP)
+    message = Message(update_id, datetime.now(timezone.utc), chat, from_user=User(user_id, "Ivan", False, username=f"user{user_id}"), text=text)
+    if bot is not None:
+        message.set_bot(bot)
+    return Update(update_id, message=message)
+
+
+class StubServer:
+    """Локальный HTTP-сервер для тестов: handler(method, path, body) → (status, тело, задержка)"""
+
+    def __init__(self, handler):
+        stub = self
+        self.requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def _serve(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                stub.requests.append((self.command, self.path, body))
+                status, payload, delay = handler(self.command, self.path, body)
+                time.sleep(delay)
+                data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                except OSError:
+                    pass  # клиент уже отвалился по таймауту
+
+            do_GET = do_POST = do_PUT = _serve
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub_server():
+    """Фабрика StubServer, все серверы закрываются после теста"""
+    servers = []
+
+    def start(handler):
+        servers.append(StubServer(handler))
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.close()
+
+
+def kv_handler(store):
+    """REST API Upstash/Vercel KV поверх словаря: GET и SET"""
+    def handle(method, path, body):
+        command, key, *args = json.loads(body)
+        if command == "GET":
+            return 200, {"result": store.get(key)}, 0
+        store[key] = args[0]
+        return 200, {"result": "OK"}, 0
+
+    return handle
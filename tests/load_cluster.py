@@ -0,0 +1,124 @@
+"""Нагрузочный стенд кластерного режима: пропускная способность на 1..N воркеров.
+
+    python tests/load_cluster.py --workers 1 2 4 --updates 4000 --users 200
+
+Ingress раскладывает синтетические /track и /stop через shard_for по
+multiprocessing.Queue, как run_ingress. Воркеры собирают Update.de_json и
+прогоняют его через PerUserUpdateProcessor и настоящие track_command /
+stop_command с общей SQLite-базой в WAL. Ответы Bot API заменены задержкой
+--latency, плановых задач нет. Печатается апдейтов в секунду и ускорение
+относительно первого прогона.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from conftest import FakeBot, message_update  # noqa: E402
+
+
+def make_updates(count: int, users: int) -> list[dict]:
+    """Поток апдейтов: у каждого пользователя /track, /stop по очереди; треть — из группы"""
+    updates = []
+    for i in range(count):
+        user_id = 1 + i % users
+        turn = i // users
+        text = f"/track задача {turn}" if turn % 2 == 0 else "/stop"
+        chat_id = -1000 - user_id % 7 if user_id % 3 == 0 else None
+        updates.append(message_update(i, text, user_id=user_id, chat_id=chat_id).to_dict())
+    return updates
+
+
+async def worker_loop(queue, latency: float, concurrency: int) -> int:
+    import bot
+    from telegram import Update
+
+    fake = FakeBot(delay=latency)
+    processor = bot.PerUserUpdateProcessor(concurrency)
+    loop = asyncio.get_running_loop()
+    tasks = []
+    while True:
+        data = await loop.run_in_executor(None, queue.get)
+        if data is None:
+            break
+        update = Update.de_json(data, fake)
+        command, *args = update.message.text.split()
+        handler = bot.track_command if command == "/track" else bot.stop_command
+        context = SimpleNamespace(args=args, job_queue=None)
+        tasks.append(asyncio.create_task(processor.process_update(update, handler(update, context))))
+    await asyncio.gather(*tasks)
+    return len(tasks)
+
+
+def run_worker(queue, results, db_path: str, latency: float, concurrency: int):
+    import bot
+
+    bot.DB_PATH = Path(db_path)
+    bot.schedule_session_deadlines = lambda *args: None
+    results.put(("ready", 0))
+    results.put(("done", asyncio.run(worker_loop(queue, latency, concurrency))))
+
+
+def measure(workers: int, updates: list[dict], latency: float, concurrency: int) -> float:
+    """Апдейтов в секунду на кластере из workers процессов"""
+    import bot
+
+    db_path = bot.DB_PATH
+    with tempfile.TemporaryDirectory() as tmp:
+        bot.DB_PATH = Path(tmp) / "timetracker.db"
+        bot.init_db()
+
+        queues = [multiprocessing.Queue() for _ in range(workers)]
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=run_worker, args=(q, results, str(bot.DB_PATH), latency, concurrency))
+            for q in queues
+        ]
+        for process in processes:
+            process.start()
+        for _ in processes:
+            results.get()  # воркеры импортировали бот и ждут
+
+        started = time.perf_counter()
+        for data in updates:
+            update = bot.Update.de_json(data, None)
+            queues[bot.shard_for(update, workers)].put(data)
+        for q in queues:
+            q.put(None)
+        processed = sum(results.get()[1] for _ in processes)
+        elapsed = time.perf_counter() - started
+
+        for process in processes:
+            process.join()
+        bot.DB_PATH = db_path
+        assert processed == len(updates), f"обработано {processed} из {len(updates)}"
+        return processed / elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--updates", type=int, default=4000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка ответа Bot API, с")
+    parser.add_argument("--concurrency", type=int, default=256, help="MAX_CONCURRENT_UPDATES воркера")
+    args = parser.parse_args(argv)
+
+    updates = make_updates(args.updates, args.users)
+    baseline = None
+    print(f"{'воркеров':>8} {'апдейт/с':>10} {'ускорение':>10}")
+    for workers in args.workers:
+        rate = measure(workers, updates, args.latency, args.concurrency)
+        baseline = baseline or rate
+        print(f"{workers:>8} {rate:>10.0f} {rate / baseline:>9.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Допуск дорогих операций: отказ без ожидания, покрытие кнопок Asana, чистка вёдер."""
+import asyncio
+import time
+
+import pytest
+
+import bot
+import webhook
+from conftest import callback_update
+
+
+@pytest.fixture
+def budget(monkeypatch):
+    """Бюджет asana: 2 запроса в минуту на пользователя"""
+    monkeypatch.setattr(bot, "ADMISSION_LIMITS", {**bot.ADMISSION_LIMITS, "asana": ("2/60", "100/60")})
+    monkeypatch.setattr(bot, "_user_buckets", {})
+    monkeypatch.setattr(bot, "_global_buckets", {})
+
+
+def test_over_budget_is_rejected_without_waiting(budget):
+    calls = []
+
+    @bot.admission("asana")
+    async def handler(update, context):
+        calls.append(update)
+
+    async def run():
+        for _ in range(3):
+            await handler(callback_update("task_done:x"), None)
+
+    started = time.monotonic()
+    asyncio.run(run())
+    assert time.monotonic() - started < 0.5
+    assert len(calls) == 2
+    assert bot.admission_delay("asana", 1) > 0
+
+
+def test_rejection_is_shown_as_callback_alert(budget):
+    updates = [callback_update("task_done:x") for _ in range(3)]
+
+    async def run():
+        return [await bot.admit("asana", update) for update in updates]
+
+    assert asyncio.run(run()) == [True, True, False]
+    text, show_alert = updates[-1].callback_query.alerts[0]
+    assert show_alert and "Попробуй через" in text
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setattr(bot, "BOT_TOKEN", "123:TEST")
+    return bot.build_application(with_jobs=False)
+
+
+def registered(app, data=None, command=None):
+    """Обёрнутый при регистрации обработчик — как его выберет Application"""
+    from telegram.ext import CallbackQueryHandler, CommandHandler
+
+    for handler in app.handlers[0]:
+        if command and isinstance(handler, CommandHandler) and command in handler.commands:
+            return handler.callback
+        if data and isinstance(handler, CallbackQueryHandler) and handler.pattern.match(data):
+            return handler.callback
+
+
+def test_voice_button_respects_budget_but_cancel_is_free(bot_db, budget, asana_calls, app):
+    async def run():
+        for _ in range(3):
+            await registered(app, "voice_cancel")(callback_update("voice_cancel"), None)
+        for _ in range(3):
+            data = f"voice_task:{bot_db.put_callback_payload({'text': 'Позвонить клиенту'})}"
+            await registered(app, data)(callback_update(data), None)
+
+    asyncio.run(run())
+    assert len(asana_calls) == 2
+
+
+def test_track_charges_only_the_asana_picker(bot_db, budget, app, monkeypatch):
+    from types import SimpleNamespace
+
+    from conftest import FakeBot, message_update
+
+    monkeypatch.setattr(bot, "get_project_tasks", lambda assignee_gid=None, limit=10: [])
+    monkeypatch.setattr(bot, "schedule_session_deadlines", lambda *args: None)
+    track = registered(app, command="track")
+
+    async def run():
+        fake = FakeBot()
+        for i in range(3):
+            await track(message_update(i, "/track отчёт", bot=fake), SimpleNamespace(args=["отчёт"], job_queue=None))
+            await bot_db.stop_command(message_update(100 + i, "/stop", bot=fake), SimpleNamespace(args=[], job_queue=None))
+        for i in range(3):
+            await track(message_update(200 + i, "/track", bot=fake), SimpleNamespace(args=[], job_queue=None))
+        return fake.sent
+
+    sent = asyncio.run(run())
+    assert sum("Попробуй через" in text for _, text in sent) == 1
+
+
+def test_webhook_prunes_full_buckets(monkeypatch):
+    monkeypatch.setattr(webhook, "_buckets", {})
+    long_ago = time.monotonic() - 3600
+    for user_id in range(webhook.BUCKETS_MAX + 1):
+        webhook._buckets[("status", user_id)] = (0.0, long_ago)
+    webhook._buckets[("status", "fresh")] = (0.0, time.monotonic())
+    assert webhook.take_token(("status", 1), "5/60") == 0
+    assert set(webhook._buckets) == {("status", "fresh"), ("status", 1)}
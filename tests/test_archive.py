@@ -0,0 +1,77 @@
+"""Архив старых сессий: перенос в две транзакции и чтение старых схем архива."""
+import sqlite3
+from datetime import datetime, timedelta
+
+OLD = (datetime.now() - timedelta(days=400)).strftime("%Y-%m-10T10:00:00")
+MONTH_TABLE = "sessions_" + OLD[:7].replace("-", "_")
+
+
+def add_closed(bot, n, started=OLD, user_id=1):
+    conn = sqlite3.connect(bot.DB_PATH)
+    for i in range(n):
+        conn.execute(
+            "INSERT INTO time_sessions (user_id, username, task_name, started_at, ended_at, duration_minutes) "
+            "VALUES (?, 'ivan', ?, ?, ?, 30)",
+            (user_id, f"задача {i}", started, started),
+        )
+    conn.commit()
+    conn.close()
+
+
+def all_sessions(bot, columns="id"):
+    conn = bot.connect_with_archive()
+    rows = conn.execute(f"SELECT {columns} FROM all_sessions ORDER BY id").fetchall()
+    conn.close()
+    return rows
+
+
+def rollup_minutes(bot):
+    conn = sqlite3.connect(bot.DB_PATH)
+    total = conn.execute("SELECT COALESCE(SUM(minutes), 0), COALESCE(SUM(sessions), 0) FROM time_rollups").fetchone()
+    conn.close()
+    return total
+
+
+def test_archive_moves_rows_once(bot_db):
+    add_closed(bot_db, 3)
+    bot_db.start_session(1, "ivan", "сейчас")
+    assert bot_db.archive_old_sessions(retention_days=180) == 3
+    assert bot_db.archive_old_sessions(retention_days=180) == 0
+    assert [r[0] for r in all_sessions(bot_db)] == [1, 2, 3, 4]
+    assert rollup_minutes(bot_db) == (90, 3)
+
+
+def test_interrupted_archive_is_finished_without_duplicates(bot_db):
+    add_closed(bot_db, 3)
+    # Первая транзакция (копия в архив) прошла, вторая (удаление из горячей) — нет
+    conn = sqlite3.connect(bot_db.DB_PATH)
+    conn.execute("ATTACH DATABASE ? AS archive", (str(bot_db.ARCHIVE_DB_PATH),))
+    columns = bot_db.session_columns(conn.cursor())
+    column_defs = ", ".join("id INTEGER PRIMARY KEY" if col == "id" else col for col in columns)
+    conn.execute(f"CREATE TABLE archive.{MONTH_TABLE} ({column_defs})")
+    conn.execute(f"INSERT INTO archive.{MONTH_TABLE} SELECT {', '.join(columns)} FROM main.time_sessions")
+    conn.commit()
+    conn.close()
+
+    assert [r[0] for r in all_sessions(bot_db)] == [1, 2, 3]
+    assert bot_db.archive_old_sessions(retention_days=180) == 3
+    assert [r[0] for r in all_sessions(bot_db)] == [1, 2, 3]
+    assert rollup_minutes(bot_db) == (90, 3)
+
+
+def test_old_archive_schema_reads_missing_columns_as_null(bot_db):
+    conn = sqlite3.connect(bot_db.ARCHIVE_DB_PATH)
+    conn.execute(f"""
+        CREATE TABLE {MONTH_TABLE} (id INTEGER PRIMARY KEY, user_id INTEGER, username TEXT, task_name TEXT,
+            asana_task_id TEXT, started_at TIMESTAMP, ended_at TIMESTAMP, duration_minutes INTEGER, notes TEXT)
+    """)
+    conn.execute(f"INSERT INTO {MONTH_TABLE} VALUES (100, 1, 'ivan', 'старая', NULL, ?, ?, 15, NULL)", (OLD, OLD))
+    conn.commit()
+    conn.close()
+
+    assert all_sessions(bot_db, "id, task_name, asana_synced_at, asana_sync_error") == [(100, "старая", None, None)]
+
+    # Новые строки того же месяца дописываются в старую таблицу, недостающие колонки добавляются
+    add_closed(bot_db, 1)
+    assert bot_db.archive_old_sessions(retention_days=180) == 1
+    assert [r[0] for r in all_sessions(bot_db)] == [1, 100]
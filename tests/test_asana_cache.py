@@ -0,0 +1,90 @@
+"""Кэш ответов Asana при живом вебхуке: что отдаётся из кэша и что забывается."""
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+import bot
+from conftest import callback_update
+
+
+class FakeAsana:
+    """Заглушка Asana: списки и задачи по gid из self.tasks"""
+
+    def __init__(self):
+        self.tasks = {"1": {"gid": "1", "name": "Отчёт", "completed": False, "assignee": None}}
+
+    def __call__(self, method, path, body):
+        url = urlsplit(path)
+        if url.path.startswith("/tasks/"):
+            return 200, {"data": self.tasks[url.path.rsplit("/", 1)[1]]}, 0
+        return 200, {"data": list(self.tasks.values())}, 0
+
+
+@pytest.fixture
+def asana(monkeypatch, stub_server):
+    """Живой вебхук, кэш пуст; в кэше — ответы настоящих get_project_tasks, get_my_tasks, search_tasks"""
+    monkeypatch.setattr(bot, "_asana_fallback", OrderedDict())
+    monkeypatch.setattr(bot, "_asana_task_keys", {})
+    monkeypatch.setattr(bot, "_asana_last_delivery", time.time())
+    fake = FakeAsana()
+    server = stub_server(fake)
+    monkeypatch.setattr(bot, "ASANA_API", server.url)
+    bot.get_project_tasks()
+    bot.get_my_tasks()
+    bot.search_tasks("отчёт")
+    server.requests.clear()
+    return fake, server
+
+
+def list_requests(server, param):
+    return [path for _, path, _ in server.requests if param in parse_qs(urlsplit(path).query)]
+
+
+def test_project_tasks_served_from_cache_until_event(asana, bot_db):
+    fake, server = asana
+    assert [t["name"] for t in bot.get_project_tasks()] == ["Отчёт"]
+    assert not server.requests
+    
+    # «Мои задачи» и поиск вебхук проекта не покрывает — всегда в Asana
+    bot.get_my_tasks()
+    bot.search_tasks("отчёт")
+    assert len(list_requests(server, "assignee")) == 1 and len(list_requests(server, "text")) == 1
+    
+    # Переименование: задача перечитана и подставлена в кэш, список не запрашивается
+    fake.tasks["1"]["name"] = "Отчёт за май"
+    bot.apply_asana_events([{"action": "changed", "resource": {"resource_type": "task", "gid": "1"},
+                             "change": {"field": "name"}}])
+    server.requests.clear()
+    assert [t["name"] for t in bot.get_project_tasks()] == ["Отчёт за май"]
+    assert not server.requests
+
+
+def test_added_event_drops_lists_and_search(asana, bot_db):
+    fake, server = asana
+    fake.tasks["2"] = {"gid": "2", "name": "Новая", "completed": False, "assignee": {"gid": "42"}}
+    bot.apply_asana_events([{"action": "added", "resource": {"resource_type": "task", "gid": "2"},
+                             "parent": {"gid": bot.ASANA_PROJECT}}])
+    assert not bot._asana_fallback
+    # своя задача — первой в выборе /track
+    assert [t["gid"] for t in bot.get_project_tasks("42")] == ["2", "1"]
+    assert len(list_requests(server, "project")) == 1
+
+
+def test_task_done_patches_cache(asana, bot_db, asana_calls):
+    fake, server = asana
+    token = bot_db.put_callback_payload({"gid": "1", "name": "Отчёт"})
+    asyncio.run(bot.task_done_callback(callback_update(f"task_done:{token}"), None))
+    assert asana_calls[0][:2] == ("PUT", "/tasks/1")
+    search = [k for k in bot._asana_fallback if "text" in json.loads(k[1])]
+    assert list(bot._asana_fallback) == search
+    assert bot._asana_fallback[search[0]][1][0]["completed"] is True
+
+
+def test_created_tasks_drop_lists(asana, bot_db, asana_calls):
+    token = bot_db.put_callback_payload({"text": "Позвонить клиенту"})
+    asyncio.run(bot.voice_callback(callback_update(f"voice_task:{token}"), None))
+    assert not bot._asana_fallback
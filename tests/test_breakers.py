@@ -0,0 +1,152 @@
+"""Предохранители внешних API против локальных серверов-заглушек:
+таймаут, 5xx, разомкнутое состояние, пробный запрос, восстановление."""
+import threading
+import time
+from collections import OrderedDict
+
+import pytest
+
+import bot
+import webhook
+
+RESET = 0.3
+
+
+class Faults:
+    """Поведение заглушки по очереди: ("ok" | код | "slow", ...), дальше — последнее"""
+
+    def __init__(self, *plan):
+        self.plan = list(plan)
+
+    def __call__(self, method, path, body):
+        step = self.plan.pop(0) if len(self.plan) > 1 else self.plan[0]
+        if step == "slow":
+            return 200, {"data": []}, 1.0
+        if step == "ok":
+            return 200, {"data": [{"gid": "1"}]}, 0
+        return step, {"errors": [{"message": "boom"}]}, 0
+
+
+# === api/webhook.py ===
+
+@pytest.fixture
+def wm(monkeypatch):
+    """Предохранитель webmaster вебхука смотрит на 127.0.0.1"""
+    monkeypatch.setattr(webhook, "BREAKER_HOSTS", {"127.0.0.1": "webmaster"})
+    monkeypatch.setattr(webhook, "_breakers", {"webmaster": {"state": "closed", "failures": 0, "opened_at": 0.0, "rejected": 0}})
+    monkeypatch.setattr(webhook, "BREAKER_FAILURES", 3)
+    monkeypatch.setattr(webhook, "BREAKER_RESET", RESET)
+    monkeypatch.setattr(webhook, "HTTP_TIMEOUT", 0.2)
+    return webhook._breakers["webmaster"]
+
+
+def test_webhook_timeouts_and_5xx_open_the_breaker(wm, stub_server):
+    server = stub_server(Faults("slow", 503, 500, "ok"))
+    for _ in range(3):
+        assert webhook.http_request(server.url + "/hosts") is None
+    assert wm["state"] == "open" and wm["failures"] == 3
+
+    # Разомкнут: запрос не доходит до сервиса и не ждёт таймаута
+    started = time.monotonic()
+    assert webhook.http_request(server.url + "/hosts") is None
+    assert time.monotonic() - started < 0.1
+    assert len(server.requests) == 3 and wm["rejected"] == 1
+
+
+def test_webhook_half_open_probe_fails_and_reopens(wm, stub_server):
+    server = stub_server(Faults(500, 500, 500, 502, "ok"))
+    for _ in range(3):
+        webhook.http_request(server.url)
+    time.sleep(RESET)
+    assert webhook.http_request(server.url) is None  # пробный запрос — снова 5xx
+    assert wm["state"] == "open"
+    assert webhook.http_request(server.url) is None  # таймер размыкания начат заново
+    assert len(server.requests) == 4
+
+
+def test_webhook_recovers_after_successful_probe(wm, stub_server):
+    server = stub_server(Faults(500, 500, 500, "ok"))
+    for _ in range(3):
+        webhook.http_request(server.url)
+    time.sleep(RESET)
+    assert webhook.http_request(server.url) == {"data": [{"gid": "1"}]}
+    assert wm["state"] == "closed" and wm["failures"] == 0
+    assert webhook.http_request(server.url) is not None
+
+
+def test_webhook_breaker_is_consistent_under_threads(wm):
+    def hammer():
+        for _ in range(500):
+            webhook.breaker_record("webmaster", 500)
+            webhook.breaker_allow("webmaster")
+
+    threads = [threading.Thread(target=hammer) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert wm["failures"] == 8 * 500
+
+
+# === bot.py (Asana) ===
+
+@pytest.fixture
+def asana(monkeypatch, stub_server):
+    """asana_request к заглушке со своим предохранителем: 2 сбоя до размыкания"""
+    breaker = bot.CircuitBreaker("asana", failures=2, reset_timeout=RESET)
+    monkeypatch.setitem(bot.BREAKERS, "asana", breaker)
+    monkeypatch.setattr(bot, "ASANA_TIMEOUT", 0.2)
+    monkeypatch.setattr(bot, "_asana_fallback", OrderedDict())
+    monkeypatch.setattr(bot, "_asana_task_keys", {})
+
+    def start(*plan):
+        server = stub_server(Faults(*plan))
+        monkeypatch.setattr(bot, "ASANA_API", server.url)
+        return server
+
+    return breaker, start
+
+
+def test_asana_timeout_and_5xx_serve_last_good_response(asana):
+    breaker, start = asana
+    server = start("ok", "slow", 503)
+    fresh = bot.asana_request("GET", "/tasks", {"project": "1"})
+    assert fresh == [{"gid": "1"}]
+
+    stale = bot.asana_request("GET", "/tasks", {"project": "1"})  # таймаут
+    assert isinstance(stale, bot.StaleData) and stale == fresh
+    bot.asana_request("GET", "/tasks", {"project": "1"})  # 503
+    assert breaker.state == breaker.OPEN
+
+    stale = bot.asana_request("GET", "/tasks", {"project": "1"})
+    assert isinstance(stale, bot.StaleData) and len(server.requests) == 3
+    assert breaker.snapshot()["rejected"] == 1
+
+
+def test_asana_half_open_lets_one_probe_through(asana):
+    breaker, start = asana
+    server = start(500, 500, "slow", "ok")
+    for _ in range(2):
+        bot.asana_request("PUT", "/tasks/1", {"completed": True})
+    time.sleep(RESET)
+
+    # Пробный запрос висит — параллельные в это время отбиваются, не доходя до Asana
+    results = []
+    probe = threading.Thread(target=lambda: results.append(bot.asana_request("PUT", "/tasks/1", {"completed": True})))
+    probe.start()
+    time.sleep(0.05)
+    assert bot.asana_request("PUT", "/tasks/1", {"completed": True}) == {}
+    probe.join()
+    assert len(server.requests) == 3
+    assert breaker.state == breaker.OPEN  # пробный упал по таймауту
+
+
+def test_asana_recovers_after_successful_probe(asana):
+    breaker, start = asana
+    start(500, 500, "ok")
+    for _ in range(2):
+        bot.asana_request("PUT", "/tasks/1", {"completed": True})
+    assert breaker.state == breaker.OPEN
+    time.sleep(RESET)
+    assert bot.asana_request("PUT", "/tasks/1", {"completed": True}) == [{"gid": "1"}]
+    assert breaker.state == breaker.CLOSED and breaker.failures == 0
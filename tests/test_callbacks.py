@@ -0,0 +1,37 @@
+"""Inline-кнопки: токены данных и кнопки старого формата."""
+import asyncio
+
+from conftest import callback_update
+
+
+def test_voice_button_by_token(bot_db, asana_calls):
+    token = bot_db.put_callback_payload({"text": "Позвонить клиенту"})
+    update = callback_update(f"voice_task:{token}")
+    asyncio.run(bot_db.voice_callback(update, None))
+    assert asana_calls[0][:2] == ("POST", "/tasks")
+    assert asana_calls[0][2]["name"] == "Позвонить клиенту"
+    assert "Задача создана" in update.callback_query.edits[-1]
+
+
+def test_voice_button_legacy_text(bot_db, asana_calls):
+    update = callback_update("voice_task:Позвонить клиенту")
+    asyncio.run(bot_db.voice_callback(update, None))
+    assert asana_calls[0][2]["name"] == "Позвонить клиенту"
+
+
+def test_voice_button_expired_token(bot_db, asana_calls):
+    update = callback_update("voice_task:AbCdEfGhIj_")
+    asyncio.run(bot_db.voice_callback(update, None))
+    assert not asana_calls
+    assert "устарела" in update.callback_query.edits[-1]
+
+
+def test_dictation_button_double_tap(bot_db, asana_calls):
+    candidates = [{"name": "Позвонить клиенту", "assignee": None, "due_on": None}]
+    token = bot_db.put_callback_payload({"tasks": candidates})
+    first, second = callback_update(f"voice_tasks:{token}"), callback_update(f"voice_tasks:{token}")
+    asyncio.run(bot_db.voice_tasks_callback(first, None))
+    asyncio.run(bot_db.voice_tasks_callback(second, None))
+    assert [call[:2] for call in asana_calls] == [("POST", "/batch")]
+    assert "устарела" in second.callback_query.edits[-1]
+    assert bot_db.get_callback_payload(token) is None
@@ -0,0 +1,25 @@
+"""Кластерный режим: раздача апдейтов по воркерам."""
+import bot
+import load_cluster
+from conftest import message_update
+
+
+def test_same_user_private_and_group_go_to_one_worker():
+    for user_id in range(1, 50):
+        private = message_update(1, "/track A", user_id=user_id)
+        group = message_update(2, "/stop", user_id=user_id, chat_id=-1001234)
+        assert bot.shard_for(private, 4) == bot.shard_for(group, 4)
+
+
+def test_channel_post_routed_by_chat():
+    from telegram import Update
+
+    post = message_update(3, "новость", user_id=1, chat_id=-1005).message.to_dict()
+    post.pop("from")
+    update = Update.de_json({"update_id": 3, "channel_post": post}, None)
+    assert bot.shard_for(update, 4) == 1005 % 4
+
+
+def test_load_harness_processes_every_update():
+    updates = load_cluster.make_updates(60, users=6)
+    assert load_cluster.measure(2, updates, latency=0, concurrency=8) > 0
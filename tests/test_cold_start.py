@@ -0,0 +1,55 @@
+"""Бюджет холодного старта: время `import` в свежем интерпретаторе.
+
+Бюджеты переопределяются через COLD_START_WEBHOOK_MS / COLD_START_BOT_MS
+(например, на медленном CI-раннере).
+"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT
+
+WEBHOOK_BUDGET_MS = float(os.environ.get("COLD_START_WEBHOOK_MS", "100"))  # как в README
+BOT_BUDGET_MS = float(os.environ.get("COLD_START_BOT_MS", "600"))  # почти всё — telegram/httpx
+RUNS = 3  # берём лучший: первый запуск греет page cache
+
+PROBE = """
+import sys, time
+sys.path.insert(0, {path!r})
+t = time.perf_counter()
+import {module}
+print((time.perf_counter() - t) * 1000)
+"""
+
+
+def import_ms(module: str, path) -> float:
+    """Лучшее из RUNS время импорта модуля в отдельном процессе, мс"""
+    best = float("inf")
+    for _ in range(RUNS):
+        out = subprocess.run(
+            [sys.executable, "-c", PROBE.format(path=str(path), module=module)],
+            capture_output=True, text=True, check=True, cwd=ROOT,
+        )
+        best = min(best, float(out.stdout.strip().splitlines()[-1]))
+    return best
+
+
+@pytest.mark.parametrize("module, path, budget", [
+    ("webhook", ROOT / "api", WEBHOOK_BUDGET_MS),
+    ("bot", ROOT, BOT_BUDGET_MS),
+])
+def test_import_within_budget(module, path, budget):
+    elapsed = import_ms(module, path)
+    assert elapsed <= budget, f"import {module}: {elapsed:.0f} мс > бюджета {budget:.0f} мс"
+
+
+@pytest.mark.parametrize("lazy", ["openai", "requests"])
+def test_heavy_clients_are_lazy(lazy):
+    """openai/requests не должны попадать в импорт bot.py — только при первом вызове"""
+    out = subprocess.run(
+        [sys.executable, "-c", f"import sys; sys.path.insert(0, {str(ROOT)!r}); import bot; print({lazy!r} in sys.modules)"],
+        capture_output=True, text=True, check=True, cwd=ROOT,
+    )
+    assert out.stdout.strip() == "False"
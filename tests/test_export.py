@@ -0,0 +1,54 @@
+"""Выгрузка /export: gzip-части под лимит Bot API."""
+import csv
+import gzip
+import io
+import json
+
+import pytest
+
+
+def add_sessions(bot, n):
+    for i in range(n):
+        bot.start_session(1, "ivan", f"задача {i} {'x' * (i % 50)}")
+        bot.stop_session(1)
+
+
+def export(bot, fmt, **kwargs):
+    parts = []
+
+    def new_part():
+        parts.append(io.BytesIO())
+        return parts[-1]
+
+    counts = bot.write_sessions_export(new_part, fmt, "2000-01-01", "2100-01-01", **kwargs)
+    return counts, [gzip.decompress(p.getvalue()).decode("utf-8-sig") for p in parts]
+
+
+def test_no_rows_no_parts(bot_db):
+    assert export(bot_db, "csv") == ([], [])
+
+
+@pytest.mark.parametrize("fmt", ["csv", "json"])
+def test_single_part(bot_db, fmt):
+    add_sessions(bot_db, 5)
+    counts, parts = export(bot_db, fmt)
+    assert counts == [5]
+    if fmt == "csv":
+        rows = list(csv.reader(io.StringIO(parts[0])))
+        assert rows[0] == list(bot_db.EXPORT_COLUMNS) and len(rows) == 6
+    else:
+        assert [json.loads(line)["user_id"] for line in parts[0].splitlines()] == [1] * 5
+
+
+def test_large_export_is_split(bot_db, monkeypatch):
+    monkeypatch.setattr(bot_db, "EXPORT_CHUNK_ROWS", 10)
+    add_sessions(bot_db, 200)
+    counts, parts = export(bot_db, "csv", max_bytes=1)
+    assert len(parts) == 20 and sum(counts) == 200
+    ids = []
+    for text, count in zip(parts, counts):
+        rows = list(csv.reader(io.StringIO(text)))
+        assert rows[0] == list(bot_db.EXPORT_COLUMNS)  # у каждой части свой заголовок
+        assert len(rows) == count + 1
+        ids += [int(r[0]) for r in rows[1:]]
+    assert ids == sorted(ids) and len(set(ids)) == 200
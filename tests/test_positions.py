@@ -0,0 +1,108 @@
+"""Хранилище позиций вебхука: SQLite инстанса и постоянная копия в KV."""
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+import webhook
+from conftest import kv_handler
+
+
+def day(offset):
+    return (datetime.now() - timedelta(days=offset)).date()
+
+
+def analytics(days, impressions=100, position=3.0, queries=("купить слона", "слон оптом")):
+    """Ответ query-analytics: одинаковые показы и позиция на каждый день"""
+    return {"text_indicator_to_statistics": [
+        {"text_indicator": {"value": text}, "statistics": [
+            stat for d in days for stat in (
+                {"date": f"{d}T00:00:00", "field": "IMPRESSIONS", "value": impressions},
+                {"date": f"{d}T00:00:00", "field": "CLICKS", "value": 5},
+                {"date": f"{d}T00:00:00", "field": "POSITION", "value": position},
+            )
+        ]} for text in queries
+    ]}
+
+
+@pytest.fixture
+def kv(stub_server, monkeypatch):
+    store = {}
+    server = stub_server(kv_handler(store))
+    monkeypatch.setattr(webhook, "KV_URL", server.url)
+    return store
+
+
+@pytest.fixture
+def new_instance(tmp_path, monkeypatch):
+    """Свежий инстанс Vercel: пустой /tmp и пустая память"""
+    monkeypatch.setattr(webhook, "_loaded_hosts", set())
+
+    def start(name):
+        monkeypatch.setattr(webhook, "POSITIONS_DB", str(tmp_path / f"{name}.db"))
+        monkeypatch.setattr(webhook, "_positions_local", threading.local())
+        webhook._loaded_hosts.clear()
+
+    return start
+
+
+def test_collected_host_is_visible_to_a_new_instance(kv, new_instance):
+    new_instance("a")
+    webhook.store_analytics("h1", analytics([day(i) for i in range(2, 16)]), day(1))
+    assert "wm:host:h1" in kv
+
+    new_instance("b")
+    assert webhook.collect_range("h1") is None  # вчерашний день уже собран другим инстансом
+    rows = webhook.positions_db().execute("SELECT COUNT(*) FROM wm_query_days").fetchone()[0]
+    assert rows == 2 * 14
+
+
+def test_without_kv_instance_starts_empty(new_instance):
+    new_instance("a")
+    webhook.store_analytics("h1", analytics([day(2)]), day(1))
+    new_instance("b")
+    assert webhook.collect_range("h1") is not None
+
+
+def test_kv_outage_does_not_overwrite_saved_host(kv, stub_server, new_instance, monkeypatch):
+    new_instance("a")
+    webhook.store_analytics("h1", analytics([day(i) for i in range(2, 16)]), day(1))
+    saved = kv["wm:host:h1"]
+
+    new_instance("b")
+    down = stub_server(lambda method, path, body: (500, {"error": "down"}, 0))
+    monkeypatch.setattr(webhook, "KV_URL", down.url)
+    webhook.store_analytics("h1", analytics([day(1)]), day(1))
+    assert "h1" not in webhook._loaded_hosts
+    assert kv["wm:host:h1"] == saved
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    messages = []
+    monkeypatch.setattr(webhook, "send_tg", lambda chat_id, text, **kwargs: messages.append((chat_id, text)))
+    return messages
+
+
+def run_collection(days, **stats):
+    webhook.store_analytics("h1", analytics(days, **stats), day(1))
+    return webhook.check_position_alerts()
+
+
+def test_drop_alerts_on_second_run_in_a_new_instance(kv, new_instance, sent):
+    new_instance("a")
+    assert run_collection([day(i) for i in range(4, 20)]) == 0  # первый проход набирает базу
+    assert not sent
+
+    new_instance("b")
+    alerts = run_collection([day(3)], impressions=10, position=15.0)
+    assert alerts == 3  # показы хоста + позиции двух запросов
+    text = sent[0][1]
+    assert "показы" in text and "«купить слона» 3.0 → 15.0" in text
+
+
+def test_without_kv_new_instance_only_rebuilds_baseline(new_instance, sent):
+    new_instance("a")
+    run_collection([day(i) for i in range(4, 20)])
+    new_instance("b")
+    assert run_collection([day(3)], impressions=10, position=15.0) == 0
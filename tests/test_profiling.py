@@ -0,0 +1,39 @@
+"""Профилирование вебхука: сессия без апдейтов останавливается по PROFILE_MAX_SECONDS"""
+import time
+import tracemalloc
+
+import webhook
+
+
+def test_profile_stops_by_time_cap(monkeypatch, tmp_path):
+    sent = []
+    monkeypatch.setattr(webhook, "PROFILE_MAX_SECONDS", 0.2)
+    monkeypatch.setattr(webhook, "PROFILE_FILE", str(tmp_path / "profile.folded"))
+    monkeypatch.setattr(webhook, "send_tg", lambda chat_id, text, *args, **kwargs: sent.append((chat_id, text)))
+    was_tracing = tracemalloc.is_tracing()
+    
+    assert webhook.start_profile(1000, chat_id=42)
+    session = webhook._profile
+    session["thread"].join(timeout=5)
+    
+    assert not session["thread"].is_alive()
+    assert webhook._profile is None
+    assert tracemalloc.is_tracing() == was_tracing
+    assert len(sent) == 1 and sent[0][0] == 42
+    assert "по лимиту" in sent[0][1]
+    assert (tmp_path / "profile.folded").exists()
+    
+    # апдейт после остановки ничего не делает, новый профиль можно запустить сразу
+    webhook.count_profiled_update(1)
+    assert len(sent) == 1
+    assert webhook.start_profile(1)
+    webhook.count_profiled_update(2)
+    assert webhook._profile is None
+    assert len(sent) == 2 and "по лимиту" not in sent[1][1]
+
+
+def test_profile_request_mentions_cap(monkeypatch):
+    monkeypatch.setattr(webhook, "CRON_SECRET", "s")
+    monkeypatch.setattr(webhook, "start_profile", lambda updates: True)
+    status, body = webhook.profile_request("5", "Bearer s")
+    assert status == 200 and b"at most" in body
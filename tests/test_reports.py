@@ -0,0 +1,31 @@
+"""Текстовые отчёты: экранирование Markdown и обрезка по строкам."""
+import bot
+
+
+def team_row(username, task, minutes=30, day="2024-09-02"):
+    return {
+        "user_id": 1, "username": username, "day": day, "task_name": task, "minutes": minutes,
+        "day_total": minutes, "user_total": minutes, "team_total": minutes,
+    }
+
+
+def test_team_report_escapes_names():
+    text = bot.render_team_report("2024-09-01", "2024-09-07", [team_row("ivan_petrov", "fix *bold* [link]`")])
+    assert "@ivan\\_petrov" in text
+    assert "fix \\*bold\\* \\[link]\\`" in text
+
+
+def test_team_report_truncates_on_line_boundary():
+    rows = [team_row("ivan", f"задача {i} " + "x" * 60, day="2024-09-02") for i in range(200)]
+    text = bot.render_team_report("2024-09-01", "2024-09-07", rows)
+    assert len(text) <= bot.REPORT_MAX_CHARS
+    body, tail = text.rsplit("\n", 1)
+    assert tail == "…"
+    # каждая строка задачи дошла целиком, вместе с длительностью
+    tasks = [line for line in body.splitlines() if line.startswith("    • ")]
+    assert tasks and all(line.endswith(bot.format_minutes(30)) for line in tasks)
+
+
+def test_truncate_lines_keeps_short_text():
+    assert bot.truncate_lines("a\nb", limit=10) == "a\nb"
+    assert bot.truncate_lines("aaaa\nbbbb\ncccc", limit=11) == "aaaa\n…"
@@ -0,0 +1,43 @@
+"""Колоночный снимок: открытые сессии не держат водяной знак, аналитика экранирует разметку."""
+import sqlite3
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from test_archive import OLD, add_closed
+
+
+def close_session(bot, session_id):
+    conn = sqlite3.connect(bot.DB_PATH)
+    conn.execute("UPDATE time_sessions SET ended_at = started_at, duration_minutes = 45 WHERE id = ?", (session_id,))
+    conn.commit()
+    conn.close()
+
+
+def test_open_session_does_not_freeze_watermark(bot_db):
+    forgotten = bot_db.start_session(2, "petr", "забытый таймер")
+    add_closed(bot_db, 3, started=OLD)
+    assert bot_db.refresh_snapshot() == 3
+    assert bot_db.load_snapshot_meta()["pending"] == [forgotten]
+    
+    # Строки выше водяного знака ушли в архив до следующего refresh
+    add_closed(bot_db, 2, started=OLD)
+    assert bot_db.archive_old_sessions(retention_days=180) == 5
+    assert bot_db.refresh_snapshot() == 2
+    
+    close_session(bot_db, forgotten)
+    assert bot_db.refresh_snapshot() == 1
+    meta = bot_db.load_snapshot_meta()
+    assert meta["rows"] == 6 and meta["pending"] == []
+    snap = bot_db.SessionSnapshot(meta)
+    assert int(np.asarray(snap.minutes).sum()) == 5 * 30 + 45
+
+
+def test_analytics_escapes_names(bot_db):
+    today = datetime.now().date()
+    stats = {"total": 60, "users": {1: (60, 0)}, "tasks": {"fix_db *срочно*": (60, 0)},
+             "heatmap": np.zeros((7, 24))}
+    text = bot_db.render_analytics((today - timedelta(days=6)).isoformat(), today.isoformat(),
+                                   stats, {1: "ivan_petrov"})
+    assert "@ivan\\_petrov" in text
+    assert "fix\\_db \\*срочно\\*" in text
@@ -0,0 +1,94 @@
+"""PerUserUpdateProcessor: порядок апдейтов одного пользователя и честность слотов."""
+import asyncio
+import random
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+from conftest import FakeBot, message_update
+
+
+@pytest.fixture
+def handlers(bot_db, monkeypatch):
+    monkeypatch.setattr(bot_db, "schedule_session_deadlines", lambda *args: None)
+    return bot_db
+
+
+async def jittered(coroutine, rng):
+    """Апдейт, который сначала ждёт (сеть, to_thread) — без очереди такие перемешиваются"""
+    await asyncio.sleep(rng.uniform(0, 0.02))
+    await coroutine
+
+
+def dispatch(bot, update):
+    text = update.message.text
+    command, *args = text.split()
+    handler = bot.track_command if command == "/track" else bot.stop_command
+    return handler(update, SimpleNamespace(args=args, job_queue=None))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_interleaved_track_stop_keep_order(handlers, seed):
+    bot = handlers
+    rng = random.Random(seed)
+    fake = FakeBot(delay=0.005)
+    commands = ["/track A", "/stop", "/track B", "/stop", "/track C", "/stop", "/track D"]
+
+    async def run():
+        processor = bot.PerUserUpdateProcessor(4)
+        tasks = []
+        for i, text in enumerate(commands):
+            update = message_update(i, text, bot=fake)
+            tasks.append(asyncio.create_task(
+                processor.process_update(update, jittered(dispatch(bot, update), rng))
+            ))
+            # /track и /stop второго пользователя идут вперемешку с первым
+            other = message_update(100 + i, text, user_id=2, bot=fake)
+            tasks.append(asyncio.create_task(
+                processor.process_update(other, jittered(dispatch(bot, other), rng))
+            ))
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+
+    conn = sqlite3.connect(bot.DB_PATH)
+    for user_id in (1, 2):
+        rows = conn.execute(
+            "SELECT task_name, ended_at IS NOT NULL FROM time_sessions WHERE user_id = ? ORDER BY id", (user_id,)
+        ).fetchall()
+        assert rows == [("A", 1), ("B", 1), ("C", 1), ("D", 0)]
+    conn.close()
+    assert not any("Нет активной сессии" in text or "уже есть активная" in text for _, text in fake.sent)
+
+
+def test_busy_user_does_not_take_all_slots():
+    """20 медленных апдейтов одного пользователя не задерживают второго"""
+    import bot
+
+    done = []
+
+    async def work(name, seconds):
+        await asyncio.sleep(seconds)
+        done.append(name)
+
+    async def run():
+        processor = bot.PerUserUpdateProcessor(4)
+        tasks = [
+            asyncio.create_task(processor.process_update(message_update(i, "/week"), work(f"busy{i}", 0.05)))
+            for i in range(20)
+        ]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(processor.process_update(message_update(99, "/status", user_id=2), work("other", 0))))
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert done.index("other") <= 1
+
+
+def test_same_user_private_and_group_share_queue():
+    import bot
+
+    keys = bot.PerUserUpdateProcessor.order_keys
+    assert keys(message_update(1, "/track", user_id=5)) == [("user", 5)]
+    assert keys(message_update(2, "/stop", user_id=5, chat_id=-100)) == [("chat", -100), ("user", 5)]
@@ -0,0 +1,137 @@
+"""Распознавание длинных голосовых кусками: порядок, сбои, параллелизм, пробный кусок."""
+import asyncio
+import os
+import random
+import threading
+import time
+
+import pytest
+
+import bot
+
+
+class StubWhisper:
+    """transcribe(path) без сети: текст куска — его имя, задержка случайная"""
+
+    def __init__(self, fail=(), delay=0.02, breaker=None):
+        self.fail = set(fail)
+        self.delay = delay
+        self.breaker = breaker
+        self.calls = []
+        self.events = []
+        self.active = self.max_active = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, path):
+        if self.breaker and not self.breaker.allow():
+            raise bot.UpstreamUnavailable("OpenAI")
+        with self._lock:
+            self.calls.append(path)
+            self.events.append(("start", path))
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(random.uniform(self.delay / 2, self.delay))
+        with self._lock:
+            self.active -= 1
+            self.events.append(("end", path))
+        if path in self.fail:
+            if self.breaker:
+                self.breaker.record(500)
+            raise RuntimeError(f"whisper failed on {path}")
+        if self.breaker:
+            self.breaker.success()
+        return f" {path} "
+
+
+@pytest.fixture
+def openai_breaker(monkeypatch):
+    breaker = bot.CircuitBreaker("openai", failures=1, reset_timeout=0.05)
+    monkeypatch.setitem(bot.BREAKERS, "openai", breaker)
+    return breaker
+
+
+def segments(n):
+    return [f"seg{i:02d}" for i in range(n)]
+
+
+def test_segments_are_joined_in_order(openai_breaker):
+    whisper = StubWhisper()
+    progress = []
+
+    async def on_progress(done, total, text):
+        progress.append((done, total, text))
+
+    text = asyncio.run(bot.transcribe_segments(segments(12), on_progress, transcribe=whisper, concurrency=4))
+    assert text == " ".join(segments(12))
+    assert [p[0] for p in progress] == list(range(1, 13))
+    # префикс только растёт и всегда — начало итогового текста
+    assert all(text.startswith(p[2]) for p in progress)
+    assert progress[-1][2] == text
+
+
+def test_concurrency_limit(openai_breaker):
+    whisper = StubWhisper(delay=0.05)
+    asyncio.run(bot.transcribe_segments(segments(12), transcribe=whisper, concurrency=3))
+    assert whisper.max_active == 3
+
+
+def test_failed_segment_fails_the_whole_voice(openai_breaker):
+    whisper = StubWhisper(fail={"seg02"})
+    with pytest.raises(RuntimeError, match="seg02"):
+        asyncio.run(bot.transcribe_segments(segments(8), transcribe=whisper, concurrency=1))
+    # по одному за раз: куски после упавшего отменены, не дойдя до Whisper
+    assert whisper.calls == segments(3)
+
+
+def test_half_open_sends_one_probe_segment_first(openai_breaker):
+    openai_breaker.failure()  # разомкнут
+    time.sleep(0.06)          # готов к пробному запросу
+    whisper = StubWhisper(delay=0.05, breaker=openai_breaker)
+    text = asyncio.run(bot.transcribe_segments(segments(6), transcribe=whisper, concurrency=6))
+    assert text == " ".join(segments(6))
+    assert whisper.events[:2] == [("start", "seg00"), ("end", "seg00")]
+    assert whisper.max_active == 5  # после удачной пробы — все остальные сразу
+    assert openai_breaker.state == openai_breaker.CLOSED
+
+
+def test_half_open_failed_probe_stops_fan_out(openai_breaker):
+    openai_breaker.failure()
+    time.sleep(0.06)
+    whisper = StubWhisper(fail={"seg00"}, breaker=openai_breaker)
+    with pytest.raises(RuntimeError):
+        asyncio.run(bot.transcribe_segments(segments(6), transcribe=whisper, concurrency=6))
+    assert whisper.calls == ["seg00"]
+
+
+def test_ffmpeg_failure_falls_back_to_whole_file(tmp_path, monkeypatch):
+    fake = tmp_path / "ffmpeg"
+    fake.write_text("#!/bin/sh\necho 'broken build' >&2\nexit 1\n")
+    fake.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+    whole = []
+    monkeypatch.setattr(bot, "transcribe_file", lambda path: whole.append(path) or "целиком")
+
+    audio = tmp_path / "voice.ogg"
+    audio.write_bytes(b"OggS")
+    text = asyncio.run(bot.transcribe_voice(str(audio), duration=600))
+    assert text == "целиком" and whole == [str(audio)]
+
+
+@pytest.mark.parametrize("text, names", [
+    ("Надо обновить сайт. Ещё проверить версию 3.5", ["Обновить сайт", "Проверить версию 3.5"]),
+    ("Также позвонить клиенту. Плюс надо купить бумагу", ["Позвонить клиенту", "Купить бумагу"]),
+    ("Еще, нужно сделать бэкап", ["Сделать бэкап"]),
+])
+def test_dictation_strips_leading_links(text, names):
+    assert [c["name"] for c in bot.split_dictation(text)] == names
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Антон, нужно сделать отчёт на завтра", [("Сделать отчёт", "@antonkamer")]),
+    ("Антону подготовить отчёт к пятнице", [("Подготовить отчёт", "@antonkamer")]),
+    ("Коллеги, надо обновить сайт. Олег, нужно позвонить клиенту",
+     [("Обновить сайт", None), ("Позвонить клиенту", None)]),
+    ("Поговорить с Андреем о бюджете", [("Поговорить с Андреем о бюджете", None)]),
+])
+def test_dictation_addresses_and_spoken_names(text, expected):
+    assert [(c["name"], c["assignee"]) for c in bot.split_dictation(text)] == expected